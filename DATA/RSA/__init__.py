@@ -1 +1,23 @@
-from .components import Volume, ID_Object, RSA_Vector, Trace, TraceObject, File
\ No newline at end of file
+from .components import (AlignmentScore, ChunkedVolume, File, ID_Object,
+                         JobEngine, JobServer, LoadedSample, PointProjector,
+                         RegistrationParameters, RegistrationResampler,
+                         RegistrationTransform, RSA_Vector, Sample,
+                         SampleCache, SampleWatcher, Session, SharedArray,
+                         Trace, TraceObject, Volume, VolumePyramid,
+                         allocate_volume, attach_array, batch_qc_snapshots,
+                         bounding_box, build_pyramids, downsampled_copy,
+                         estimate_sample_nbytes, expand_box, export_frames,
+                         export_registered, file_set, find_samples, fit_points,
+                         held_nbytes, is_complete, is_memory_mapped,
+                         is_out_of_core, load_checkpoint,
+                         load_checkpoint_array, load_registration,
+                         maximum_intensity_projections, pet_hotspots,
+                         placement_offset, pyramid_jobs, read_uint8_frames,
+                         read_uint8_volume, read_volume_file, release_frames,
+                         release_pages, remove_stale_buffers,
+                         render_qc_snapshot, rescale_volume, rinfo_hash,
+                         root_points, root_uptake, save_checkpoint,
+                         save_export_info, save_registration, save_resampled,
+                         save_root_uptake, save_slices, search_flip_rotation,
+                         serve_jobs, share_array, slab_size, union_box,
+                         volume_shape, volume_voxels, watch_samples)
@@ -1,4 +1,31 @@
+from .cache import SampleCache, held_nbytes
+from .checkpoint import (load_checkpoint, load_checkpoint_array,
+                         save_checkpoint)
+from .export import (export_frames, export_registered, save_export_info,
+                     save_resampled, save_slices)
 from .file import File
-from .rinfo import ID_Object, RSA_Vector
+from .jobs import JobEngine, LoadedSample
+from .projection import PointProjector, maximum_intensity_projections
+from .pyramid import (ChunkedVolume, VolumePyramid, build_pyramids,
+                      pyramid_jobs)
+from .qc import batch_qc_snapshots, render_qc_snapshot
+from .reader import (read_uint8_frames, read_uint8_volume, read_volume_file,
+                     release_frames)
+from .registration import (AlignmentScore, RegistrationParameters,
+                           RegistrationResampler, RegistrationTransform,
+                           fit_points, pet_hotspots, placement_offset,
+                           root_points, search_flip_rotation)
+from .rinfo import ID_Object, RSA_Vector, rinfo_hash
+from .sample import Sample, load_registration, save_registration
+from .scratch import (allocate_volume, downsampled_copy, is_memory_mapped,
+                      is_out_of_core, release_pages, slab_size)
+from .shared import (SharedArray, attach_array, remove_stale_buffers,
+                     share_array)
+from .service import JobServer, serve_jobs
+from .session import (Session, estimate_sample_nbytes, find_samples,
+                      volume_shape, volume_voxels)
 from .trace import Trace, TraceObject
-from .volume import Volume
+from .uptake import root_uptake, save_root_uptake
+from .volume import (Volume, bounding_box, expand_box, rescale_volume,
+                     union_box)
+from .watch import SampleWatcher, file_set, is_complete, watch_samples
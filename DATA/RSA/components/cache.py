@@ -0,0 +1,90 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Union
+
+import numpy as np
+
+
+def held_nbytes(arrays: Iterable[Union[np.ndarray, None]]) -> int:
+    """Bytes held by arrays, counting the buffers shared by views once.
+
+    Read-only memory-mapped files (e.g. a single-file volume) cost nothing to keep,
+    so they are not counted; memory-mapped scratch files are.
+    """
+
+    buffers = {}
+    for ndarray in arrays:
+        if ndarray is None:
+            continue
+        while isinstance(ndarray.base, np.ndarray):
+            ndarray = ndarray.base
+        if isinstance(ndarray, np.memmap) and ndarray.mode in ('r', 'c'):
+            continue
+        buffers[id(ndarray)] = ndarray.nbytes
+    return sum(buffers.values())
+
+class SampleCache(object):
+    def __init__(self, budget: int, release: Union[Callable[[Any], None], None]=None):
+        """The recently loaded samples, dropped least recently used first when they exceed budget bytes.
+
+        A sample is stored with the signature of its files (see File.sample_signature());
+        it is returned only while the files are unchanged. The current sample is not in the
+        cache: it is put back when another one is opened, and taken out when reopened.
+
+        Args:
+            budget (int): Bytes kept at most. A sample larger than this is not kept.
+            release (Union[Callable[[Any], None], None], optional): Called with a sample when it is dropped, e.g. to remove its scratch files. Defaults to None.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.budget = budget
+        self.release = release
+        #// key -> (signature, sample, nbytes); the least recently used first
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key: str):
+        return key in self.__entries
+
+    def nbytes(self) -> int:
+        return sum([nbytes for _, _, nbytes in self.__entries.values()])
+
+    def put(self, key: str, signature: Any, sample: Any, nbytes: int):
+        self.discard(key)
+        self.__entries[key] = (signature, sample, nbytes)
+        self.logger.info(f'[Cached] {key} ({nbytes/1024/1024:.1f} MB)')
+        self.evict()
+
+    def pop(self, key: str, signature: Any) -> Any:
+        """The sample of key taken out of the cache, or None if it is not cached or its files have changed."""
+
+        if key not in self.__entries:
+            return None
+
+        cached_signature, sample, _ = self.__entries.pop(key)
+        if cached_signature != signature:
+            self.logger.info(f'[Cache outdated] {key}')
+            self.__release(sample)
+            return None
+        return sample
+
+    def discard(self, key: str):
+        if key in self.__entries:
+            self.__release(self.__entries.pop(key)[1])
+
+    def evict(self):
+        while len(self.__entries) != 0 and self.nbytes() > self.budget:
+            key, (_, sample, _) = self.__entries.popitem(last=False)
+            self.logger.info(f'[Evicted] {key}')
+            self.__release(sample)
+
+    def clear(self):
+        while len(self.__entries) != 0:
+            self.__release(self.__entries.popitem(last=False)[1][1])
+
+    def __release(self, sample: Any):
+        if self.release is not None:
+            self.release(sample)
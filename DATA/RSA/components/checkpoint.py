@@ -0,0 +1,60 @@
+import json
+import os
+from typing import Dict, Union
+
+import config
+import numpy as np
+
+
+def save_checkpoint(directory: str, state: dict, arrays: Union[Dict[str, np.ndarray], None]=None):
+    """Saves the state of a sample being worked on to directory/checkpoint.json, and arrays as directory/[name].npy.
+
+    Each file is written aside and then replaced at once, and the JSON file last, so an
+    interrupted save leaves the previous checkpoint readable.
+
+    Args:
+        directory (str): The checkpoint directory ([volume_name]_checkpoint/).
+        state (dict): The JSON serializable state. The version, the skip size and the names of the saved arrays are added.
+        arrays (Union[Dict[str, np.ndarray], None], optional): Arrays to (re)write, or to remove if None; the others saved before are kept. Defaults to None.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    for name, ndarray in (arrays or {}).items():
+        fname = os.path.join(directory, name+'.npy')
+        if ndarray is not None:
+            with open(fname+'.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(ndarray))
+            os.replace(fname+'.tmp', fname)
+        elif os.path.isfile(fname):
+            os.remove(fname)
+
+    state = dict(state)
+    state['version'] = config.version_string()
+    state['skip_size'] = config.skip_size
+    state['arrays'] = sorted([os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith('.npy')])
+
+    fname = os.path.join(directory, 'checkpoint.json')
+    with open(fname+'.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(fname+'.tmp', fname)
+
+def load_checkpoint(directory: str, signature) -> Union[dict, None]:
+    """The state saved by save_checkpoint(), or None if there is none, or it was saved for other files (signature) or another skip size."""
+
+    try:
+        with open(os.path.join(directory, 'checkpoint.json'), 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if state.get('signature') != signature or state.get('skip_size') != config.skip_size:
+        return None
+    return state
+
+def load_checkpoint_array(directory: str, state: dict, name: str) -> Union[np.ndarray, None]:
+    if name not in state.get('arrays', []):
+        return None
+    try:
+        return np.load(os.path.join(directory, name+'.npy'))
+    except (OSError, ValueError):
+        return None
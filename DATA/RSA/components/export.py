@@ -0,0 +1,140 @@
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+from skimage import io
+
+from .registration import (RegistrationParameters, RegistrationResampler,
+                           RegistrationTransform)
+from .scratch import release_pages, slab_size
+from .shared import attach_array
+from .volume import Volume
+
+
+def save_slices(ndarray: np.ndarray, dest: str, start: int=0):
+    """Saves a volume as img0000.tif, img0001.tif, ... in dest.
+
+    With start > 0, ndarray is a z-slab saved from img[start] on, and the slices already in dest are kept.
+    """
+
+    os.makedirs(dest, exist_ok=True)
+    #// slices of a previous export with another box would otherwise be left behind
+    if start == 0:
+        for f in glob.glob(os.path.join(dest, 'img*.tif')):
+            os.remove(f)
+
+    for i in range(len(ndarray)):
+        io.imsave(os.path.join(dest, f'img{start+i:04}.tif'), ndarray[i], check_contrast=False)
+
+def save_resampled(ndarray: np.ndarray, resampler: RegistrationResampler, dest: str, progress: Union[Callable, None]=None):
+    """Resamples ndarray and saves the slices in dest, one z-slab at a time.
+
+    Only one slab of the output is in memory, and the out-of-core mode sizes it to the memory ceiling.
+    """
+
+    size = slab_size(resampler.shape, ndarray.dtype)
+    for start in range(0, resampler.shape[0], size):
+        stop = min(start+size, resampler.shape[0])
+        if progress is not None:
+            progress(start, resampler.shape[0], 'Exporting the volume')
+        save_slices(resampler.resample(ndarray, start=start, stop=stop), dest, start=start)
+        release_pages(ndarray)
+
+def save_export_info(dest: str, resampler: RegistrationResampler, ct_resolution: float, ct_shape: Tuple[int], frames: Union[List[str], None]=None):
+    """Saves the grid of an exported volume to dest/export.json."""
+
+    info = {
+        'volume_shape': list(resampler.grid_shape),
+        'offset': [b.start for b in resampler.box],
+        'voxel_size': ct_resolution*resampler.voxel_scale,
+        'ct_voxel_size': ct_resolution,
+        'ct_volume_shape': list(ct_shape),
+        #// the center of voxel (0, 0, 0) in the X-ray CT voxel coordinates
+        'origin': [0.5*resampler.voxel_scale-0.5]*3,
+    }
+    if frames is not None:
+        info['frames'] = frames
+
+    os.makedirs(dest, exist_ok=True)
+    with open(os.path.join(dest, 'export.json'), 'w') as f:
+        json.dump(info, f, indent=1)
+
+#// the frames and the resampler shared by the export workers; set once per worker by the initializer
+_export_globals = {}
+
+def _init_frame_worker(frames_handle: tuple, resampler: RegistrationResampler):
+    _export_globals['frames'] = attach_array(frames_handle)
+    _export_globals['resampler'] = resampler
+
+def _export_frame(job: Tuple[int, str]) -> int:
+    index, dest = job
+    save_resampled(_export_globals['frames'][index], _export_globals['resampler'], dest)
+    return index
+
+def export_frames(frames: np.ndarray, resampler: RegistrationResampler, dests: List[str], processes: Union[int, None]=None, progress: Union[Callable, None]=None):
+    """Resamples and saves all frames of a dynamic PET volume in parallel with one registration.
+
+    The resampler (and so the transform) is computed once and sent once to each worker, and
+    each worker maps the frames (see Volume.shared_handle()), so a frame costs only its resampling and saving.
+
+    Args:
+        frames (np.ndarray): The frames read by read_uint8_frames(), or any 4D array.
+        resampler (RegistrationResampler): The resampling shared by all frames.
+        dests (List[str]): The output directory of each frame.
+        processes (Union[int, None], optional): The number of worker processes. Defaults to the number of CPUs.
+        progress (Union[Callable, None], optional): Called with (i, total, message) for each frame. Defaults to None.
+    """
+
+    volume = Volume()
+    volume.init_from_volume(frames)
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_frame_worker, initargs=(volume.shared_handle(), resampler)) as executor:
+            for i, _ in enumerate(executor.map(_export_frame, enumerate(dests))):
+                if progress is not None:
+                    progress(i+1, len(dests), 'Exporting frames')
+    finally:
+        volume.clear()
+
+def export_registered(ndarray: np.ndarray, rescaled_shape: Tuple[int], parameters: RegistrationParameters, dest: str, ct_shape: Tuple[int], box: Union[Tuple[slice], None]=None, voxel_scale: float=1., ct_resolution: float=1., frames: Union[np.memmap, None]=None, frame_names: Union[List[str], None]=None, source=None, processes: Union[int, None]=None, progress: Union[Callable, None]=None) -> RegistrationResampler:
+    """Exports the registrated PET volume, or all its frames, on a grid aligned with the X-ray CT volume, with export.json.
+
+    Args:
+        ndarray (np.ndarray): The original PET volume (not rescaled).
+        rescaled_shape (Tuple[int]): Shape of the rescaled PET volume that the registration applies to.
+        parameters (RegistrationParameters): The registration.
+        dest (str): The output directory.
+        ct_shape (Tuple[int]): Shape of the X-ray CT volume.
+        box (Union[Tuple[slice], None], optional): Only this box of the X-ray CT volume is exported. Defaults to None.
+        voxel_scale (float, optional): Output voxel size in X-ray CT voxels. Defaults to 1.
+        ct_resolution (float, optional): X-ray CT voxel resolution, written to export.json. Defaults to 1.
+        frames (Union[np.memmap, None], optional): All frames of a dynamic PET volume, of which ndarray is one. Defaults to None.
+        frame_names (Union[List[str], None], optional): The output directory name of each frame. Defaults to None (no frames).
+        source (optional): A chunked copy of ndarray (ChunkedVolume), from which only the chunks of the exported region are read. Defaults to None.
+        processes (Union[int, None], optional): The number of worker processes for the frames. Defaults to the number of CPUs.
+        progress (Union[Callable, None], optional): Called with (i, total, message). Defaults to None.
+
+    Returns:
+        RegistrationResampler: The resampling of the export.
+    """
+
+    frame_names = frame_names if frame_names is not None else []
+
+    #// the transform and the resampling coordinates are computed once, also for all frames
+    transform = RegistrationTransform(parameters, rescaled_shape, ct_shape)
+    resampler = RegistrationResampler(transform, ndarray.shape, voxel_scale=voxel_scale, box=box)
+
+    if frames is not None:
+        dests = [os.path.join(dest, name) for name in frame_names]
+        if progress is not None:
+            progress(0, len(dests), 'Exporting frames')
+        export_frames(frames, resampler, dests, processes=processes, progress=progress)
+        save_export_info(dest, resampler, ct_resolution, ct_shape, frames=frame_names)
+    else:
+        #// resampled and saved slab by slab, so the output volume is never in memory as a whole
+        save_resampled(source if source is not None else ndarray, resampler, dest, progress=progress)
+        save_export_info(dest, resampler, ct_resolution, ct_shape)
+
+    return resampler
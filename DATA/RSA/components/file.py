@@ -1,7 +1,24 @@
+import hashlib
 import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
 
+from .reader import raw_header_file, read_volume_shape, volume_file_extensions
+
+
+def natural_sort_key(path: str):
+    """A sort key ordering numbers by value, so that img2 comes before img10."""
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', os.path.basename(path).lower())]
 
 class File(object):
+    #// directory -> (mtime, image files bucketed by extension, noise files), least recently used first;
+    #// bounded, since the watch and service modes see new directories for as long as they run
+    __scan_cache: Dict[str, Tuple[int, Dict[str, List[str]], List[str]]] = OrderedDict()
+    __scan_cache_size = 64
+    __scan_lock = threading.Lock()
+
     def __init__(self, volume_directory: str=''):
         super().__init__()
         self.clear()
@@ -11,26 +28,133 @@ class File(object):
     def clear(self):
         self.directory = ''
         self.rinfo_file = ''
+        self.img_files = []
 
     def extensions(self):
         return ('.cb', '.png', '.tif', '.tiff', '.jpg', '.jpeg')
 
+    def __scan(self):
+        """Lists the directory once and buckets the files by extension.
+
+        The result is cached until the modification time of the directory changes, for the
+        most recently scanned directories. Only the directory entries are used, so no file is stat'ed.
+        """
+
+        mtime = os.stat(self.directory).st_mtime_ns
+        with File.__scan_lock:
+            cached = File.__scan_cache.get(self.directory)
+            if cached is not None and cached[0] == mtime:
+                File.__scan_cache.move_to_end(self.directory)
+                return cached[1], cached[2]
+
+        buckets = {ext: [] for ext in self.extensions()+volume_file_extensions()}
+        noise_files = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+
+                ext = os.path.splitext(entry.name)[1].lower()
+                #// hidden files such as '._img0001.tif' or '.DS_Store' are not slices
+                if ext in buckets and not entry.name.startswith('.'):
+                    buckets[ext].append(entry.path)
+                else:
+                    noise_files.append(entry.path)
+
+        for files in buckets.values():
+            files.sort(key=natural_sort_key)
+
+        with File.__scan_lock:
+            File.__scan_cache[self.directory] = (mtime, buckets, noise_files)
+            File.__scan_cache.move_to_end(self.directory)
+            while len(File.__scan_cache) > File.__scan_cache_size:
+                File.__scan_cache.popitem(last=False)
+        return buckets, noise_files
+
     def image_files(self):
-        img_files = [os.path.join(self.directory, f) for f in os.listdir(self.directory)]
-        ext_count = []
-        for ext in self.extensions():
-            ext_count.append(len([f for f in img_files if f.lower().endswith(ext)]))
+        buckets, _ = self.__scan()
+        target_ext = max(self.extensions(), key=lambda ext: len(buckets[ext]))
+
+        return list(buckets[target_ext])
+
+    def noise_files(self):
+        buckets, noise_files = self.__scan()
+        volume_file = self.volume_file()
+        if volume_file != '':
+            used_files = set([volume_file, raw_header_file(volume_file)])
+        else:
+            target_ext = max(self.extensions(), key=lambda ext: len(buckets[ext]))
+            used_files = set(buckets[target_ext])
 
-        target_ext = self.extensions()[ext_count.index(max(ext_count))]
+        other_files = [f for files in buckets.values() for f in files]+noise_files
+        return sorted([f for f in other_files if f not in used_files], key=natural_sort_key)
 
-        img_files = sorted([f for f in img_files if f.lower().endswith(target_ext)])
-        return img_files
+    def volume_file(self):
+        """Returns the single-file volume (.npy, .raw or multipage TIFF) if the directory holds one instead of slice images, otherwise ''."""
+
+        buckets, _ = self.__scan()
+        image_files = [f for files in buckets.values() for f in files]
+        if len(image_files) == 1 and os.path.splitext(image_files[0])[1].lower() in volume_file_extensions():
+            return image_files[0]
+
+        return ''
+
+    def is_single_file(self):
+        return len(self.directory) != 0 and self.volume_file() != ''
 
     def pet_directory(self):
         assert len(self.directory) != 0
         return self.directory+'_PET'
         return self.directory+'_PET_registrated'
 
+    def pet_frame_directories(self):
+        """The frame directories of a dynamic PET volume ([volume_name]_PET/frame_XX/), or [] for a static PET volume."""
+
+        pet_directory = self.pet_directory()
+        if not os.path.isdir(pet_directory):
+            return []
+
+        with os.scandir(pet_directory) as it:
+            directories = [entry.path for entry in it if entry.is_dir() and entry.name.lower().startswith('frame')]
+        return sorted(directories, key=natural_sort_key)
+
+    def volume_source(self):
+        """The single-file volume, or the list of slice image files."""
+        return self.volume_file() if self.is_single_file() else self.image_files()
+
+    def source_signature(self):
+        """Identifies the volume files by their names, sizes and modification times, so that data derived from them can be reused while they are unchanged.
+
+        Every file of the volume is stat'ed, so that replacing any slice is noticed; the stats are kept as a digest.
+        """
+
+        if self.is_single_file():
+            volume_file = self.volume_file()
+            files = set([volume_file, raw_header_file(volume_file)])
+        else:
+            files = set(self.img_files)
+
+        with os.scandir(self.directory) as it:
+            stats = sorted([(entry.name, entry.stat()) for entry in it if entry.path in files])
+        digest = hashlib.sha1()
+        for name, stat in stats:
+            digest.update(f'{name}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode('utf-8'))
+        return [os.path.abspath(self.directory), len(stats), digest.hexdigest()]
+
+    def sample_signature(self):
+        """source_signature() of the X-ray CT volume and the PET volume (or its frames), with the size and modification time of the rinfo file."""
+
+        frame_directories = self.pet_frame_directories()
+        pet_directories = frame_directories if len(frame_directories) != 0 else [self.pet_directory()]
+        pet_files = [File(volume_directory=d) for d in pet_directories if os.path.isdir(d)]
+        pet = [f.source_signature() for f in pet_files if f.is_valid()]
+
+        rinfo = None
+        if self.is_rinfo_file_available():
+            stat = os.stat(self.rinfo_file)
+            rinfo = [stat.st_size, stat.st_mtime_ns]
+        return [self.source_signature(), pet, rinfo]
+
     def registrated_pet_directory(self):
         assert len(self.directory) != 0
         return self.directory+'_PET_registrated'
@@ -39,26 +163,35 @@ class File(object):
         self.directory = directory
         self.rinfo_file = self.directory+'.rinfo'
         self.root_traits_file = self.directory+'_root_traits.csv'
+        self.root_uptake_file = self.directory+'_root_uptake.csv'
+        self.registration_file = self.directory+'_registration.json'
+        self.qc_file = self.directory+'_qc.png'
         self.trace_directory = self.directory+'_trace'
+        self.pyramid_directory = self.directory+'_pyramid'
+        self.checkpoint_directory = self.directory+'_checkpoint'
         self.volume = os.path.basename(self.directory)
 
-        self.img_files = [os.path.join(self.directory, f) for f in os.listdir(self.directory)]
-        ext_count = []
-        for ext in self.extensions():
-            ext_count.append(len([f for f in self.img_files if f.lower().endswith(ext)]))
-
-        target_ext = self.extensions()[ext_count.index(max(ext_count))]
-
-        self.img_files = [f for f in self.img_files if f.lower().endswith(target_ext)]
-        self.img_files.sort()
+        self.img_files = self.image_files()
 
     def is_rinfo_file_available(self):
         return os.path.isfile(self.rinfo_file)
 
     def is_valid(self):
-        return len(self.directory) != 0 and len(self.img_files) >= 64
+        if len(self.directory) == 0:
+            return False
+
+        if self.is_single_file():
+            try:
+                shape = read_volume_shape(self.volume_file())
+            except (OSError, ValueError):
+                return False
+            return len(shape) == 3 and shape[0] >= 64
+
+        return len(self.img_files) >= 64
 
     def __str__(self):
+        if self.is_single_file():
+            return (f'Volume file: {self.volume_file()}')
         return (f'Number of image files: {len(self.img_files)}')
 
 if __name__ == '__main__':
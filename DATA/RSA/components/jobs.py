@@ -0,0 +1,315 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+
+import config
+import numpy as np
+
+from .cache import SampleCache, held_nbytes
+from .export import export_registered
+from .file import File
+from .qc import render_qc_snapshot
+from .reader import read_uint8_frames, read_uint8_volume, release_frames
+from .registration import RegistrationParameters, RegistrationTransform
+from .sample import Sample, load_registration, save_registration
+from .session import volume_shape
+from .uptake import root_uptake, save_root_uptake
+
+
+class LoadedSample(object):
+    def __init__(self, directory: str):
+        """A sample loaded for the jobs of the service mode.
+
+        It holds the PET volume (and the frames of a dynamic PET volume), the rinfo and the
+        shape of the X-ray CT volume. No job needs the X-ray CT voxels, so they are not read.
+
+        Args:
+            directory (str): The X-ray CT volume directory.
+        """
+
+        super().__init__()
+        self.file = File(volume_directory=directory)
+        if not self.file.is_valid():
+            raise ValueError(f'Invalid volume: {directory}')
+
+        self.signature = self.file.sample_signature()
+        self.ct_shape = volume_shape(self.file)[0]
+        self.rinfo = Sample(directory).load_rinfo()
+
+        self.pet = None
+        self.frames = None
+        self.frame_names = []
+        frame_directories = self.file.pet_frame_directories()
+        pet_files = [File(volume_directory=d) for d in frame_directories]
+        if len(pet_files) != 0 and all([f.is_valid() for f in pet_files]):
+            self.frames = read_uint8_frames([f.volume_source() for f in pet_files], clip_percentile=config.pet_clip_percentile)
+            self.frame_names = [os.path.basename(d) for d in frame_directories]
+            #// the uptake is sampled from the maximum over the frames, as in the QC snapshots
+            self.pet = np.array(self.frames[0])
+            for frame in self.frames[1:]:
+                np.maximum(self.pet, frame, out=self.pet)
+        elif len(pet_files) == 0 and os.path.isdir(self.file.pet_directory()):
+            pet_file = File(volume_directory=self.file.pet_directory())
+            if pet_file.is_valid():
+                self.pet = read_uint8_volume(pet_file.volume_source(), clip_percentile=config.pet_clip_percentile)
+
+    def nbytes(self) -> int:
+        return held_nbytes([self.pet, self.frames])
+
+    def release(self):
+        release_frames(self.frames)
+        self.frames = None
+
+    def rescaled_pet_shape(self, ct_resolution: float, pet_resolution: float) -> Tuple[int]:
+        return tuple([int(s*pet_resolution/ct_resolution) for s in self.pet.shape])
+
+    def export(self, ct_resolution: float, pet_resolution: float, parameters: RegistrationParameters, dest: str='', voxel_size: Union[float, None]=None, processes: Union[int, None]=None) -> str:
+        """Exports the registrated PET volume (all frames of a dynamic PET volume) to dest, [volume_name]_PET_registrated/ by default, and returns dest."""
+
+        if self.pet is None:
+            raise ValueError(f'No PET volume: {self.file.pet_directory()}')
+
+        dest = dest or self.file.registrated_pet_directory()
+        voxel_size = voxel_size if voxel_size is not None else ct_resolution
+        export_registered(
+            self.pet, self.rescaled_pet_shape(ct_resolution, pet_resolution), parameters, dest, self.ct_shape,
+            voxel_scale=voxel_size/ct_resolution, ct_resolution=ct_resolution,
+            frames=self.frames, frame_names=self.frame_names, processes=processes
+        )
+        return dest
+
+class JobEngine(object):
+    #// job type -> whether the job runs on the loaded sample
+    job_types = OrderedDict([
+        ('load', True),
+        ('export', True),
+        ('uptake', True),
+        ('registration', False),
+        ('qc', False),
+    ])
+
+    def __init__(self, workers: int=2, cache_mb: float=config.sample_cache_mb, max_jobs: int=1000):
+        """Runs jobs against sample directories on a bounded pool of worker threads.
+
+        The loaded samples are kept in a SampleCache between jobs, so repeated jobs on a sample
+        skip loading while its files are unchanged. Jobs on the same sample run one at a time;
+        jobs on different samples run in parallel. Each job records the seconds spent waiting,
+        loading and in its stage.
+
+        A job is a dictionary with 'type' (see job_types) and 'sample' (the X-ray CT volume directory), and:
+
+        - export: optional 'dest', 'voxel_size' and 'processes'
+        - uptake: optional 'dest' and 'radius' (X-ray CT voxels)
+        - registration: 'parameters', 'ct_resolution' and 'pet_resolution', saved to the registration file
+        - qc: optional 'dest'
+
+        export and uptake use 'parameters', 'ct_resolution' and 'pet_resolution' if given, or the saved registration file.
+
+        Args:
+            workers (int, optional): Jobs run at once. Defaults to 2.
+            cache_mb (float, optional): Budget of the loaded samples in MB. Defaults to config.sample_cache_mb.
+            max_jobs (int, optional): Finished jobs kept for status queries. Defaults to 1000.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cache = SampleCache(int(cache_mb*1024*1024), release=lambda sample: sample.release())
+        self.lock = threading.Lock()
+        #// sample -> [lock, number of jobs holding or waiting for it]; removed when no job needs it
+        self.sample_locks = {}
+        self.jobs = OrderedDict()
+        self.next_id = 1
+
+    def submit(self, request: dict) -> dict:
+        """Queues a job and returns its status. Raises ValueError if the job is invalid."""
+
+        if not isinstance(request, dict):
+            raise ValueError('A job must be a JSON object.')
+        if not isinstance(request.get('type'), str) or request['type'] not in self.job_types:
+            raise ValueError(f"Unknown job type: {request.get('type')} (one of {', '.join(self.job_types)})")
+        if not isinstance(request.get('sample'), str) or not os.path.isdir(request['sample']) or not File(volume_directory=request['sample'].rstrip('/\\')).is_valid():
+            raise ValueError(f"Invalid volume: {request.get('sample')}")
+        if ('parameters' in request or request['type'] == 'registration') and not all([k in request for k in ('parameters', 'ct_resolution', 'pet_resolution')]):
+            raise ValueError('parameters, ct_resolution and pet_resolution are given together.')
+        if 'parameters' in request and not isinstance(request['parameters'], dict):
+            raise ValueError('parameters must be a JSON object.')
+
+        with self.lock:
+            job = {
+                'id': str(self.next_id),
+                'type': request['type'],
+                'sample': os.path.abspath(request['sample'].rstrip('/\\')),
+                'status': 'queued',
+                'result': None,
+                'error': '',
+                'cached': False,
+                'timings': {},
+            }
+            self.next_id += 1
+            self.jobs[job['id']] = job
+            self.trim_jobs()
+            queued = self.copy(job)
+        self.executor.submit(self.run, job, request, time.perf_counter())
+        self.logger.info(f"[Job queued] {job['id']} {job['type']} {job['sample']}")
+        return queued
+
+    def job(self, job_id: str) -> Union[dict, None]:
+        with self.lock:
+            return self.copy(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def list_jobs(self) -> List[dict]:
+        with self.lock:
+            return [self.copy(job) for job in self.jobs.values()]
+
+    @staticmethod
+    def copy(job: dict) -> dict:
+        #// the timings are still written by the worker
+        return dict(job, timings=dict(job['timings']))
+
+    def status(self) -> dict:
+        with self.lock:
+            counts = {s: len([j for j in self.jobs.values() if j['status'] == s]) for s in ('queued', 'running', 'done', 'failed')}
+            return {
+                'workers': self.workers,
+                'jobs': counts,
+                'cached_samples': len(self.cache),
+                'cache_mb': self.cache.nbytes()/1024/1024,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.cache.clear()
+
+    def trim_jobs(self):
+        finished = [k for k, j in self.jobs.items() if j['status'] in ('done', 'failed')]
+        for k in finished[:max(0, len(self.jobs)-self.max_jobs)]:
+            del self.jobs[k]
+
+    def lock_sample(self, key: str):
+        """Waits until no other job uses the sample, and holds it until unlock_sample()."""
+
+        with self.lock:
+            entry = self.sample_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        entry[0].acquire()
+
+    def unlock_sample(self, key: str):
+        with self.lock:
+            entry = self.sample_locks[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.sample_locks[key]
+
+    def run(self, job: dict, request: dict, queued_time: float):
+        start = time.perf_counter()
+        with self.lock:
+            job['status'] = 'running'
+            job['timings']['queued'] = start-queued_time
+
+        try:
+            if self.job_types[job['type']]:
+                self.lock_sample(job['sample'])
+                try:
+                    sample = self.acquire(job)
+                    try:
+                        result = self.run_stage(job, request, sample)
+                    finally:
+                        with self.lock:
+                            self.cache.put(job['sample'], sample.signature, sample, sample.nbytes())
+                finally:
+                    self.unlock_sample(job['sample'])
+            else:
+                result = self.run_stage(job, request, None)
+        except Exception as e:
+            with self.lock:
+                job['status'] = 'failed'
+                job['error'] = f'{e.__class__.__name__}: {e}'
+                job['timings']['total'] = time.perf_counter()-queued_time
+            self.logger.error(f"[Job failed] {job['id']} {job['type']} {job['sample']}: {job['error']}")
+            return
+
+        with self.lock:
+            job['status'] = 'done'
+            job['result'] = result
+            job['timings']['total'] = time.perf_counter()-queued_time
+        self.logger.info(f"[Job done] {job['id']} {job['type']} {job['sample']} ({job['timings']['total']:.2f} s)")
+
+    def acquire(self, job: dict) -> LoadedSample:
+        """The sample of job from the cache, or loaded if it is not cached or its files have changed."""
+
+        start = time.perf_counter()
+        signature = File(volume_directory=job['sample']).sample_signature()
+        with self.lock:
+            sample = self.cache.pop(job['sample'], signature)
+        cached = sample is not None
+        if sample is None:
+            sample = LoadedSample(job['sample'])
+        with self.lock:
+            job['cached'] = cached
+            job['timings']['load'] = time.perf_counter()-start
+        return sample
+
+    def run_stage(self, job: dict, request: dict, sample: Union[LoadedSample, None]) -> dict:
+        start = time.perf_counter()
+        result = getattr(self, 'run_'+job['type'])(request, sample, job['sample'])
+        with self.lock:
+            job['timings'][job['type']] = time.perf_counter()-start
+        return result
+
+    def registration(self, request: dict, file: File) -> Tuple[float, float, RegistrationParameters]:
+        """The registration given with the job, or the saved one."""
+
+        if 'parameters' in request:
+            return float(request['ct_resolution']), float(request['pet_resolution']), RegistrationParameters.from_dict(request['parameters'])
+        if not os.path.isfile(file.registration_file):
+            raise ValueError(f'No registration parameters are given or saved: {file.registration_file}')
+        return load_registration(file.registration_file)
+
+    def run_load(self, request: dict, sample: LoadedSample, directory: str) -> dict:
+        return {
+            'ct_shape': list(sample.ct_shape),
+            'pet_shape': list(sample.pet.shape) if sample.pet is not None else None,
+            'frames': sample.frame_names,
+            'rinfo': sample.rinfo is not None,
+            'nbytes': sample.nbytes(),
+        }
+
+    def run_export(self, request: dict, sample: LoadedSample, directory: str) -> dict:
+        ct_resolution, pet_resolution, parameters = self.registration(request, sample.file)
+        voxel_size = float(request['voxel_size']) if 'voxel_size' in request else None
+        dest = sample.export(ct_resolution, pet_resolution, parameters, dest=request.get('dest', ''), voxel_size=voxel_size, processes=request.get('processes'))
+        return {'dest': dest, 'frames': sample.frame_names}
+
+    def run_uptake(self, request: dict, sample: LoadedSample, directory: str) -> dict:
+        if sample.pet is None:
+            raise ValueError(f'No PET volume: {sample.file.pet_directory()}')
+        if sample.rinfo is None:
+            raise ValueError(f'No rinfo file: {sample.file.rinfo_file}')
+
+        ct_resolution, pet_resolution, parameters = self.registration(request, sample.file)
+        transform = RegistrationTransform(parameters, sample.rescaled_pet_shape(ct_resolution, pet_resolution), sample.ct_shape)
+        uptake = root_uptake(sample.rinfo, sample.pet, transform, radius=int(request.get('radius', 0)), resolution=ct_resolution)
+        if len(uptake) == 0:
+            raise ValueError('No root trace is available.')
+
+        dest = request.get('dest') or sample.file.root_uptake_file
+        save_root_uptake(uptake, dest)
+        return {'file': dest, 'roots': [{k: v if isinstance(v, str) else float(v) for k, v in row.items()} for row in uptake]}
+
+    def run_registration(self, request: dict, sample: None, directory: str) -> dict:
+        file = File(volume_directory=directory)
+        ct_resolution, pet_resolution, parameters = self.registration(request, file)
+        save_registration(file.registration_file, ct_resolution, pet_resolution, parameters)
+        return {'file': file.registration_file, 'parameters': parameters.dictionary()}
+
+    def run_qc(self, request: dict, sample: None, directory: str) -> dict:
+        return {'file': render_qc_snapshot(directory, request.get('dest', ''))}
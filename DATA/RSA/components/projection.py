@@ -0,0 +1,74 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+
+from .registration import RegistrationParameters, RegistrationTransform
+
+
+def maximum_intensity_projections(ndarray: np.ndarray) -> List[np.ndarray]:
+    """The maximum intensity projections along axes 0, 1 and 2."""
+    return [ndarray.max(axis=axis) for axis in range(3)]
+
+class PointProjector(object):
+    def __init__(self, ndarray: np.ndarray, threshold_ratio: float=0.05, max_points: int=500000, rescaled_shape: Union[Tuple[int], None]=None):
+        """Maximum intensity projections of a registered volume, computed from its voxels above the noise level.
+
+        The voxels are extracted once and sorted by intensity. For each registration, only
+        these points are transformed and written into the projections, so the cost scales
+        with the signal and not with the volume size. Points off the voxel grid are written
+        to the 2x2 pixels around them, so that rotated projections have no holes.
+
+        Args:
+            ndarray (np.ndarray): The PET volume.
+            threshold_ratio (float, optional): Voxels below this ratio of the maximum are ignored. Defaults to 0.05.
+            max_points (int, optional): Only the brightest voxels are kept. Defaults to 500000.
+            rescaled_shape (Union[Tuple[int], None], optional): The shape of the rescaled PET volume that the registration applies to, so that the original PET volume can be given instead. Defaults to None.
+        """
+
+        super().__init__()
+        self.source_shape = tuple(rescaled_shape) if rescaled_shape is not None else ndarray.shape
+        points = np.argwhere(ndarray > ndarray.max()*threshold_ratio)
+        values = ndarray[tuple(points.T)]
+
+        order = np.argsort(values)[-max_points:]
+        self.points = points[order]
+        if self.source_shape != ndarray.shape:
+            zoom = np.array(self.source_shape, dtype=np.float64)/np.array(ndarray.shape)
+            self.points = (self.points+0.5)*zoom-0.5
+        self.values = values[order]
+
+    def project(self, parameters: RegistrationParameters, target_shape: Tuple[int], shift_scale: float=1., out: Union[List[np.ndarray], None]=None, binning: int=1) -> List[np.ndarray]:
+        """The projections along axes 0, 1 and 2 in target_shape, reduced by binning voxels per pixel."""
+
+        transform = RegistrationTransform(parameters, self.source_shape, target_shape, shift_scale=shift_scale)
+        coordinates = transform.source_to_target(self.points)
+        mapped = np.rint(coordinates).astype(np.int64)
+        inside = np.all((mapped >= 0) & (mapped < np.array(target_shape)), axis=1)
+        coordinates, mapped, values = coordinates[inside], mapped[inside], self.values[inside]
+
+        #// off the voxel grid (rotated by other than a multiple of 90 degrees, or rescaled), each point is written to
+        #// the 2x2 pixels around it, so that the projections have no holes; a bin gathers several voxels, so binned projections need not
+        splat = binning == 1 and len(mapped) != 0 and np.abs(coordinates-mapped).max() > 1e-3
+        pixels = np.floor(coordinates).astype(np.int64) if splat else mapped//binning
+
+        if out is None:
+            binned_shape = [-(-s//binning) for s in target_shape]
+            out = [np.zeros([s for i, s in enumerate(binned_shape) if i != axis], dtype=self.values.dtype) for axis in range(3)]
+
+        #// the points are in ascending order of intensity, so the last one written to a pixel is its maximum
+        for axis, projection in enumerate(out):
+            projection[...] = 0
+            rows, columns = [pixels[:, i] for i in range(3) if i != axis]
+            if not splat:
+                projection[rows, columns] = values
+                continue
+
+            #// written into a buffer padded by a pixel on each side, so that no index is out of bounds;
+            #// the 4 pixels of a point are written one after another, so the order is kept
+            width = projection.shape[1]+2
+            padded = np.zeros((projection.shape[0]+2, width), dtype=projection.dtype)
+            indices = (rows+1)*width+columns+1
+            padded.ravel()[(indices[:, None]+np.array([0, 1, width, width+1])).ravel()] = np.repeat(values, 4)
+            projection[...] = padded[1:-1, 1:-1]
+
+        return out
@@ -0,0 +1,291 @@
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple, Union
+
+import config
+import numpy as np
+
+from .file import File
+from .scratch import release_pages
+
+
+class ChunkedVolume(object):
+    def __init__(self, directory: str, shape: Tuple[int], dtype, chunk_size: int, cache_size: int=64):
+        """One level of a VolumePyramid: a volume stored as .npy chunks of chunk_size voxels per axis.
+
+        Indexing with slices reads only the chunks the box covers. The chunks are
+        memory-mapped, and the recently used ones are kept open, so reading slice
+        by slice through a chunk does not open it again.
+
+        Args:
+            directory (str): The directory of the chunk files.
+            shape (Tuple[int]): Shape of the volume.
+            dtype: Data type of the volume.
+            chunk_size (int): Voxels per axis of a chunk.
+            cache_size (int, optional): Number of chunks kept open. Defaults to 64.
+        """
+
+        super().__init__()
+        self.directory = directory
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def chunk_file(self, index: Tuple[int]):
+        return os.path.join(self.directory, '_'.join([str(i) for i in index])+'.npy')
+
+    def chunk(self, index: Tuple[int]) -> np.ndarray:
+        if index in self.__cache:
+            self.__cache.move_to_end(index)
+            return self.__cache[index]
+
+        chunk = np.load(self.chunk_file(index), mmap_mode='r')
+        self.__cache[index] = chunk
+        if len(self.__cache) > self.cache_size:
+            self.__cache.popitem(last=False)
+        return chunk
+
+    def box(self, key) -> Tuple[slice]:
+        """key (slices or integers, as in ndarray indexing without steps) as a slice for each axis."""
+
+        key = key if isinstance(key, tuple) else (key,)
+        key = key+(slice(None),)*(self.ndim-len(key))
+
+        box = []
+        for k, s in zip(key, self.shape):
+            if isinstance(k, slice):
+                start, stop, step = k.indices(s)
+                if step != 1:
+                    raise IndexError('Steps are not supported by ChunkedVolume.')
+                box.append(slice(start, max(start, stop)))
+            else:
+                k = int(k)+s if int(k) < 0 else int(k)
+                box.append(slice(k, k+1))
+        return tuple(box)
+
+    def __getitem__(self, key) -> np.ndarray:
+        box = self.box(key)
+        out = np.empty([b.stop-b.start for b in box], dtype=self.dtype)
+
+        C = self.chunk_size
+        ranges = [range(b.start//C, -(-b.stop//C)) for b in box]
+        for index in np.ndindex(*[len(r) for r in ranges]):
+            index = tuple([r[i] for r, i in zip(ranges, index)])
+            chunk_box = tuple([slice(max(b.start, i*C), min(b.stop, (i+1)*C)) for b, i in zip(box, index)])
+            out[tuple([slice(c.start-b.start, c.stop-b.start) for c, b in zip(chunk_box, box)])] = \
+                self.chunk(index)[tuple([slice(c.start-i*C, c.stop-i*C) for c, i in zip(chunk_box, index)])]
+
+        #// integer indices drop their axes
+        key = key if isinstance(key, tuple) else (key,)
+        return out[tuple([0 if not isinstance(k, slice) else slice(None) for k in key])]
+
+    def write_slab(self, start: int, slab: np.ndarray):
+        """Writes slab (chunk_size slices or the last ones) from slice start, which is a multiple of chunk_size."""
+
+        C = self.chunk_size
+        assert start % C == 0
+        for y in range(0, self.shape[1], C):
+            for x in range(0, self.shape[2], C):
+                np.save(self.chunk_file((start//C, y//C, x//C)), np.ascontiguousarray(slab[:, y:y+C, x:x+C]))
+
+def reduce_by_2(ndarray: np.ndarray, reduction: str) -> np.ndarray:
+    """2x2x2 block reduction ('mean', 'max' or 'subsample'); odd edges are padded by repeating the edge voxels."""
+
+    if reduction == 'subsample':
+        return ndarray[::2, ::2, ::2]
+
+    padded = np.pad(ndarray, [(0, s % 2) for s in ndarray.shape], mode='edge')
+    blocks = padded.reshape(padded.shape[0]//2, 2, padded.shape[1]//2, 2, padded.shape[2]//2, 2)
+    if reduction == 'max':
+        return blocks.max(axis=(1, 3, 5))
+    if reduction == 'mean':
+        mean = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+        return np.rint(mean).astype(ndarray.dtype) if np.issubdtype(ndarray.dtype, np.integer) else mean.astype(ndarray.dtype)
+    raise ValueError(f'Unknown reduction: {reduction}')
+
+class VolumePyramid(object):
+    def __init__(self, directory: str):
+        """A chunked on-disk volume with downsampled levels 1, 2, 4, 8, ... (the factors).
+
+        It is written once by build() and opened by open(); the signature of the source
+        tells whether the store is still valid. Level f holds the volume reduced by f per axis,
+        of shape ceil(s/f).
+
+        Args:
+            directory (str): The store directory, with pyramid.json and a directory for each level.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        with open(os.path.join(directory, 'pyramid.json'), 'r') as f:
+            info = json.load(f)
+
+        self.shape = tuple(info['shape'])
+        self.dtype = np.dtype(info['dtype'])
+        self.chunk_size = info['chunk_size']
+        self.factors = info['factors']
+        self.reduction = info['reduction']
+        self.signature = info['signature']
+        self.levels = {f: ChunkedVolume(os.path.join(directory, f'level_{f}'), self.level_shape(f), self.dtype, self.chunk_size) for f in self.factors}
+
+    @staticmethod
+    def open(directory: str, signature: str) -> Union['VolumePyramid', None]:
+        """The store in directory, or None if it is missing, incomplete or built from another source."""
+
+        if not os.path.isfile(os.path.join(directory, 'pyramid.json')):
+            return None
+        try:
+            pyramid = VolumePyramid(directory)
+        except (ValueError, KeyError):
+            return None
+        return pyramid if pyramid.signature == signature else None
+
+    @staticmethod
+    def build(directory: str, ndarray: np.ndarray, signature: str, reduction: str='mean', chunk_size: int=64, minimum_size: int=16, is_cancelled: Union[Callable, None]=None) -> Union['VolumePyramid', None]:
+        """Writes the store of ndarray into directory, slab by slab.
+
+        Level 1 is written from ndarray chunk_size slices at a time, and each coarser level
+        from the chunks of the level before it, so a memory-mapped ndarray is never resident
+        as a whole. pyramid.json is written last, so an interrupted build is not opened.
+
+        Args:
+            directory (str): The store directory. Its previous contents are removed.
+            ndarray (np.ndarray): The volume, e.g. memory-mapped.
+            signature (str): Identifies the source, checked by open().
+            reduction (str, optional): 'mean', 'max' (e.g. for masks) or 'subsample'. Defaults to 'mean'.
+            chunk_size (int, optional): Voxels per axis of a chunk. Defaults to 64.
+            minimum_size (int, optional): Levels are added until the volume fits in this size per axis. Defaults to 16.
+            is_cancelled (Union[Callable, None], optional): Polled between slabs; the build stops if it returns True. Defaults to None.
+
+        Returns:
+            Union[VolumePyramid, None]: The store, or None if cancelled.
+        """
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+        factors = [1]
+        while max([-(-s//factors[-1]) for s in ndarray.shape]) > minimum_size:
+            factors.append(factors[-1]*2)
+
+        source = ndarray
+        for f in factors:
+            shape = tuple([-(-s//f) for s in ndarray.shape])
+            level = ChunkedVolume(os.path.join(directory, f'level_{f}'), shape, ndarray.dtype, chunk_size)
+            os.makedirs(level.directory)
+
+            for start in range(0, shape[0], chunk_size):
+                if is_cancelled is not None and is_cancelled():
+                    shutil.rmtree(directory, ignore_errors=True)
+                    return None
+
+                if f == 1:
+                    slab = np.asarray(source[start:start+chunk_size])
+                else:
+                    slab = reduce_by_2(source[start*2:(start+chunk_size)*2], reduction)
+                level.write_slab(start, slab)
+                release_pages(ndarray)
+            source = level
+
+        info = {
+            'shape': list(ndarray.shape),
+            'dtype': np.dtype(ndarray.dtype).str,
+            'chunk_size': chunk_size,
+            'factors': factors,
+            'reduction': reduction,
+            'signature': signature,
+        }
+        with open(os.path.join(directory, 'pyramid.json'), 'w') as f:
+            json.dump(info, f, indent=1)
+
+        return VolumePyramid(directory)
+
+    def level_shape(self, factor: int) -> Tuple[int]:
+        return tuple([-(-s//factor) for s in self.shape])
+
+    def level(self, factor: int) -> ChunkedVolume:
+        return self.levels[factor]
+
+    def level_box(self, box: Union[Tuple[slice], None], factor: int) -> Tuple[slice]:
+        """box (in full resolution voxels; None is the whole volume) in the voxels of level factor, covering it."""
+
+        if box is None:
+            return tuple([slice(0, s) for s in self.level_shape(factor)])
+        return tuple([slice(b.start//factor, min(-(-b.stop//factor), s)) for b, s in zip(box, self.level_shape(factor))])
+
+    def level_for_budget(self, budget: int, box: Union[Tuple[slice], None]=None, bytes_per_voxel: int=1, minimum_factor: int=1) -> int:
+        """The finest level (at least minimum_factor) at which box takes at most budget bytes; the coarsest level if none does."""
+
+        for f in self.factors:
+            if f < minimum_factor:
+                continue
+            if int(np.prod([b.stop-b.start for b in self.level_box(box, f)]))*bytes_per_voxel <= budget:
+                return f
+        return self.factors[-1]
+
+def pyramid_jobs(file: File, ct: np.ndarray, trace=None, pet: Union[np.ndarray, None]=None) -> List[Tuple[str, str, np.ndarray, str, str]]:
+    """(name, directory, volume, signature, reduction) of the volumes of a sample to be kept as pyramids in [volume_name]_pyramid/.
+
+    Args:
+        file (File): The X-ray CT volume files.
+        ct (np.ndarray): The full resolution X-ray CT volume.
+        trace (optional): The drawn CT trace (TraceObject), if there is an rinfo file. Defaults to None.
+        pet (Union[np.ndarray, None], optional): The static PET volume; no pyramid is kept for the frames of a dynamic PET volume. Defaults to None.
+    """
+
+    directory = file.pyramid_directory
+    ct_signature = [file.source_signature(), list(ct.shape)]
+    jobs = [('ct', os.path.join(directory, 'ct'), ct, json.dumps(ct_signature), 'mean')]
+
+    if trace is not None and file.is_rinfo_file_available():
+        stat = os.stat(file.rinfo_file)
+        signature = json.dumps(ct_signature+[stat.st_size, stat.st_mtime_ns, trace.pen_size])
+        #// the max keeps thin traces visible at the coarse levels
+        jobs.append(('trace', os.path.join(directory, 'trace'), trace.volume[..., 1], signature, 'max'))
+
+    if pet is not None:
+        pet_file = File(volume_directory=file.pet_directory())
+        signature = json.dumps([pet_file.source_signature(), list(pet.shape), config.pet_clip_percentile])
+        jobs.append(('pet', os.path.join(directory, 'pet'), pet, signature, 'mean'))
+
+    return jobs
+
+def build_pyramids(jobs: List[Tuple[str, str, np.ndarray, str, str]], is_cancelled: Union[Callable, None]=None, progress: Union[Callable, None]=None) -> Union[Dict[str, VolumePyramid], None]:
+    """Opens the pyramids of jobs (see pyramid_jobs()), and builds those that are missing or outdated.
+
+    If a pyramid cannot be written (e.g. the disk is read-only or full), a warning is logged and
+    no pyramid is returned, so the volumes are used as they are.
+
+    Returns:
+        Union[Dict[str, VolumePyramid], None]: The pyramid of each name, or None if cancelled.
+    """
+
+    pyramids = {}
+    for i, (name, directory, ndarray, signature, reduction) in enumerate(jobs):
+        try:
+            pyramid = VolumePyramid.open(directory, signature)
+            if pyramid is None:
+                if progress is not None:
+                    progress(i, len(jobs), f'Building the {name} pyramid')
+                pyramid = VolumePyramid.build(
+                    directory, ndarray, signature, reduction=reduction,
+                    chunk_size=config.pyramid_chunk_size, is_cancelled=is_cancelled
+                )
+        except OSError as e:
+            logging.getLogger('build_pyramids').warning(f'[Pyramid not written] {directory}: {e}')
+            shutil.rmtree(directory, ignore_errors=True)
+            return {}
+        if pyramid is None:
+            return None
+        pyramids[name] = pyramid
+
+    return pyramids
@@ -0,0 +1,153 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple, Union
+
+import config
+import numpy as np
+from skimage import io
+
+from .file import File
+from .projection import PointProjector
+from .registration import root_points
+from .sample import Sample
+
+
+def find_registered_samples(path: str) -> List[str]:
+    """The sample directories with saved registration parameters, either path itself or its subdirectories."""
+
+    path = path.rstrip('/\\')
+    if os.path.isfile(File(volume_directory=path).registration_file):
+        return [path]
+
+    samples = []
+    for entry in sorted(os.scandir(path), key=lambda e: e.name) if os.path.isdir(path) else []:
+        if entry.is_dir() and os.path.isfile(File(volume_directory=entry.path).registration_file):
+            samples.append(entry.path)
+    return samples
+
+def streaming_projections(slices: Iterable[np.ndarray]) -> List[np.ndarray]:
+    """The maximum intensity projections along axes 0, 1 and 2, computed one slice at a time."""
+
+    top, side_x, side_y = None, [], []
+    for img in slices:
+        top = img.copy() if top is None else np.maximum(top, img, out=top)
+        side_x.append(img.max(axis=0))
+        side_y.append(img.max(axis=1))
+
+    return [top, np.array(side_x), np.array(side_y)]
+
+def bin_projection(projection: np.ndarray, binning: int) -> np.ndarray:
+    if binning == 1:
+        return projection
+
+    shape = [-(-s//binning)*binning for s in projection.shape]
+    padded = np.zeros(shape, dtype=projection.dtype)
+    padded[:projection.shape[0], :projection.shape[1]] = projection
+    return padded.reshape(shape[0]//binning, binning, shape[1]//binning, binning).max(axis=(1, 3))
+
+def to_uint8(projection: np.ndarray, percentile: float=0.5) -> np.ndarray:
+    low, high = np.percentile(projection, (percentile, 100.-percentile))
+    if high <= low:
+        return np.zeros(projection.shape, dtype=np.uint8)
+    return (np.clip((projection.astype(np.float32)-low)/(high-low), 0., 1.)*255).astype(np.uint8)
+
+def compose_overlay(ct: np.ndarray, trace: Union[np.ndarray, None], pet: Union[np.ndarray, None]) -> np.ndarray:
+    """CT in gray, the trace in blue and the PET in yellow, as in the MIP viewer."""
+
+    rgb = np.repeat(to_uint8(ct)[..., None], 3, axis=2)
+    if trace is not None:
+        rgb[trace] = (0, 160, 255)
+    if pet is not None:
+        np.maximum(rgb[..., 0], pet, out=rgb[..., 0])
+        np.maximum(rgb[..., 1], pet, out=rgb[..., 1])
+    return rgb
+
+def render_qc_snapshot(directory: str, dest: str='') -> str:
+    """Renders the orthogonal MIPs of the X-ray CT volume, the trace and the registered PET volume into a PNG image.
+
+    Only NumPy is used for the rendering, so that it runs without a display. The PET volume
+    is projected at the PET voxel size (binned X-ray CT voxels), which keeps the image compact.
+
+    Args:
+        directory (str): The X-ray CT volume directory with a saved registration file.
+        dest (str, optional): The PNG file. Defaults to [volume_name]_qc.png.
+
+    Returns:
+        str: The PNG file.
+    """
+
+    sample = Sample(directory)
+    if not sample.is_valid():
+        raise ValueError(f'Invalid volume: {directory}')
+    ct_resolution, pet_resolution, parameters = sample.load_registration()
+    scaling_factor = pet_resolution/ct_resolution
+    binning = max(1, int(round(scaling_factor)))
+
+    ct_mips = streaming_projections(sample.ct_slices())
+    ct_shape = (ct_mips[1].shape[0], ct_mips[0].shape[0], ct_mips[0].shape[1])
+    ct_mips = [bin_projection(mip, binning) for mip in ct_mips]
+
+    trace_mips = None
+    rinfo = sample.load_rinfo()
+    if rinfo is not None:
+        points = root_points(rinfo, max_points=np.iinfo(np.int64).max).astype(np.int64)
+        points = points[np.all((points >= 0) & (points < np.array(ct_shape)), axis=1)]//binning
+        trace_mips = [np.zeros(mip.shape, dtype=bool) for mip in ct_mips]
+        for axis, mip in enumerate(trace_mips):
+            mip[tuple([points[:, i] for i in range(3) if i != axis])] = True
+
+    pet_mips = None
+    pet = sample.load_pet()
+    if pet is not None:
+        rescaled_shape = [int(s*scaling_factor) for s in pet.shape]
+        projector = PointProjector(pet, rescaled_shape=rescaled_shape)
+        pet_mips = projector.project(parameters, ct_shape, shift_scale=config.skip_size, binning=binning)
+
+    panels = [compose_overlay(ct_mips[i], trace_mips[i] if trace_mips is not None else None, pet_mips[i] if pet_mips is not None else None) for i in range(3)]
+    height = max([p.shape[0] for p in panels])
+    image = np.concatenate([np.pad(p, ((0, height-p.shape[0]), (0, 4), (0, 0))) for p in panels], axis=1)
+
+    dest = dest if dest != '' else sample.file.qc_file
+    io.imsave(dest, image, check_contrast=False)
+    return dest
+
+def _render_qc_snapshot(args: Tuple[str, str]) -> Tuple[str, str, str]:
+    directory, dest = args
+    try:
+        return directory, render_qc_snapshot(directory, dest), ''
+    except Exception as e:
+        return directory, '', f'{e.__class__.__name__}: {e}'
+
+def batch_qc_snapshots(paths: List[str], output_directory: str='', processes: Union[int, None]=None) -> List[Tuple[str, str, str]]:
+    """Renders the QC snapshots of all registered samples found in paths, in a process pool.
+
+    Args:
+        paths (List[str]): Sample directories or directories containing them.
+        output_directory (str, optional): Where the PNG images are saved. Defaults to next to each sample.
+        processes (Union[int, None], optional): The number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        List[Tuple[str, str, str]]: The sample directory, the PNG file and the error message for each sample.
+    """
+
+    logger = logging.getLogger('batch_qc_snapshots')
+    directories = [d for path in paths for d in find_registered_samples(path)]
+    if len(directories) == 0:
+        logger.error('No sample with saved registration parameters was found.')
+        return []
+
+    if output_directory != '':
+        os.makedirs(output_directory, exist_ok=True)
+    jobs = [(d, os.path.join(output_directory, os.path.basename(d)+'_qc.png') if output_directory != '' else '') for d in directories]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for i, (directory, dest, error) in enumerate(executor.map(_render_qc_snapshot, jobs)):
+            if error != '':
+                logger.error(f'[QC failed] {directory}: {error}')
+            else:
+                logger.info(f'[QC saved] ({i+1}/{len(jobs)}) {dest}')
+            results.append((directory, dest, error))
+
+    return results
@@ -0,0 +1,200 @@
+import json
+import os
+import tempfile
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+from skimage import io
+
+from .scratch import allocate_volume, is_memory_mapped
+from .shared import shared_directory, shared_file_prefix
+from .volume import IntensityStatistics, convert_to_uint8
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def volume_file_extensions():
+    return ('.npy', '.raw', '.tif', '.tiff')
+
+def raw_header_file(raw_file: str):
+    return os.path.splitext(raw_file)[0]+'.json'
+
+def read_raw_header(raw_file: str):
+    """Reads the JSON header of a raw binary volume.
+
+    The header is stored next to the raw file with the '.json' extension, e.g.
+    {"shape": [z, y, x], "dtype": "<u2", "offset": 0}.
+    """
+
+    header_file = raw_header_file(raw_file)
+    with open(header_file, 'r') as f:
+        header = json.load(f)
+
+    if 'shape' not in header or 'dtype' not in header:
+        raise ValueError(f'"shape" and "dtype" are required in {header_file}')
+
+    return tuple(header['shape']), np.dtype(header['dtype']), int(header.get('offset', 0))
+
+def read_volume_file(volume_file: str, mmap: bool=True) -> np.ndarray:
+    """Opens a single-file volume.
+
+    Args:
+        volume_file (str): A .npy file, a raw binary file with a JSON header, or a multipage TIFF (BigTIFF) file.
+        mmap (bool, optional): If True, the volume is memory-mapped read-only where the format allows it. Defaults to True.
+
+    Returns:
+        np.ndarray: The volume data. Only the touched pages are read from the disk when it is memory-mapped.
+    """
+
+    ext = os.path.splitext(volume_file)[1].lower()
+    mmap_mode = 'r' if mmap else None
+
+    if ext == '.npy':
+        volume = np.load(volume_file, mmap_mode=mmap_mode)
+    elif ext == '.raw':
+        shape, dtype, offset = read_raw_header(volume_file)
+        if mmap:
+            volume = np.memmap(volume_file, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            volume = np.fromfile(volume_file, dtype=dtype, offset=offset, count=int(np.prod(shape))).reshape(shape)
+    elif ext in ('.tif', '.tiff'):
+        volume = None
+        if mmap and tifffile is not None:
+            try:
+                volume = tifffile.memmap(volume_file, mode='r')
+            except ValueError:
+                #// compressed or non-contiguous pages can not be memory-mapped
+                volume = None
+        if volume is None:
+            volume = io.imread(volume_file)
+    else:
+        raise ValueError(f'Unsupported volume file: {volume_file}')
+
+    if volume.ndim != 3:
+        raise ValueError(f'A 3D volume is required: {volume_file} {volume.shape}')
+
+    return volume
+
+def read_volume_shape(volume_file: str) -> Tuple[int]:
+    """Reads the shape of a single-file volume without reading the voxels."""
+
+    ext = os.path.splitext(volume_file)[1].lower()
+    if ext in ('.tif', '.tiff') and tifffile is not None:
+        with tifffile.TiffFile(volume_file) as tif:
+            return tuple(tif.series[0].shape)
+    if ext == '.raw':
+        return read_raw_header(volume_file)[0]
+
+    return read_volume_file(volume_file, mmap=True).shape
+
+def read_uint8_volume(source: Union[str, List[str]], clip_percentile: float=0., progress: Union[Callable, None]=None, slab_size: int=16) -> np.ndarray:
+    """Reads a volume and normalizes its intensity to 8 bit while streaming.
+
+    The intensity statistics are gathered slice by slice while the slices are decoded,
+    and the conversion is done in place (8-bit data) or slab by slab, so no floating
+    point copy of the whole volume is created.
+
+    Args:
+        source (Union[str, List[str]]): A single-file volume, or a list of slice image files.
+        clip_percentile (float, optional): Percentile clipped at each end of the intensity range. Defaults to 0.
+        progress (Union[Callable, None], optional): Called with (i, total, message) for each slice or slab. Defaults to None.
+        slab_size (int, optional): Number of slices converted at once. Defaults to 16.
+    """
+
+    statistics = IntensityStatistics(clip_percentile=clip_percentile)
+
+    if isinstance(source, str):
+        volume = read_volume_file(source)
+        total = len(volume)
+        for i in range(0, total, slab_size):
+            if progress is not None:
+                progress(i//slab_size, (total+slab_size-1)//slab_size, 'Intensity scanning')
+            statistics.update(np.asarray(volume[i:i+slab_size]))
+    else:
+        volume = None
+        for i, f in enumerate(source):
+            if progress is not None:
+                progress(i, len(source), 'File loading')
+            img = io.imread(f)
+            if volume is None:
+                volume = np.empty((len(source),)+img.shape, dtype=img.dtype)
+            volume[i] = img
+            statistics.update(img)
+
+    intensity_range = statistics.intensity_range()
+    if volume.dtype == np.uint8 and intensity_range[0] == 0 and intensity_range[1] == 255:
+        #// nothing to convert; a memory-mapped file is kept as it is, so only the touched pages are ever read
+        return volume
+
+    if volume.dtype == np.uint8 and volume.flags.writeable:
+        out = volume
+    else:
+        #// a memory-mapped file is converted into a scratch file, so that it is not made resident as a whole
+        out = allocate_volume(volume.shape, np.uint8, memory_mapped=is_memory_mapped(volume))
+    return convert_to_uint8(volume, intensity_range, out=out, slab_size=slab_size)
+
+def read_uint8_frames(sources: List[Union[str, List[str]]], clip_percentile: float=0., progress: Union[Callable, None]=None, slab_size: int=16) -> np.memmap:
+    """Reads the frames of a dynamic PET volume into a memory-mapped 4D 8-bit array.
+
+    All frames are normalized with one intensity range, so that the uptake stays comparable
+    between frames. Slice images are decoded once into a temporary memory-mapped file, and
+    the 8-bit frames are written to a temporary .npy file, which is removed by release_frames().
+    Worker processes map the frames from this file (see share_array()).
+
+    Args:
+        sources (List[Union[str, List[str]]]): A single-file volume or a list of slice image files for each frame.
+        clip_percentile (float, optional): Percentile clipped at each end of the intensity range. Defaults to 0.
+        progress (Union[Callable, None], optional): Called with (i, total, message) for each frame. Defaults to None.
+        slab_size (int, optional): Number of slices converted at once. Defaults to 16.
+
+    Returns:
+        np.memmap: The frames, of shape (frames, z, y, x).
+    """
+
+    statistics = IntensityStatistics(clip_percentile=clip_percentile)
+    volumes = []
+    for i, source in enumerate(sources):
+        if progress is not None:
+            progress(i, len(sources), 'Frame loading')
+
+        if isinstance(source, str):
+            volume = read_volume_file(source)
+        else:
+            volume = None
+            for j, f in enumerate(source):
+                img = io.imread(f)
+                if volume is None:
+                    volume = np.memmap(tempfile.TemporaryFile(), dtype=img.dtype, mode='w+', shape=(len(source),)+img.shape)
+                volume[j] = img
+
+        if len(volumes) != 0 and volume.shape != volumes[0].shape:
+            raise ValueError(f'All frames must have the same shape: {volumes[0].shape} {volume.shape}')
+        for j in range(0, len(volume), slab_size):
+            statistics.update(np.asarray(volume[j:j+slab_size]))
+        volumes.append(volume)
+
+    #// named as the shared buffers, so the file of a crashed process is removed by the next one (see remove_stale_buffers())
+    with tempfile.NamedTemporaryFile(prefix=shared_file_prefix(), suffix='.npy', dir=shared_directory(), delete=False) as f:
+        frames_file = f.name
+    frames = np.lib.format.open_memmap(frames_file, mode='w+', dtype=np.uint8, shape=(len(volumes),)+volumes[0].shape)
+    intensity_range = statistics.intensity_range()
+    for i, volume in enumerate(volumes):
+        if progress is not None:
+            progress(i, len(volumes), 'Frame converting')
+        convert_to_uint8(volume, intensity_range, out=frames[i], slab_size=slab_size)
+    frames.flush()
+
+    return frames
+
+def release_frames(frames: Union[np.memmap, None]):
+    """Removes the temporary file of frames read by read_uint8_frames(). frames must not be used afterwards."""
+
+    if frames is None or getattr(frames, 'filename', None) is None:
+        return
+    try:
+        os.remove(frames.filename)
+    except OSError:
+        pass
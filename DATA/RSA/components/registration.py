@@ -0,0 +1,494 @@
+import heapq
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Union
+
+import config
+import numpy as np
+from scipy import fft, ndimage
+from scipy.spatial import cKDTree
+
+from .rinfo import RSA_Vector
+from .scratch import release_pages
+from .shared import attach_array
+from .volume import Volume
+
+
+class RegistrationParameters(object):
+    def __init__(self, x: int=0, y: int=0, z: int=0, angle: int=0, x_flip: int=1, y_flip: int=1, z_flip: int=1):
+        """Registration parameters of the PET volume, in the same units as Registrator.
+
+        Args:
+            x (int, optional): Shift of X direction (axis 2) in display voxels. Defaults to 0.
+            y (int, optional): Shift of Y direction (axis 1) in display voxels. Defaults to 0.
+            z (int, optional): Shift of Z direction (axis 0) in display voxels. Defaults to 0.
+            angle (int, optional): Rotation angle in degrees about axis 0, i.e. in axes (1,2). Defaults to 0.
+            x_flip (int, optional): -1 if flipped on X axis, otherwise 1. Defaults to 1.
+            y_flip (int, optional): -1 if flipped on Y axis, otherwise 1. Defaults to 1.
+            z_flip (int, optional): -1 if flipped on Z axis, otherwise 1. Defaults to 1.
+        """
+
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.z = z
+        self.angle = angle
+        self.x_flip = x_flip
+        self.y_flip = y_flip
+        self.z_flip = z_flip
+
+    @classmethod
+    def from_registrator(cls, registrator):
+        return cls(**{k: getattr(registrator, k) for k in cls.keys()})
+
+    @classmethod
+    def from_dict(cls, dictionary: dict):
+        return cls(**{k: dictionary[k] for k in cls.keys() if k in dictionary})
+
+    @staticmethod
+    def keys():
+        return ('x', 'y', 'z', 'angle', 'x_flip', 'y_flip', 'z_flip')
+
+    def dictionary(self):
+        return {k: getattr(self, k) for k in self.keys()}
+
+    def __str__(self):
+        flips = ''.join([a for a, f in zip('XYZ', [self.x_flip, self.y_flip, self.z_flip]) if f == -1]) or '-'
+        return f'flip: {flips}, angle: {self.angle}, shift: ({self.x}, {self.y}, {self.z})'
+
+def placement_offset(target_shape: Tuple[int], source_shape: Tuple[int]):
+    """Offset of the source volume centered in the target volume, as VolumeExporter places it."""
+
+    offset = []
+    for t, s in zip(target_shape, source_shape):
+        difference = t-s
+        offset.append(difference//2 if difference >= 0 else -(-difference//2))
+    return np.array(offset, dtype=np.float64)
+
+class RegistrationTransform(object):
+    def __init__(self, parameters: RegistrationParameters, source_shape: Tuple[int], target_shape: Tuple[int], shift_scale: float=config.skip_size):
+        """Voxel coordinate mapping between the PET volume (source) and the X-ray CT volume (target).
+
+        The mapping is the one VolumeExporter applies: flip, shift, rotation in axes (1,2)
+        about the volume center, and centering into the target shape.
+
+        Args:
+            parameters (RegistrationParameters): Registration parameters.
+            source_shape (Tuple[int]): Shape of the PET volume.
+            target_shape (Tuple[int]): Shape of the X-ray CT volume.
+            shift_scale (float, optional): Voxels per unit of the shift parameters. Defaults to config.skip_size.
+        """
+
+        super().__init__()
+        self.parameters = parameters
+        self.source_shape = tuple(source_shape)
+        self.target_shape = tuple(target_shape)
+
+        self.flips = np.array([parameters.z_flip, parameters.y_flip, parameters.x_flip])
+        self.shift = np.array([parameters.z, parameters.y, parameters.x], dtype=np.float64)*shift_scale
+        self.center = (np.array(self.source_shape, dtype=np.float64)-1)/2
+        self.offset = placement_offset(self.target_shape, self.source_shape)
+
+        theta = np.deg2rad(parameters.angle)
+        c, s = np.cos(theta), np.sin(theta)
+        #// rotation of (axis 1, axis 2) coordinates, as scipy.ndimage.rotate(angle, axes=(1,2)) moves the contents
+        self.rotation = np.array([[c, -s], [s, c]])
+
+    def source_to_target(self, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        upper = np.array(self.source_shape)-1
+        flipped = np.where(self.flips == -1, upper-points, points)
+        shifted = flipped-self.shift
+        rotated = shifted.copy()
+        rotated[:, 1:] = (shifted[:, 1:]-self.center[1:]) @ self.rotation.T + self.center[1:]
+        return rotated+self.offset
+
+    def target_to_source(self, points: np.ndarray) -> np.ndarray:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        rotated = points-self.offset
+        shifted = rotated.copy()
+        shifted[:, 1:] = (rotated[:, 1:]-self.center[1:]) @ self.rotation + self.center[1:]
+        flipped = shifted+self.shift
+        upper = np.array(self.source_shape)-1
+        return np.where(self.flips == -1, upper-flipped, flipped)
+
+class RegistrationResampler(object):
+    def __init__(self, transform: RegistrationTransform, pet_shape: Tuple[int], voxel_scale: float=1., box: Union[Tuple[slice], None]=None):
+        """Resampling of the original PET volume onto a grid aligned with the X-ray CT volume.
+
+        The grid covers the X-ray CT volume with voxels voxel_scale times the X-ray CT voxel;
+        grid voxel j is centered at (j+0.5)*voxel_scale-0.5 in the X-ray CT voxel coordinates.
+        As the rotation is in axes (1,2), the source slice depends only on the grid slice and
+        the in-slice source coordinates only on the in-slice grid position, so one plane of
+        coordinates is computed here and shared by all slices (and by all frames).
+
+        Args:
+            transform (RegistrationTransform): The registration of the rescaled PET volume into the X-ray CT volume.
+            pet_shape (Tuple[int]): Shape of the original PET volume.
+            voxel_scale (float, optional): Grid voxel size in X-ray CT voxels. Defaults to 1.
+            box (Union[Tuple[slice], None], optional): Only this box of the X-ray CT volume is resampled. Defaults to None.
+        """
+
+        super().__init__()
+        self.voxel_scale = voxel_scale
+        self.grid_shape = tuple([max(1, int(round(s/voxel_scale))) for s in transform.target_shape])
+        if box is None:
+            self.box = tuple([slice(0, s) for s in self.grid_shape])
+        else:
+            self.box = tuple([slice(int(np.floor(b.start/voxel_scale)), min(int(np.ceil(b.stop/voxel_scale)), s)) for b, s in zip(box, self.grid_shape)])
+        self.shape = tuple([b.stop-b.start for b in self.box])
+
+        #// rescaled PET voxel -> original PET voxel
+        zoom = np.array(transform.source_shape, dtype=np.float64)/np.array(pet_shape)
+        centers = [(np.arange(b.start, b.stop)+0.5)*voxel_scale-0.5 for b in self.box]
+
+        slices = np.zeros((self.shape[0], 3))
+        slices[:, 0] = centers[0]
+        self.source_slices = (transform.target_to_source(slices)[:, 0]+0.5)/zoom[0]-0.5
+
+        plane = np.zeros((self.shape[1]*self.shape[2], 3))
+        plane[:, 1:] = np.stack(np.meshgrid(centers[1], centers[2], indexing='ij'), axis=-1).reshape(-1, 2)
+        self.source_plane = ((transform.target_to_source(plane)[:, 1:]+0.5)/zoom[1:]-0.5).T
+
+        #// the in-slice source region that the grid samples, including the voxels the interpolation reads; only it is read from the source
+        lower = np.floor(self.source_plane.min(axis=1)).astype(int) if self.source_plane.size != 0 else np.zeros(2, dtype=int)
+        upper = np.floor(self.source_plane.max(axis=1)).astype(int)+2 if self.source_plane.size != 0 else np.zeros(2, dtype=int)
+        self.source_box = tuple([slice(int(np.clip(l, 0, s)), int(np.clip(u, 0, s))) for l, u, s in zip(lower, upper, pet_shape[1:])])
+        self.source_plane -= np.array([b.start for b in self.source_box], dtype=np.float64)[:, None]
+
+        self.pet_shape = tuple(pet_shape)
+
+    def resample(self, ndarray: np.ndarray, out: Union[np.ndarray, None]=None, progress=None, start: int=0, stop: Union[int, None]=None) -> np.ndarray:
+        """Trilinear resampling of ndarray (of pet_shape) into out (of shape), slice by slice.
+
+        Each output slice reads only the two source slices around it, within source_box, so a
+        z-slab of the output (start to stop) needs only the source region it covers plus that halo.
+
+        Args:
+            ndarray (np.ndarray): The original PET volume, e.g. a memory-mapped frame or a ChunkedVolume.
+            out (Union[np.ndarray, None], optional): The output slices start to stop. Defaults to a new array of the dtype of ndarray.
+            progress (optional): Called with (i, total, message) for each slice. Defaults to None.
+            start (int, optional): The first output slice. Defaults to 0.
+            stop (Union[int, None], optional): The end of the output slices. Defaults to all slices.
+        """
+
+        assert ndarray.shape == self.pet_shape
+        stop = self.shape[0] if stop is None else stop
+        if out is None:
+            out = np.zeros((stop-start,)+self.shape[1:], dtype=ndarray.dtype)
+
+        coordinates = np.empty((3, self.source_plane.shape[1]))
+        coordinates[1:] = self.source_plane
+        for i, z in enumerate(self.source_slices[start:stop]):
+            if progress is not None:
+                progress(i, stop-start, 'Resampling the volume')
+            if z <= -1 or z >= ndarray.shape[0] or any([b.stop <= b.start for b in self.source_box]):
+                out[i] = 0
+                continue
+
+            #// only the two source slices around z are read
+            z0 = int(np.clip(np.floor(z), 0, ndarray.shape[0]-2)) if ndarray.shape[0] > 1 else 0
+            slab = np.asarray(ndarray[(slice(z0, z0+2),)+self.source_box])
+            coordinates[0] = z-z0
+            out[i] = ndimage.map_coordinates(slab, coordinates, order=1, mode='constant', cval=0.).reshape(self.shape[1:])
+
+        return out
+
+class AlignmentScore(object):
+    def __init__(self, pet: np.ndarray, reference: np.ndarray, is_mask: bool, shift_scale: float=1., threshold_ratio: float=0.1, max_points: int=50000):
+        """A numeric alignment score of the PET volume against the X-ray CT volume or the trace.
+
+        PET voxels are sampled once, and each score() call maps only these samples into the
+        reference, so a score costs a few milliseconds whatever the volume size.
+
+        Args:
+            pet (np.ndarray): The (low resolution) PET volume.
+            reference (np.ndarray): The (low resolution) X-ray CT volume or trace mask, at the same scale as pet.
+            is_mask (bool): If True, the score is the fraction of the PET signal falling on the mask. Otherwise, it is the normalized cross-correlation of the PET and reference intensities.
+            shift_scale (float, optional): Voxels of these volumes per unit of the shift parameters. Defaults to 1.
+            threshold_ratio (float, optional): PET voxels below this ratio of the maximum are ignored for the mask score. Defaults to 0.1.
+            max_points (int, optional): Maximum number of PET samples. Defaults to 50000.
+        """
+
+        super().__init__()
+        self.source_shape = pet.shape
+        self.target_shape = reference.shape
+        self.reference = reference
+        self.is_mask = is_mask
+        self.shift_scale = shift_scale
+
+        if is_mask:
+            points = np.argwhere(pet > pet.max()*threshold_ratio)
+        else:
+            stride = max(1, int(np.ceil((pet.size/max_points)**(1/3))))
+            points = np.argwhere(np.ones_like(pet[::stride, ::stride, ::stride], dtype=bool))*stride
+        if len(points) > max_points:
+            points = points[np.linspace(0, len(points)-1, max_points).astype(int)]
+
+        self.points = points
+        self.weights = pet[tuple(points.T)].astype(np.float64)
+
+    def score(self, parameters: RegistrationParameters) -> float:
+        transform = RegistrationTransform(parameters, self.source_shape, self.target_shape, shift_scale=self.shift_scale)
+        mapped = np.rint(transform.source_to_target(self.points)).astype(np.int64)
+        inside = np.all((mapped >= 0) & (mapped < np.array(self.target_shape)), axis=1)
+
+        values = np.zeros(len(mapped), dtype=np.float64)
+        values[inside] = self.reference[tuple(mapped[inside].T)]
+
+        if self.is_mask:
+            total = self.weights.sum()
+            return float(self.weights[values > 0].sum()/total) if total > 0 else 0.
+
+        weights = self.weights-self.weights.mean()
+        values -= values.mean()
+        norm = np.linalg.norm(weights)*np.linalg.norm(values)
+        return float(np.dot(weights, values)/norm) if norm > 0 else 0.
+
+def downsample(ndarray: np.ndarray, factor: int) -> np.ndarray:
+    """Block-mean downsampling, computed slab by slab into a float32 array."""
+
+    shape = [s//factor for s in ndarray.shape]
+    out = np.empty(shape, dtype=np.float32)
+    for i in range(shape[0]):
+        slab = np.asarray(ndarray[i*factor:(i+1)*factor, :shape[1]*factor, :shape[2]*factor], dtype=np.float32)
+        out[i] = slab.reshape(factor, shape[1], factor, shape[2], factor).mean(axis=(0, 2, 4))
+        release_pages(ndarray)
+    return out
+
+def place_centered(ndarray: np.ndarray, target_shape: Tuple[int]) -> np.ndarray:
+    """Centers ndarray into a zero volume of target_shape, cropping if needed, as VolumeExporter does."""
+
+    placed = np.zeros(target_shape, dtype=ndarray.dtype)
+    offset = placement_offset(target_shape, ndarray.shape).astype(int)
+    target_slices = tuple([slice(max(o, 0), min(o+s, t)) for o, s, t in zip(offset, ndarray.shape, target_shape)])
+    source_slices = tuple([slice(max(-o, 0), max(-o, 0)+(ts.stop-ts.start)) for o, ts in zip(offset, target_slices)])
+    placed[target_slices] = ndarray[source_slices]
+    return placed
+
+#// coarse volumes shared by the search workers; set once per worker by the initializer
+_search_volumes = {}
+
+def _init_search_worker(reference_handle: tuple, moving_handle: tuple):
+    reference = attach_array(reference_handle)
+    reference = reference-reference.mean()
+    fft_shape = [fft.next_fast_len(2*s-1, real=True) for s in reference.shape]
+    _search_volumes['reference_fft'] = fft.rfftn(reference, fft_shape)
+    _search_volumes['reference_norm'] = np.linalg.norm(reference)
+    _search_volumes['fft_shape'] = fft_shape
+    _search_volumes['reference_shape'] = reference.shape
+    _search_volumes['moving'] = attach_array(moving_handle)
+
+def _evaluate_candidate(candidate: Tuple[Tuple[int], int]):
+    (z_flip, y_flip, x_flip), angle = candidate
+    moving = _search_volumes['moving'][::z_flip, ::y_flip, ::x_flip]
+    moving = ndimage.rotate(moving, angle, axes=(1,2), reshape=False, order=1)
+    moving = place_centered(moving, _search_volumes['reference_shape'])
+    moving -= moving.mean()
+
+    moving_norm = np.linalg.norm(moving)
+    if moving_norm == 0 or _search_volumes['reference_norm'] == 0:
+        return 0., candidate, (0, 0, 0)
+
+    fft_shape = _search_volumes['fft_shape']
+    correlation = fft.irfftn(_search_volumes['reference_fft']*np.conj(fft.rfftn(moving, fft_shape)), fft_shape)
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    score = correlation[peak]/(moving_norm*_search_volumes['reference_norm'])
+
+    #// circular index to signed shift of the moving volume
+    shift = tuple([int(p) if p <= s//2 else int(p-s) for p, s in zip(peak, fft_shape)])
+    return float(score), candidate, shift
+
+def _canonical_candidate(candidate: Tuple[Tuple[int], int]) -> Tuple[Tuple[int], int]:
+    """The same pose without the Y flip: flipping Y and X together is a rotation by 180 degrees, so a Y flip is an X flip rotated by 180 degrees."""
+
+    (z_flip, y_flip, x_flip), angle = candidate
+    if y_flip == -1:
+        return (z_flip, 1, -x_flip), (angle+180) % 360
+    return candidate
+
+def search_flip_rotation(reference: np.ndarray, moving: np.ndarray, angle_step: int=10, top_k: int=5, coarse_size: int=64, processes: Union[int, None]=None, shift_scale: float=config.skip_size) -> List[Tuple[float, RegistrationParameters]]:
+    """Exhaustive search over the 8 flip states and a grid of rotation angles.
+
+    Both volumes are block-mean downsampled so that the reference fits in coarse_size
+    voxels per axis. For each candidate, the best translation is found by FFT
+    cross-correlation. Candidates are evaluated in a process pool. Candidates that are
+    the same pose (see _canonical_candidate()) are evaluated once, which halves them when
+    angle_step divides 180, and so the top candidates are distinct poses.
+
+    Args:
+        reference (np.ndarray): The X-ray CT volume or the trace volume.
+        moving (np.ndarray): The rescaled PET volume.
+        angle_step (int, optional): Step of the rotation angle grid in degrees. Defaults to 10.
+        top_k (int, optional): Number of candidates returned. Defaults to 5.
+        coarse_size (int, optional): Size of the downsampled reference per axis. Defaults to 64.
+        processes (Union[int, None], optional): Number of worker processes. Defaults to None (number of CPUs).
+        shift_scale (float, optional): Voxels per unit of the shift parameters. Defaults to config.skip_size.
+
+    Returns:
+        List[Tuple[float, RegistrationParameters]]: Scores (normalized cross-correlation) and parameters, best first.
+    """
+
+    logger = logging.getLogger('search_flip_rotation')
+
+    factor = max(1, int(np.ceil(max(reference.shape)/coarse_size)))
+    reference_coarse = downsample(reference, factor)
+    moving_coarse = downsample(moving, factor)
+    logger.debug(f'Coarse volumes: {reference_coarse.shape}, {moving_coarse.shape} (factor {factor})')
+
+    candidates = sorted(set([_canonical_candidate((flips, angle)) for flips in itertools.product((1, -1), repeat=3) for angle in range(0, 360, angle_step)]))
+    #// the workers map the coarse volumes instead of receiving a pickled copy each
+    volumes = [Volume(), Volume()]
+    volumes[0].init_from_volume(reference_coarse)
+    volumes[1].init_from_volume(moving_coarse)
+    try:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_search_worker, initargs=tuple([v.shared_handle() for v in volumes])) as executor:
+            results = list(executor.map(_evaluate_candidate, candidates, chunksize=4))
+    finally:
+        for v in volumes:
+            v.clear()
+
+    best = []
+    for score, ((z_flip, y_flip, x_flip), angle), shift in heapq.nlargest(top_k, results, key=lambda r: r[0]):
+        #// the search moves the rotated volume, whereas the exporter shifts before rotating
+        theta = np.deg2rad(angle)
+        c, s = np.cos(theta), np.sin(theta)
+        rotation = np.array([[c, -s], [s, c]])
+        shift_full = np.array(shift, dtype=np.float64)*factor
+        t_yx = -rotation.T @ shift_full[1:]
+        t = np.array([-shift_full[0], t_yx[0], t_yx[1]])/shift_scale
+
+        parameters = RegistrationParameters(
+            x=int(round(t[2])), y=int(round(t[1])), z=int(round(t[0])), angle=angle,
+            x_flip=x_flip, y_flip=y_flip, z_flip=z_flip
+        )
+        best.append((score, parameters))
+
+    return best
+
+def pet_hotspots(ndarray: np.ndarray, zoom: Tuple[float]=(1., 1., 1.), threshold_ratio: float=0.3, max_points: int=2000) -> np.ndarray:
+    """Local maxima of the PET volume above threshold_ratio of its maximum.
+
+    Args:
+        ndarray (np.ndarray): The PET volume.
+        zoom (Tuple[float], optional): Ratio of the rescaled PET shape to the shape of ndarray. The points are returned in the rescaled voxel coordinates. Defaults to (1., 1., 1.).
+        threshold_ratio (float, optional): Threshold relative to the maximum intensity. Defaults to 0.3.
+        max_points (int, optional): Only the brightest points are kept. Defaults to 2000.
+
+    Returns:
+        np.ndarray: (N, 3) voxel coordinates.
+    """
+
+    threshold = ndarray.max()*threshold_ratio
+    maxima = (ndimage.maximum_filter(ndarray, size=3) == ndarray) & (ndarray > threshold)
+    points = np.argwhere(maxima)
+    if len(points) > max_points:
+        values = ndarray[tuple(points.T)]
+        points = points[np.argsort(values)[::-1][:max_points]]
+
+    #// voxel centers of the original grid in the rescaled grid
+    return (points+0.5)*np.array(zoom)-0.5
+
+def root_points(rinfo: RSA_Vector, max_points: int=20000) -> np.ndarray:
+    """Voxel coordinates on the completed polylines of all roots."""
+
+    polylines = [root_node.completed_polyline() for base_node in rinfo for root_node in base_node]
+    polylines = [np.array(polyline).reshape(-1, 3) for polyline in polylines if len(polyline) != 0]
+    if len(polylines) == 0:
+        return np.zeros((0, 3))
+
+    points = np.unique(np.concatenate(polylines), axis=0)
+    if len(points) > max_points:
+        points = points[np.linspace(0, len(points)-1, max_points).astype(int)]
+    return points.astype(np.float64)
+
+def _rotation_about_axis0(theta: float, points: np.ndarray):
+    c, s = np.cos(theta), np.sin(theta)
+    rotated = points.copy()
+    rotated[:, 1] = c*points[:, 1]-s*points[:, 2]
+    rotated[:, 2] = s*points[:, 1]+c*points[:, 2]
+    return rotated
+
+def _icp(source: np.ndarray, tree: cKDTree, target: np.ndarray, theta: float, iterations: int, inlier_ratio: float, eps: float=0.):
+    translation = target.mean(axis=0)-_rotation_about_axis0(theta, source).mean(axis=0)
+    cost = np.inf
+    for _ in range(iterations):
+        distances, indices = tree.query(_rotation_about_axis0(theta, source)+translation, eps=eps)
+        inliers = distances <= np.quantile(distances, inlier_ratio)
+        u, r = source[inliers], target[indices[inliers]]
+
+        #// 2D Procrustes in axes (1,2); axis 0 is only translated
+        u_c, r_c = u-u.mean(axis=0), r-r.mean(axis=0)
+        theta = np.arctan2(
+            np.sum(r_c[:, 2]*u_c[:, 1]-r_c[:, 1]*u_c[:, 2]), 
+            np.sum(r_c[:, 1]*u_c[:, 1]+r_c[:, 2]*u_c[:, 2])
+        )
+        translation = r.mean(axis=0)-_rotation_about_axis0(theta, u).mean(axis=0)
+
+        previous_cost, cost = cost, distances[inliers].mean()
+        if previous_cost-cost < 1e-3:
+            break
+
+    return cost, theta, translation
+
+def fit_points(source_points: np.ndarray, target_points: np.ndarray, source_shape: Tuple[int], target_shape: Tuple[int], initial: RegistrationParameters, search_flips: bool=False, angle_step: int=30, iterations: int=50, screening_iterations: int=5, inlier_ratio: float=0.8, shift_scale: float=config.skip_size) -> Tuple[float, RegistrationParameters]:
+    """Aligns PET points to X-ray CT points with a multi-start trimmed ICP.
+
+    The ICP is started from the current angle and every angle_step degrees, each start
+    with the centroids aligned. Each start is run for a few iterations, and the one with
+    the lowest residual is refined. The nearest neighbors are found with a KD-tree of the
+    target points.
+
+    Args:
+        source_points (np.ndarray): (N, 3) points in the rescaled PET voxel coordinates, e.g. from pet_hotspots().
+        target_points (np.ndarray): (M, 3) points in the X-ray CT voxel coordinates, e.g. from root_points().
+        source_shape (Tuple[int]): Shape of the rescaled PET volume.
+        target_shape (Tuple[int]): Shape of the X-ray CT volume.
+        initial (RegistrationParameters): Current parameters. Their flip states are kept unless search_flips is True.
+        search_flips (bool, optional): If True, all 8 flip states are tried. Defaults to False.
+        angle_step (int, optional): Step of the start angles in degrees. Defaults to 30.
+        iterations (int, optional): Maximum number of iterations of the best start. Defaults to 50.
+        screening_iterations (int, optional): Number of iterations of each start. Defaults to 5.
+        inlier_ratio (float, optional): Ratio of the closest pairs used in each iteration. Defaults to 0.8.
+        shift_scale (float, optional): Voxels per unit of the shift parameters. Defaults to config.skip_size.
+
+    Returns:
+        Tuple[float, RegistrationParameters]: Mean distance of the inlier pairs in voxels, and the parameters.
+    """
+
+    source_points = np.asarray(source_points, dtype=np.float64).reshape(-1, 3)
+    target_points = np.asarray(target_points, dtype=np.float64).reshape(-1, 3)
+    tree = cKDTree(target_points)
+
+    center = (np.array(source_shape, dtype=np.float64)-1)/2
+    offset = placement_offset(target_shape, source_shape)
+    upper = np.array(source_shape)-1
+
+    if search_flips:
+        flip_states = list(itertools.product((1, -1), repeat=3))
+    else:
+        flip_states = [(initial.z_flip, initial.y_flip, initial.x_flip)]
+    start_angles = sorted(set([initial.angle % 360]+list(range(0, 360, angle_step))))
+
+    #// every start is screened with a few iterations, then only the best one is refined
+    starts = []
+    for flips in flip_states:
+        flipped = np.where(np.array(flips) == -1, upper-source_points, source_points)
+        u = flipped-center
+        for angle in start_angles:
+            #// approximate neighbors are enough while screening and much faster for far away points
+            cost, theta, _ = _icp(u, tree, target_points, np.deg2rad(angle), screening_iterations, inlier_ratio, eps=2.)
+            starts.append((cost, flips, theta, u))
+
+    _, flips, theta, u = min(starts, key=lambda start: start[0])
+    cost, theta, translation = _icp(u, tree, target_points, theta, iterations, inlier_ratio)
+    z_flip, y_flip, x_flip = flips
+
+    #// translation = center + offset - rotation(shift) in RegistrationTransform terms
+    shift = _rotation_about_axis0(-theta, (center+offset-translation).reshape(1, 3))[0]/shift_scale
+    parameters = RegistrationParameters(
+        x=int(round(shift[2])), y=int(round(shift[1])), z=int(round(shift[0])), angle=int(round(np.rad2deg(theta))) % 360,
+        x_flip=x_flip, y_flip=y_flip, z_flip=z_flip
+    )
+    return float(cost), parameters
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 from typing import Generator, Iterator, List, Union
@@ -6,6 +7,10 @@ import config
 import numpy as np
 
 
+def rinfo_hash(rinfo_dict: dict) -> str:
+    """A hash of the rinfo content, independent of the formatting of the file."""
+    return hashlib.sha1(json.dumps(rinfo_dict, sort_keys=True).encode()).hexdigest()
+
 class ID_Object(str):
     def __new__(cls, key: Union[str, list, tuple]):
         def __raise_exception():
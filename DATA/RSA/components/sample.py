@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+from typing import Iterator, Tuple, Union
+
+import config
+import numpy as np
+from skimage import io
+
+from .file import File
+from .reader import (read_uint8_frames, read_uint8_volume, read_volume_file,
+                     release_frames)
+from .registration import RegistrationParameters
+from .rinfo import RSA_Vector
+from .scratch import allocate_volume, release_pages
+
+
+def save_registration(fname: str, ct_resolution: float, pet_resolution: float, parameters: RegistrationParameters):
+    registration = {
+        'version': config.version_string(),
+        'skip_size': config.skip_size,
+        'ct_resolution': ct_resolution,
+        'pet_resolution': pet_resolution,
+        'parameters': parameters.dictionary(),
+    }
+    with open(fname, 'w') as f:
+        json.dump(registration, f, indent=1)
+
+def load_registration(fname: str) -> Tuple[float, float, RegistrationParameters]:
+    with open(fname, 'r') as f:
+        registration = json.load(f)
+
+    parameters = RegistrationParameters.from_dict(registration['parameters'])
+    #// shifts are stored in display voxels of the skip size used when they were saved
+    skip_size = registration.get('skip_size', config.skip_size)
+    if skip_size != config.skip_size:
+        for k in ('x', 'y', 'z'):
+            setattr(parameters, k, int(round(getattr(parameters, k)*skip_size/config.skip_size)))
+
+    return registration['ct_resolution'], registration['pet_resolution'], parameters
+
+class Sample(object):
+    def __init__(self, directory: str):
+        """Loading of a sample directory without the GUI.
+
+        Args:
+            directory (str): The X-ray CT volume directory. The PET directory, rinfo file and registration file are found by File.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.file = File(volume_directory=directory)
+        self.pet_file = File(volume_directory=self.file.pet_directory()) if os.path.isdir(self.file.pet_directory()) else None
+
+    def is_valid(self):
+        return self.file.is_valid()
+
+    def ct_slices(self) -> Iterator[np.ndarray]:
+        """Yields the X-ray CT slices one by one, so that the whole volume need not be in memory."""
+
+        if self.file.is_single_file():
+            volume = read_volume_file(self.file.volume_file())
+            for img in volume:
+                yield np.asarray(img)
+        else:
+            for f in self.file.img_files:
+                yield io.imread(f)
+
+    def load_ct(self) -> np.ndarray:
+        if self.file.is_single_file():
+            return read_volume_file(self.file.volume_file())
+
+        volume = None
+        for i, img in enumerate(self.ct_slices()):
+            if volume is None:
+                #// a scratch file in the out-of-core mode
+                volume = allocate_volume((len(self.file.img_files),)+img.shape, img.dtype)
+            volume[i] = img
+        release_pages(volume)
+        return volume
+
+    def load_pet(self) -> Union[np.ndarray, None]:
+        """The PET volume, or the maximum over the frames of a dynamic PET volume."""
+
+        frame_directories = self.file.pet_frame_directories()
+        if len(frame_directories) != 0:
+            frame_files = [File(volume_directory=d) for d in frame_directories]
+            if not all([f.is_valid() for f in frame_files]):
+                return None
+
+            frames = read_uint8_frames([f.volume_source() for f in frame_files], clip_percentile=config.pet_clip_percentile)
+            volume = np.array(frames[0])
+            for frame in frames[1:]:
+                np.maximum(volume, frame, out=volume)
+            release_frames(frames)
+            return volume
+
+        if self.pet_file is None or not self.pet_file.is_valid():
+            return None
+
+        return read_uint8_volume(self.pet_file.volume_source(), clip_percentile=config.pet_clip_percentile)
+
+    def load_rinfo(self) -> Union[RSA_Vector, None]:
+        if not self.file.is_rinfo_file_available():
+            return None
+
+        with open(self.file.rinfo_file, 'r') as f:
+            rinfo_dict = json.load(f)
+
+        rinfo = RSA_Vector()
+        if not rinfo.load_from_dict(rinfo_dict, file=self.file.rinfo_file):
+            return None
+        return rinfo
+
+    def is_registration_available(self):
+        return os.path.isfile(self.file.registration_file)
+
+    def load_registration(self):
+        return load_registration(self.file.registration_file)
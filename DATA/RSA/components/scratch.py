@@ -0,0 +1,62 @@
+import mmap
+import tempfile
+from typing import Tuple
+
+import config
+import numpy as np
+
+
+def memory_limit() -> int:
+    """The resident memory ceiling in bytes, or 0 if the out-of-core mode is off."""
+    return int(config.memory_limit_mb*1024*1024)
+
+def is_out_of_core() -> bool:
+    return memory_limit() > 0
+
+def allocate_volume(shape: Tuple[int], dtype, memory_mapped: bool=False) -> np.ndarray:
+    """A zero-filled array; in the out-of-core mode (or if memory_mapped), it is memory-mapped on a scratch file that is removed once it is released."""
+
+    if not is_out_of_core() and not memory_mapped:
+        return np.zeros(shape, dtype=dtype)
+
+    scratch_file = tempfile.TemporaryFile(dir=config.scratch_directory if config.scratch_directory != '' else None)
+    return np.memmap(scratch_file, dtype=dtype, mode='w+', shape=tuple(shape))
+
+def slab_size(shape: Tuple[int], dtype, buffers: int=1, default: int=16) -> int:
+    """Slices per z-slab, so that the given number of slab-sized buffers take at most a quarter of the ceiling.
+
+    The rest of the ceiling is left to the display copies and the PET volume. Without a ceiling, default is returned.
+    """
+
+    if not is_out_of_core():
+        return default
+
+    slice_bytes = int(np.prod(shape[1:]))*np.dtype(dtype).itemsize*buffers
+    return max(1, memory_limit()//4//max(1, slice_bytes))
+
+def is_memory_mapped(ndarray: np.ndarray) -> bool:
+    return isinstance(ndarray, np.memmap) and getattr(ndarray, '_mmap', None) is not None
+
+def release_pages(ndarray: np.ndarray):
+    """Writes back the dirty pages of a memory-mapped array and drops all its pages from the resident memory.
+
+    Only the out-of-core mode does this; the pages stay in the page cache, so reading them again is cheap.
+    """
+
+    if not is_out_of_core() or not is_memory_mapped(ndarray) or ndarray.mode == 'c':
+        return
+
+    ndarray._mmap.flush()
+    #// mmap.madvise is available from Python 3.8
+    if hasattr(ndarray._mmap, 'madvise'):
+        ndarray._mmap.madvise(mmap.MADV_DONTNEED)
+
+def downsampled_copy(ndarray: np.ndarray, step: int) -> np.ndarray:
+    """ndarray[::step, ::step, ::step] in memory, copied slab by slab so that a memory-mapped array is never resident as a whole."""
+
+    out = np.empty([-(-s//step) for s in ndarray.shape[:3]]+list(ndarray.shape[3:]), dtype=ndarray.dtype)
+    size = slab_size(ndarray.shape, ndarray.dtype, buffers=step)
+    for i in range(0, len(out), size):
+        out[i:i+size] = ndarray[i*step:(i+size)*step:step, ::step, ::step]
+        release_pages(ndarray)
+    return out
@@ -0,0 +1,79 @@
+import json
+import logging
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import config
+
+from .jobs import JobEngine
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """The HTTP/JSON interface of a JobEngine (server.engine).
+
+    - POST /jobs with a job (see JobEngine) queues it: 202 and the job, or 400 and the error
+    - GET /jobs lists the jobs, GET /jobs/[id] returns one
+    - GET /status returns the number of jobs by status and of the cached samples
+    """
+
+    def do_GET(self):
+        engine = self.server.engine
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/status':
+            self.send_json(200, engine.status())
+        elif path == '/jobs':
+            self.send_json(200, {'jobs': engine.list_jobs()})
+        elif path.startswith('/jobs/'):
+            job = engine.job(path[len('/jobs/'):])
+            self.send_json(200, job) if job is not None else self.send_json(404, {'error': f'No such job: {path}'})
+        else:
+            self.send_json(404, {'error': f'Unknown path: {path}'})
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path != '/jobs':
+            self.send_json(404, {'error': f'Unknown path: {path}'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+            job = self.server.engine.submit(request)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, job)
+
+    def send_json(self, code: int, body):
+        content = json.dumps(body, indent=1).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.getLogger(self.__class__.__name__).debug(format % args)
+
+class JobServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, engine: JobEngine):
+        """An HTTP server of engine; each request is answered in its own thread, the jobs run in the pool of engine."""
+
+        super().__init__(address, JobRequestHandler)
+        self.engine = engine
+
+def serve_jobs(port: int, host: str='127.0.0.1', workers: int=2):
+    """Runs the service mode until interrupted: jobs posted to http://host:port/jobs run without the GUI."""
+
+    logger = logging.getLogger('serve_jobs')
+    engine = JobEngine(workers=workers, cache_mb=config.sample_cache_mb)
+    server = JobServer((host, port), engine)
+    logger.info(f'[Serving] http://{host}:{server.server_address[1]}/ ({workers} workers)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.shutdown()
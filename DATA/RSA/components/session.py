@@ -0,0 +1,92 @@
+import logging
+import os
+from typing import List, Tuple
+
+import numpy as np
+from skimage import io
+
+from .file import File, natural_sort_key
+from .reader import read_volume_shape
+
+#// directories written next to a sample directory; they are not samples themselves
+derived_suffixes = ('_PET', '_PET_registrated', '_trace', '_pyramid', '_checkpoint')
+
+def find_samples(path: str) -> List[str]:
+    """The X-ray CT volume directories in path, without the PET, export, trace and pyramid directories of the samples."""
+
+    path = path.rstrip('/\\')
+    with os.scandir(path) as it:
+        entries = sorted([entry for entry in it if entry.is_dir()], key=lambda e: natural_sort_key(e.name))
+    names = set([entry.name for entry in entries])
+
+    samples = []
+    for entry in entries:
+        if any([entry.name.endswith(s) and entry.name[:-len(s)] in names for s in derived_suffixes]):
+            continue
+        if File(volume_directory=entry.path).is_valid():
+            samples.append(entry.path)
+    return samples
+
+def volume_shape(volume_file: File) -> Tuple[Tuple[int], int]:
+    """The shape of a volume and the bytes per voxel of its slice images (0 for a single-file volume), read from the header or the first slice only."""
+
+    if volume_file.is_single_file():
+        return tuple(read_volume_shape(volume_file.volume_file())), 0
+    img = io.imread(volume_file.img_files[0])
+    return (len(volume_file.img_files),)+img.shape, img.dtype.itemsize
+
+def volume_voxels(volume_file: File) -> Tuple[int, int]:
+    """The number of voxels of a volume and the bytes per voxel of its slice images (0 for a single-file volume)."""
+
+    shape, itemsize = volume_shape(volume_file)
+    return int(np.prod(shape)), itemsize
+
+def estimate_sample_nbytes(directory: str) -> int:
+    """Bytes a loaded sample holds in the sample cache, estimated from the volume headers or first slices.
+
+    A single-file X-ray CT volume is memory-mapped read-only and not counted; the slice images
+    of the X-ray CT volume, the CT trace (RGBA, if there is an rinfo file) and the 8-bit PET
+    volume or frames are.
+    """
+
+    volume_file = File(volume_directory=directory)
+    voxels, itemsize = volume_voxels(volume_file)
+    nbytes = voxels*itemsize
+    if volume_file.is_rinfo_file_available():
+        nbytes += voxels*4
+
+    frame_directories = volume_file.pet_frame_directories()
+    for d in frame_directories if len(frame_directories) != 0 else [volume_file.pet_directory()]:
+        pet_file = File(volume_directory=d) if os.path.isdir(d) else None
+        if pet_file is not None and pet_file.is_valid():
+            nbytes += volume_voxels(pet_file)[0]
+    return nbytes
+
+class Session(object):
+    def __init__(self, directory: str):
+        """A folder of samples that are processed one after another.
+
+        Args:
+            directory (str): The folder containing the sample directories (see find_samples()).
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.samples = find_samples(directory)
+        self.index = -1
+        self.logger.info(f'[Session] {len(self.samples)} samples in {directory}')
+
+    def __len__(self):
+        return len(self.samples)
+
+    def index_of(self, directory: str) -> int:
+        """The index of the sample directory, or -1 if it is not in the session."""
+
+        paths = [os.path.abspath(s) for s in self.samples]
+        directory = os.path.abspath(directory)
+        return paths.index(directory) if directory in paths else -1
+
+    def next_sample(self) -> str:
+        """The sample after the current one, or '' at the end."""
+        return self.samples[self.index+1] if 0 <= self.index+1 < len(self.samples) else ''
@@ -0,0 +1,199 @@
+import atexit
+import glob
+import logging
+import mmap
+import os
+import tempfile
+import uuid
+import weakref
+from typing import Tuple, Union
+
+import config
+import numpy as np
+
+from .scratch import is_out_of_core
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    #// Python < 3.8; the buffers are memory-mapped temporary files instead
+    shared_memory = None
+
+#// the buffers are named [prefix][pid]_..., so those left by a crashed process can be found and removed
+shared_prefix = 'rsa_pet_'
+
+def shared_file_prefix() -> str:
+    """The name prefix of the buffers and temporary files of this process."""
+    return f'{shared_prefix}{os.getpid()}_'
+
+def shared_directory() -> str:
+    """Where the memory-mapped buffers are written: the scratch directory, or the system temporary directory."""
+    return config.scratch_directory if config.scratch_directory != '' else tempfile.gettempdir()
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def remove_stale_buffers():
+    """Removes the shared memory blocks and temporary files left by processes that are no longer running.
+
+    Only POSIX systems are swept; there, os.kill(pid, 0) only tells whether pid is running.
+    """
+
+    if os.name != 'posix':
+        return
+
+    logger = logging.getLogger('remove_stale_buffers')
+    paths = glob.glob(os.path.join(shared_directory(), shared_prefix+'*'))+glob.glob(os.path.join('/dev/shm', shared_prefix+'*'))
+    for path in paths:
+        pid = os.path.basename(path)[len(shared_prefix):].split('_')[0]
+        if not pid.isdigit() or is_process_alive(int(pid)):
+            continue
+        try:
+            os.remove(path)
+            logger.info(f'[Stale buffer removed] {path}')
+        except OSError:
+            pass
+
+#// the buffers owned by this process, released at exit
+_owned = weakref.WeakSet()
+#// handle -> (buffer, array) of the buffers attached by this (worker) process
+_attached = {}
+_swept = []
+
+@atexit.register
+def _release_all():
+    for shared in list(_owned):
+        shared.release()
+
+class SharedArray(object):
+    def __init__(self, shape: Tuple[int], dtype, backend: str=''):
+        """A zero-filled NumPy array that worker processes map by its handle instead of receiving a copy.
+
+        The buffer is a block of multiprocessing.shared_memory, or a memory-mapped temporary .npy
+        file in the out-of-core mode (so it is not resident) and on Python < 3.8. The creating
+        process owns it: release() removes it, and so does the exit of the process. The buffers of
+        a process that crashed are removed by the next process that creates one (see remove_stale_buffers()).
+
+        Args:
+            shape (Tuple[int]): Shape of the array.
+            dtype: Data type of the array.
+            backend (str, optional): 'memory' or 'file'. Defaults to 'file' in the out-of-core mode or without shared_memory, 'memory' otherwise.
+        """
+
+        super().__init__()
+        if len(_swept) == 0:
+            _swept.append(True)
+            remove_stale_buffers()
+
+        if backend == '':
+            backend = 'file' if is_out_of_core() or shared_memory is None else 'memory'
+        self.backend = backend
+        self.shape = tuple([int(s) for s in shape])
+        self.dtype = np.dtype(dtype)
+        self.name = shared_file_prefix()+uuid.uuid4().hex[:12]
+
+        if backend == 'memory':
+            self.__shm = shared_memory.SharedMemory(name=self.name, create=True, size=max(1, int(np.prod(self.shape))*self.dtype.itemsize))
+            self.ndarray = np.ndarray(self.shape, dtype=self.dtype, buffer=self.__shm.buf)
+            self.ndarray[...] = 0
+            #// the views of the array keep it alive, so the block is unmapped only once none is left;
+            #// closing it earlier would leave them pointing to unmapped memory
+            finalizer = weakref.finalize(self.ndarray, self.__shm.close)
+            finalizer.atexit = False
+        elif backend == 'file':
+            self.__shm = None
+            self.name = os.path.join(shared_directory(), self.name+'.npy')
+            self.ndarray = np.lib.format.open_memmap(self.name, mode='w+', dtype=self.dtype, shape=self.shape)
+        else:
+            raise ValueError(f'Unknown backend: {backend}')
+
+        _owned.add(self)
+
+    @classmethod
+    def copy_of(cls, ndarray: np.ndarray, backend: str='') -> 'SharedArray':
+        shared = cls(ndarray.shape, ndarray.dtype, backend=backend)
+        shared.ndarray[...] = ndarray
+        return shared
+
+    def handle(self) -> tuple:
+        """What attach_array() needs to map the array in another process; small to pickle."""
+        return (self.backend, self.name, self.shape, self.dtype.str, 0)
+
+    def is_released(self):
+        return self.ndarray is None
+
+    def release(self):
+        """Removes the buffer. The views still held in this process stay valid, and the memory is freed once they are dropped."""
+
+        if self.ndarray is None:
+            return
+
+        self.ndarray = None
+        if self.backend == 'memory':
+            try:
+                self.__shm.unlink()
+            except FileNotFoundError:
+                pass
+            self.__shm = None
+        else:
+            try:
+                os.remove(self.name)
+            except OSError:
+                pass
+        _owned.discard(self)
+
+    def __del__(self):
+        self.release()
+
+def share_array(ndarray: np.ndarray) -> Tuple[tuple, Union[SharedArray, None]]:
+    """A handle of ndarray for attach_array(), and the SharedArray that has to be kept (and released) while it is used.
+
+    A whole memory-mapped file (e.g. a single-file volume or the frames read by read_uint8_frames())
+    is mapped from its file by the workers, so no copy is made; any other array is copied once into a SharedArray.
+    """
+
+    #// a view (e.g. Volume.ndary) of a whole memory-mapped file is mapped from the file as well
+    root = ndarray
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    if isinstance(root, np.memmap) and root.filename is not None and isinstance(root.base, mmap.mmap) and ndarray.flags.c_contiguous \
+            and ndarray.shape == root.shape and ndarray.dtype == root.dtype and ndarray.ctypes.data == root.ctypes.data:
+        return ('file', root.filename, ndarray.shape, ndarray.dtype.str, root.offset), None
+
+    shared = SharedArray.copy_of(ndarray)
+    return shared.handle(), shared
+
+def attach_array(handle: tuple, writeable: bool=False) -> np.ndarray:
+    """The array of handle (see SharedArray.handle() and share_array()) mapped in this process without copying.
+
+    The mapping is kept for the life of the process, so the tasks of a worker attach once.
+    """
+
+    if handle in _attached:
+        return _attached[handle][1]
+
+    backend, name, shape, dtype, offset = handle
+    if backend == 'memory':
+        try:
+            #// the owner unlinks the block; the workers must not (Python >= 3.13)
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        ndarray = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    else:
+        shm = None
+        if name.endswith('.npy') and offset == 0:
+            ndarray = np.load(name, mmap_mode='r+' if writeable else 'r')
+        else:
+            ndarray = np.memmap(name, dtype=np.dtype(dtype), mode='r+' if writeable else 'r', offset=offset, shape=tuple(shape))
+
+    if not writeable:
+        ndarray.flags.writeable = False
+    _attached[handle] = (shm, ndarray)
+    return ndarray
@@ -1,12 +1,15 @@
+import json
 import logging
+import os
 from copy import deepcopy
-from typing import List, Tuple, Union
+from typing import Callable, List, Tuple, Union
 
 import numpy as np
 from PyQt5.QtGui import QColor
 from skimage.morphology import ball, disk
 
-from .rinfo import RootNode
+from .rinfo import RootNode, RSA_Vector
+from .scratch import allocate_volume, release_pages, slab_size
 
 
 class Trace(object):
@@ -30,7 +33,79 @@ class Trace(object):
         completed_polyline = root_node.completed_polyline()
         if self.trace3D is not None:
             self.trace3D.draw_trace_single(completed_polyline, color=QColor('#ffffffff'))
-        
+
+    def draw_traces(self, root_nodes: List[RootNode], progress: Union[Callable, None]=None):
+        """Draws all roots at once, z-slab by z-slab (see TraceObject.draw_traces)."""
+
+        polylines = []
+        for i, root_node in enumerate(root_nodes):
+            if progress is not None:
+                progress(i, len(root_nodes), 'Making trace volume')
+            polylines.append(root_node.completed_polyline())
+
+        if self.trace3D is not None:
+            self.trace3D.draw_traces(polylines, color=QColor('#ffffffff'))
+
+    def draw_rinfo(self, rinfo: RSA_Vector, rinfo_hash: str, directory: str='', progress: Union[Callable, None]=None) -> bool:
+        """Draws the roots of rinfo, or reads the trace mask saved in directory while the rinfo content (rinfo_hash), the shape and the pen size are unchanged.
+
+        The drawn trace is saved in directory ([volume_name]_trace/), unless it is ''.
+        Returns False if rinfo has no base node.
+        """
+
+        base_node = rinfo.base_node(1)
+        if base_node is None:
+            return False
+
+        if directory != '' and self.load_mask(directory, rinfo_hash):
+            return True
+
+        self.draw_traces(list(base_node.child_nodes()), progress=progress)
+        if directory != '':
+            self.save_mask(directory, rinfo_hash)
+        return True
+
+    def is_drawn(self):
+        return self.trace3D is not None and self.trace3D.drawn
+
+    def mask_key(self, rinfo_hash: str) -> dict:
+        """What the trace mask depends on: the rinfo content, the X-ray CT shape and the pen size."""
+        return {'rinfo': rinfo_hash, 'shape': list(self.trace3D.shape_full[:3]), 'dimensions': self.trace3D.dimensions, 'pen_size': self.trace3D.pen_size}
+
+    def load_mask(self, directory: str, rinfo_hash: str) -> bool:
+        """Reads the trace saved by save_mask() in directory, if it was drawn from the same rinfo content, shape and pen size."""
+
+        if self.trace3D is None:
+            return False
+
+        try:
+            with open(os.path.join(directory, 'trace_mask.json'), 'r') as f:
+                if json.load(f) != self.mask_key(rinfo_hash):
+                    return False
+            self.trace3D.load_mask(os.path.join(directory, 'trace_mask.npy'))
+        except (OSError, ValueError):
+            return False
+
+        self.logger.info(f'[Trace mask loaded] {directory}')
+        return True
+
+    def save_mask(self, directory: str, rinfo_hash: str):
+        """Saves the drawn trace bit-packed in directory, with its key written last so that an interrupted save is not read."""
+
+        if self.trace3D is None:
+            return
+
+        key_file = os.path.join(directory, 'trace_mask.json')
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if os.path.isfile(key_file):
+                os.remove(key_file)
+            self.trace3D.save_mask(os.path.join(directory, 'trace_mask.npy'))
+            with open(key_file, 'w') as f:
+                json.dump(self.mask_key(rinfo_hash), f, indent=1)
+        except OSError as e:
+            self.logger.warning(f'[Trace mask not saved] {directory}: {e}')
+
 class TraceObject():
     def __init__(self, shape: Tuple, dimensions: List[int] = [0,1,2], pen_size: int=3):
         self.dimensions = deepcopy(dimensions)
@@ -41,9 +116,11 @@ class TraceObject():
         self.clear()
 
     def clear(self):
-        self.volume = np.zeros(self.shape, dtype=np.uint8)
+        #// the RGBA volume is 4 times the X-ray CT volume; it is memory-mapped in the out-of-core mode
+        self.volume = allocate_volume(self.shape, np.uint8)
+        self.drawn = False
 
-    def get_slice_generator(self, polyline: List[List[int]]):
+    def get_slice_generator(self, polyline: List[List[int]], z_range: Union[Tuple[int], None]=None):
         S = self.pen_size*2+1
 
         for pos in polyline:
@@ -58,6 +135,14 @@ class TraceObject():
                 slices.append(slice(max(pos[d]-self.pen_size, 0), min(pos[d]+self.pen_size+1, self.shape_full[d])))
                 pad_slices.append(slice(-min(pos[d]-self.pen_size, 0), S+min(self.shape_full[d]-pos[d]-self.pen_size-1, 0)))
 
+            #// clip the pen to the z-slab being drawn
+            if z_range is not None:
+                start, stop = max(slices[0].start, z_range[0]), min(slices[0].stop, z_range[1])
+                if start >= stop:
+                    continue
+                pad_slices[0] = slice(pad_slices[0].start+start-slices[0].start, pad_slices[0].stop-slices[0].stop+stop)
+                slices[0] = slice(start, stop)
+
             not_index = [d for d in range(3) if d not in self.dimensions]
             for d in not_index:
                 del slices[d]
@@ -65,16 +150,70 @@ class TraceObject():
 
             yield (slices, pad_slices)
 
-    def draw_trace(self, polyline: List[List[int]], color=QColor('#ffffffff')):
-        for slices, pad_slices in self.get_slice_generator(polyline=polyline):
-            croped = self.volume[tuple(slices)]
-            pen = ball if len(self.dimensions)==3 else disk
-            pen = pen(self.pen_size)[tuple(pad_slices)]
-            m_ball = [pen*color for color in color.getRgb()]
-            m_ball = np.stack(m_ball, axis=len(self.dimensions))
+    def draw_trace(self, polyline: List[List[int]], color=QColor('#ffffffff'), z_range: Union[Tuple[int], None]=None):
+        pen = ball if len(self.dimensions)==3 else disk
+        pen = pen(self.pen_size)
+        m_ball = np.stack([pen*color for color in color.getRgb()], axis=len(self.dimensions))
 
-            croped = np.maximum(croped, m_ball)
+        for slices, pad_slices in self.get_slice_generator(polyline=polyline, z_range=z_range):
+            croped = self.volume[tuple(slices)]
+            croped = np.maximum(croped, m_ball[tuple(pad_slices)])
             self.volume[tuple(slices)] = croped
+            self.drawn = True
+
+    def save_mask(self, fname: str):
+        """Saves where the trace is drawn as a .npy file of bit-packed slices (1 bit per voxel), slab by slab.
+
+        The trace is drawn in white, so the mask restores every channel.
+        """
+
+        pixels = int(np.prod(self.shape[1:3]))
+        packed = np.lib.format.open_memmap(fname, mode='w+', dtype=np.uint8, shape=(self.shape[0], -(-pixels//8)))
+        size = slab_size(self.shape, self.volume.dtype)
+        for z0 in range(0, self.shape[0], size):
+            packed[z0:z0+size] = np.packbits(self.volume[z0:z0+size, ..., 1].reshape(-1, pixels) != 0, axis=1)
+            release_pages(self.volume)
+        packed.flush()
+        del packed
+
+    def load_mask(self, fname: str):
+        """Reads a mask saved by save_mask() into the volume, slab by slab."""
+
+        pixels = int(np.prod(self.shape[1:3]))
+        packed = np.load(fname, mmap_mode='r')
+        if packed.shape != (self.shape[0], -(-pixels//8)):
+            raise ValueError(f'The mask shape {packed.shape} does not match the volume shape {self.shape}.')
+
+        self.clear()
+        size = slab_size(self.shape, self.volume.dtype)
+        for z0 in range(0, self.shape[0], size):
+            mask = np.unpackbits(packed[z0:z0+size], axis=1, count=pixels).reshape((-1,)+self.shape[1:3])
+            self.volume[z0:z0+size] = (mask*255)[..., None]
+            self.drawn = self.drawn or bool(mask.any())
+            release_pages(self.volume)
 
     def draw_trace_single(self, polyline: List[List[int]], **kwargs):
         self.draw_trace(polyline, **kwargs)
+
+    def draw_traces(self, polylines: List[List[List[int]]], color=QColor('#ffffffff')):
+        """Draws the polylines z-slab by z-slab.
+
+        The points are sorted by z once, and each slab is drawn from the points within the
+        pen radius of it (the halo), so only one slab of a memory-mapped volume is written at
+        a time. The result is the same as drawing the polylines one by one.
+        """
+
+        points = np.array([pos for polyline in polylines for pos in polyline], dtype=np.int64).reshape(-1, 3)
+        if len(points) == 0:
+            return
+        if 0 not in self.dimensions:
+            self.draw_trace(points.tolist(), color=color)
+            return
+
+        points = points[np.argsort(points[:, 0], kind='stable')]
+        size = slab_size(self.shape, self.volume.dtype)
+        for z0 in range(0, self.shape_full[0], size):
+            z1 = min(z0+size, self.shape_full[0])
+            first, last = np.searchsorted(points[:, 0], [z0-self.pen_size, z1+self.pen_size])
+            self.draw_trace(points[first:last].tolist(), color=color, z_range=(z0, z1))
+            release_pages(self.volume)
@@ -0,0 +1,66 @@
+import csv
+from typing import Dict, List
+
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import ball
+
+from .registration import RegistrationTransform
+from .rinfo import RSA_Vector
+
+
+def root_uptake(rinfo: RSA_Vector, pet: np.ndarray, transform: RegistrationTransform, radius: int=0, resolution: float=1.) -> List[Dict]:
+    """PET uptake along each root, without resampling the PET volume.
+
+    The voxels of each completed polyline (optionally dilated by a ball of radius voxels)
+    are mapped into the PET volume by transform, and all of them are sampled from pet
+    with one trilinear gather.
+
+    Args:
+        rinfo (RSA_Vector): RSA vector data in the X-ray CT voxel coordinates.
+        pet (np.ndarray): The PET volume, not rescaled.
+        transform (RegistrationTransform): The registration of the rescaled PET volume into the X-ray CT volume.
+        radius (int, optional): Radius in X-ray CT voxels around the polylines, e.g. the pen size of the trace. Defaults to 0.
+        resolution (float, optional): X-ray CT voxel resolution for the root length. Defaults to 1.
+
+    Returns:
+        List[Dict]: ID_string, length, sum, mean and max of the uptake for each root.
+    """
+
+    offsets = np.argwhere(ball(radius))-radius if radius > 0 else np.zeros((1, 3), dtype=np.int64)
+
+    roots = []
+    for base_node in rinfo:
+        for root_node in base_node:
+            polyline = np.array(root_node.completed_polyline(), dtype=np.int64).reshape(-1, 3)
+            voxels = np.unique((polyline[:, None, :]+offsets[None]).reshape(-1, 3), axis=0)
+            length = np.linalg.norm(np.diff(polyline, axis=0), axis=1).sum()*resolution
+            roots.append((root_node.ID_string(), length, voxels))
+
+    if len(roots) == 0:
+        return []
+
+    #// rescaled PET voxel -> original PET voxel
+    zoom = np.array(transform.source_shape, dtype=np.float64)/np.array(pet.shape)
+    voxels = np.concatenate([r[2] for r in roots])
+    coordinates = (transform.target_to_source(voxels)+0.5)/zoom-0.5
+    values = ndimage.map_coordinates(pet, coordinates.T, order=1, mode='constant', cval=0.)
+
+    uptake = []
+    for (ID_string, length, _), root_values in zip(roots, np.split(values, np.cumsum([len(r[2]) for r in roots])[:-1])):
+        uptake.append({
+            'ID_string': ID_string,
+            'length': length,
+            'sum': root_values.sum() if len(root_values) != 0 else 0.,
+            'mean': root_values.mean() if len(root_values) != 0 else 0.,
+            'max': root_values.max() if len(root_values) != 0 else 0.,
+        })
+
+    return uptake
+
+def save_root_uptake(uptake: List[Dict], fname: str):
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ID_string', 'length', 'uptake_sum', 'uptake_mean', 'uptake_max'])
+        for row in uptake:
+            writer.writerow([row['ID_string'], f"{row['length']:.3f}", f"{row['sum']:.3f}", f"{row['mean']:.3f}", f"{row['max']:.3f}"])
@@ -1,20 +1,164 @@
 import logging
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import numpy as np
-from skimage import exposure, transform
+from scipy import ndimage
 
+from .scratch import release_pages
+from .shared import SharedArray, share_array
+
+
+class IntensityStatistics(object):
+    def __init__(self, clip_percentile: float=0.):
+        """Running intensity statistics gathered slice by slice.
+
+        Args:
+            clip_percentile (float, optional): Percentile clipped at each end of the intensity range. A running histogram is kept for unsigned integer data of up to 16 bits when it is positive. Defaults to 0.
+        """
+
+        super().__init__()
+        self.clip_percentile = clip_percentile
+        self.minimum = None
+        self.maximum = None
+        self.histogram = None
+
+    def update(self, ndarray: np.ndarray):
+        minimum, maximum = ndarray.min(), ndarray.max()
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+
+        if self.clip_percentile > 0 and ndarray.dtype in (np.uint8, np.uint16):
+            histogram = np.bincount(ndarray.ravel(), minlength=np.iinfo(ndarray.dtype).max+1)
+            self.histogram = histogram if self.histogram is None else self.histogram+histogram
+
+    def intensity_range(self):
+        assert self.minimum is not None
+        if self.histogram is None:
+            return self.minimum, self.maximum
+
+        cdf = np.cumsum(self.histogram)
+        lower = np.searchsorted(cdf, cdf[-1]*self.clip_percentile/100.)
+        upper = np.searchsorted(cdf, cdf[-1]*(1-self.clip_percentile/100.))
+        return lower, upper
+
+def convert_to_uint8(ndarray: np.ndarray, intensity_range: Tuple, out: Union[np.ndarray, None]=None, slab_size: int=16):
+    """Maps intensity_range to 0-255 slab by slab.
+
+    Only slab-sized float32 temporaries are created. If out is ndarray itself (8-bit and writable), the conversion is done in place.
+    """
+
+    if out is None:
+        out = np.empty(ndarray.shape, dtype=np.uint8)
+
+    lower, upper = float(intensity_range[0]), float(intensity_range[1])
+    scale = 255./(upper-lower) if upper > lower else 0.
+    for i in range(0, len(ndarray), slab_size):
+        slab = ndarray[i:i+slab_size].astype(np.float32)
+        slab -= lower
+        slab *= scale
+        np.clip(slab, 0, 255, out=slab)
+        out[i:i+slab_size] = slab
+        release_pages(ndarray)
+        release_pages(out)
+
+    return out
+
+def bounding_box(ndarray: np.ndarray, threshold: float=0, slab_size: int=16) -> Union[Tuple[slice], None]:
+    """Bounding box of the voxels above threshold, from the projections of the mask onto each axis.
+
+    The mask is built slab by slab, so only slab-sized temporaries are created.
+
+    Returns:
+        Union[Tuple[slice], None]: A slice for each axis, or None if no voxel is above threshold.
+    """
+
+    projections = [np.zeros(s, dtype=bool) for s in ndarray.shape]
+    for i in range(0, len(ndarray), slab_size):
+        mask = np.asarray(ndarray[i:i+slab_size]) > threshold
+        projections[0][i:i+slab_size] = mask.any(axis=(1, 2))
+        projections[1] |= mask.any(axis=(0, 2))
+        projections[2] |= mask.any(axis=(0, 1))
+
+    if not projections[0].any():
+        return None
+    return tuple([slice(int(np.argmax(p)), len(p)-int(np.argmax(p[::-1]))) for p in projections])
+
+def union_box(boxes: List[Union[Tuple[slice], None]]) -> Union[Tuple[slice], None]:
+    boxes = [box for box in boxes if box is not None]
+    if len(boxes) == 0:
+        return None
+    return tuple([slice(min([b[i].start for b in boxes]), max([b[i].stop for b in boxes])) for i in range(3)])
+
+def expand_box(box: Union[Tuple[slice], None], shape: Tuple[int], margin: int=0, scale: int=1) -> Tuple[slice]:
+    """Scales box (e.g. from every scale-th voxel to all voxels) and widens it by margin, within shape. None is the whole shape."""
+
+    if box is None:
+        return tuple([slice(0, s) for s in shape])
+    return tuple([slice(max(b.start*scale-margin, 0), min((b.stop-1)*scale+1+margin, s)) for b, s in zip(box, shape)])
+
+
+def rescale_volume(ndarray: np.ndarray, rescaled_shape: Tuple[int], step: int=1, out: Union[np.ndarray, None]=None, slab_size: int=16) -> np.ndarray:
+    """Linear rescaling of a volume to rescaled_shape, stretched to 8 bit.
+
+    With step > 1, only every step-th voxel of the rescaled volume is computed, so that
+    rescale_volume(a, shape, step) equals rescale_volume(a, shape)[::step, ::step, ::step]
+    up to the intensity stretch, without the full resolution volume being allocated.
+
+    The output is computed in z-slabs of slab_size slices, each from the source slices
+    it covers plus a halo of one slice for the interpolation, so a memory-mapped source
+    or output is only touched slab by slab.
+
+    Args:
+        out (Union[np.ndarray, None], optional): The 8-bit output, e.g. a memory-mapped scratch array. Defaults to a new array.
+    """
+
+    #// voxel centers of the rescaled grid in the original grid, as in ndimage.zoom(..., grid_mode=True)
+    scale = [s/r for s, r in zip(ndarray.shape, rescaled_shape)]
+    output_shape = tuple([-(-r//step) for r in rescaled_shape])
+    if out is None:
+        out = np.empty(output_shape, dtype=np.uint8)
+    assert out.shape == output_shape and out.dtype == np.uint8
+
+    #// interpolated straight into 8 bit, then stretched in place
+    minimum, maximum = 255, 0
+    for i in range(0, output_shape[0], slab_size):
+        stop = min(i+slab_size, output_shape[0])
+        #// source slices of the slab and its halo; the mirror mode only applies at the true volume ends
+        first = (i*step+0.5)*scale[0]-0.5
+        last = ((stop-1)*step+0.5)*scale[0]-0.5
+        z0 = max(int(np.floor(first))-1, 0)
+        z1 = min(int(np.floor(last))+3, ndarray.shape[0])
+
+        offset = [0.5*c-0.5 for c in scale]
+        offset[0] += i*step*scale[0]-z0
+        ndimage.affine_transform(np.asarray(ndarray[z0:z1]), [c*step for c in scale], offset=offset, output=out[i:stop], order=1, mode='mirror')
+        minimum, maximum = min(minimum, int(out[i:stop].min())), max(maximum, int(out[i:stop].max()))
+        release_pages(ndarray)
+        release_pages(out)
+
+    #// the stretch of 8-bit values as a lookup table, so that no float32 slab is needed
+    lut = convert_to_uint8(np.arange(256, dtype=np.uint8), (minimum, maximum))
+    for i in range(0, output_shape[0], slab_size):
+        #// slice by slice, as the indices are converted to intp
+        for j in range(i, min(i+slab_size, output_shape[0])):
+            out[j] = lut[out[j]]
+        release_pages(out)
+
+    return out
 
 class Volume(object):
     def __init__(self):
         super().__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.__shared = None
         self.clear()
 
     def clear(self):
+        self.release_shared()
         self.ndary: Union[np.ndarray, None] = None
         self.resolution = 0.3
         self.scaling_factor = 1.
+        self.__loader = None
         self.logger.debug(f'The volume data cleared.')
 
     def is_empty(self):
@@ -24,22 +168,69 @@ class Volume(object):
         assert self.ndary is not None
         return self.ndary.shape
 
-    def init_from_volume(self, volume: np.ndarray):
-        self.ndary = volume
+    def init_from_volume(self, volume: np.ndarray, loader=None):
+        """Set the volume data.
+
+        Args:
+            volume (np.ndarray): The volume data.
+            loader (optional): A thread still filling the volume in the background. Its wait() is called before the full resolution data is used.
+        """
+
+        #// the array is shared with the viewer and the exporter, so it is held as a read-only view instead of being copied
+        self.release_shared()
+        self.ndary = volume.view()
+        self.ndary.flags.writeable = False
+        self.__loader = loader
         self.logger.debug(f'The volume data initialized.')
 
-    def get_rescaled_ndarray(self):
+    def share(self):
+        """Backs the volume by a SharedArray, so worker processes map it (see shared_handle()) instead of receiving a copy.
+
+        The data is copied once, unless it is a whole memory-mapped file, which the workers map
+        directly. ndary stays a read-only view, so callers do not notice. clear() releases the buffer.
+        """
+
+        if self.__shared is not None or self.ndary is None:
+            return
+
+        self.wait_until_loaded()
+        handle, shared = share_array(self.ndary)
+        self.__shared = (handle, shared)
+        if shared is not None:
+            self.ndary = shared.ndarray.view()
+            self.ndary.flags.writeable = False
+
+    def shared_handle(self) -> tuple:
+        """The handle of the volume for attach_array() in worker processes; the volume is shared first if it is not yet."""
+
         assert self.ndary is not None
+        self.share()
+        return self.__shared[0]
+
+    def release_shared(self):
+        """Removes the SharedArray backing the volume, if any; ndary stays valid until it is dropped."""
 
-        shape :Tuple[int] = self.ndary.shape
-        resized = [int(s*self.scaling_factor) for s in shape]
-        
-        return np.array(exposure.rescale_intensity(
-            transform.resize(self.ndary, resized),
-            out_range=np.uint8
-        ))
+        if self.__shared is not None and self.__shared[1] is not None:
+            self.__shared[1].release()
+        self.__shared: Union[Tuple[tuple, Union[SharedArray, None]], None] = None
 
+    def is_fully_loaded(self):
+        return self.__loader is None or self.__loader.isFinished()
 
+    def wait_until_loaded(self):
+        if self.__loader is not None:
+            self.logger.debug(f'Waiting for the full resolution volume.')
+            self.__loader.wait()
+            self.__loader = None
 
+    def full_ndarray(self):
+        self.wait_until_loaded()
+        return self.ndary
 
-        
\ No newline at end of file
+    def rescaled_shape(self):
+        assert self.ndary is not None
+        return tuple([int(s*self.scaling_factor) for s in self.ndary.shape])
+
+    def get_rescaled_ndarray(self, step: int=1):
+        assert self.ndary is not None
+        return rescale_volume(self.ndary, self.rescaled_shape(), step=step)
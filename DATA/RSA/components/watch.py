@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+import config
+
+from .file import File
+from .jobs import LoadedSample
+from .pyramid import build_pyramids, pyramid_jobs
+from .rinfo import RSA_Vector, rinfo_hash
+from .sample import Sample, load_registration
+from .session import find_samples
+from .trace import Trace
+
+
+def file_set(volume_file: File) -> List[Tuple[str, int, int]]:
+    """The names, sizes and modification times of all files of a sample: the X-ray CT volume, the PET directory (with its frames), the rinfo file and the registration file."""
+
+    paths = [volume_file.rinfo_file, volume_file.registration_file]
+    for directory in (volume_file.directory, volume_file.pet_directory()):
+        for root, _, files in os.walk(directory):
+            paths.extend([os.path.join(root, f) for f in files])
+
+    files = []
+    for path in sorted(paths):
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+    return files
+
+def directory_stamp(volume_file: File) -> List[Union[List[int], None]]:
+    """The modification times of the directories of a sample (the X-ray CT volume, the PET directory and its frames) and of its rinfo and registration files.
+
+    Only a few stat calls, so it is checked on every scan; a directory changes when a file in it is added, removed or replaced.
+    """
+
+    paths = [volume_file.directory, volume_file.pet_directory()]+volume_file.pet_frame_directories()
+    stamp = []
+    for path in paths+[volume_file.rinfo_file, volume_file.registration_file]:
+        try:
+            stat = os.stat(path)
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            stamp.append(None)
+    return stamp
+
+def is_complete(volume_file: File) -> bool:
+    """Whether the X-ray CT volume and the PET volume (or all its frames) of a sample are there and valid."""
+
+    if not volume_file.is_valid() or not os.path.isdir(volume_file.pet_directory()):
+        return False
+
+    frame_directories = volume_file.pet_frame_directories()
+    pet_directories = frame_directories if len(frame_directories) != 0 else [volume_file.pet_directory()]
+    return all([File(volume_directory=d).is_valid() for d in pet_directories])
+
+def registration_stat(volume_file: File) -> Union[List[int], None]:
+    if not os.path.isfile(volume_file.registration_file):
+        return None
+    stat = os.stat(volume_file.registration_file)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class SampleWatcher(object):
+    def __init__(self, directory: str, settle_time: float=30., index_file: str=''):
+        """Watches a folder where samples arrive, and prepares each one once its files are complete and stable.
+
+        A sample is prepared when its X-ray CT and PET volumes are valid and none of its files
+        (see file_set()) has changed for settle_time seconds: the CT trace is drawn from the rinfo
+        file and saved as the trace mask, and the pyramids of the X-ray CT volume, the trace and
+        the PET volume are built, as the GUI would on opening it. If a registration file is
+        there, the registrated PET volume is exported as well.
+
+        What was done is recorded in the index file with the signature of the sample and of
+        the registration file, so a restart skips the samples already prepared. The files of a
+        sample in the index are only listed again once its directory_stamp() changes. A sample is
+        prepared again when its files change, and only exported again when its registration file does.
+
+        Args:
+            directory (str): The watched folder, containing the sample directories (see find_samples()).
+            settle_time (float, optional): Seconds a sample has to stay unchanged. Defaults to 30.
+            index_file (str, optional): The index. Defaults to directory/watch_index.json.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.directory = directory
+        self.settle_time = settle_time
+        self.index_file = index_file if index_file != '' else os.path.join(directory, 'watch_index.json')
+        self.index = self.load_index()
+        #// sample -> (file set, when it was first seen unchanged)
+        self.file_sets = {}
+        self.stopped = threading.Event()
+
+    def load_index(self) -> Dict[str, dict]:
+        try:
+            with open(self.index_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self):
+        #// written aside and replaced at once, so an interrupted save leaves the previous index readable
+        with open(self.index_file+'.tmp', 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(self.index_file+'.tmp', self.index_file)
+
+    def run(self, interval: float=10.):
+        """Polls the folder every interval seconds until stop() is called or interrupted."""
+
+        self.logger.info(f'[Watching] {self.directory} (index: {self.index_file})')
+        try:
+            while not self.stopped.is_set():
+                self.poll()
+                self.stopped.wait(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self) -> List[str]:
+        """Prepares the samples that are complete and stable and have not been prepared yet, and returns them."""
+
+        prepared = []
+        now = time.monotonic()
+        for directory in find_samples(self.directory):
+            if self.stopped.is_set():
+                break
+
+            key = os.path.abspath(directory)
+            volume_file = File(volume_directory=directory)
+            try:
+                stamp = directory_stamp(volume_file)
+                entry = self.index.get(key)
+                if key not in self.file_sets and entry is not None and entry.get('stamp') == stamp:
+                    continue
+                files = file_set(volume_file)
+            except OSError:
+                #// a file was removed while listing; the sample is still being written
+                continue
+
+            previous = self.file_sets.get(key)
+            if previous is None or previous[0] != files:
+                self.file_sets[key] = (files, now)
+                continue
+            if now-previous[1] < self.settle_time or not is_complete(volume_file):
+                continue
+
+            signature = volume_file.sample_signature()
+            registration = registration_stat(volume_file)
+            steps = self.pending_steps(key, signature, registration)
+            if len(steps) != 0:
+                self.prepare(volume_file, steps, signature, registration, stamp)
+                prepared.append(directory)
+            elif self.index[key].get('stamp') != stamp:
+                self.index[key]['stamp'] = stamp
+                self.save_index()
+            if key in self.index and self.index[key].get('stamp') == stamp:
+                #// settled; listed again once its directories change
+                del self.file_sets[key]
+
+        return prepared
+
+    def pending_steps(self, key: str, signature, registration: Union[List[int], None]) -> List[str]:
+        entry = self.index.get(key)
+        if entry is None or entry['signature'] != signature:
+            return ['trace', 'pyramids', 'export'] if registration is not None else ['trace', 'pyramids']
+        if registration is not None and entry['registration'] != registration:
+            return ['export']
+        return []
+
+    def prepare(self, volume_file: File, steps: List[str], signature, registration: Union[List[int], None], stamp: List[Union[List[int], None]]):
+        key = os.path.abspath(volume_file.directory)
+        entry = {'signature': signature, 'registration': registration, 'stamp': stamp, 'steps': {}, 'error': ''}
+        self.logger.info(f"[Sample ready] {volume_file.directory} ({', '.join(steps)})")
+
+        try:
+            sample = LoadedSample(volume_file.directory)
+            try:
+                if 'trace' in steps or 'pyramids' in steps:
+                    self.build_caches(sample, entry)
+                if 'export' in steps:
+                    start = time.perf_counter()
+                    dest = sample.export(*load_registration(volume_file.registration_file))
+                    entry['steps']['export'] = time.perf_counter()-start
+                    self.logger.info(f'[Exported] {dest}')
+            finally:
+                sample.release()
+        except Exception as e:
+            #// recorded with the signature, so the sample is not tried again until its files change
+            entry['error'] = f'{e.__class__.__name__}: {e}'
+            self.logger.error(f"[Preparation failed] {volume_file.directory}: {entry['error']}")
+
+        if self.stopped.is_set() and entry['error'] == '' and len(entry['steps']) != len(steps):
+            #// interrupted; prepared again on the next start
+            return
+
+        previous = self.index.get(key)
+        if previous is not None and steps == ['export']:
+            entry['steps'] = dict(previous['steps'], **entry['steps'])
+        self.index[key] = entry
+        self.save_index()
+
+    def build_caches(self, sample: LoadedSample, entry: dict):
+        """Draws and saves the trace mask, and builds the pyramids."""
+
+        start = time.perf_counter()
+        ct = Sample(sample.file.directory).load_ct()
+        trace = None
+        if sample.rinfo is not None:
+            with open(sample.file.rinfo_file, 'r') as f:
+                rinfo_dict = json.load(f)
+            trace = Trace()
+            trace.init_from_volume(ct)
+            rinfo = RSA_Vector()
+            if not rinfo.load_from_dict(rinfo_dict, file=sample.file.rinfo_file) or not trace.draw_rinfo(rinfo, rinfo_hash(rinfo_dict), directory=sample.file.trace_directory):
+                trace = None
+        entry['steps']['trace'] = time.perf_counter()-start
+
+        if config.build_pyramid:
+            start = time.perf_counter()
+            trace_object = trace.trace3D if trace is not None and trace.is_drawn() else None
+            pet = sample.pet if sample.frames is None else None
+            #// None if stopped, {} if the pyramids could not be written
+            if build_pyramids(pyramid_jobs(sample.file, ct, trace=trace_object, pet=pet), is_cancelled=self.stopped.is_set):
+                entry['steps']['pyramids'] = time.perf_counter()-start
+
+def watch_samples(directory: str, interval: float=10., settle_time: float=30.):
+    """Runs the watch mode until interrupted (see SampleWatcher)."""
+
+    SampleWatcher(directory, settle_time=settle_time).run(interval=interval)
@@ -1,8 +1,10 @@
 from PyQt5.QtWidgets import QApplication
 from .components import QtMain
 
-def start():
+def start(session: str=''):
     app = QApplication([])
     main = QtMain()
     main.show()
+    if session != '':
+        main.open_session(session)
     app.exec_()
\ No newline at end of file
@@ -3,10 +3,23 @@ from typing import Union
 import config
 import numpy as np
 import pyqtgraph.opengl as gl
+from DATA import (VolumePyramid, bounding_box, downsampled_copy, expand_box,
+                  is_memory_mapped, union_box)
 from DATA.RSA.components.volume import Volume
 from GUI.components import QtMain
+from PyQt5.QtCore import QTimer, pyqtSignal
 from PyQt5.QtGui import QVector3D
 
+#// lookup table of the display opacity, equivalent to ((v/255*2)**2*255) without float temporaries
+ALPHA_LUT = np.clip((np.arange(256)/255.*2)**2*255, 0, 255).astype(np.ubyte)
+
+def scale_intensity(ndarray: np.ndarray, intensity: float):
+    if ndarray.dtype == np.uint8:
+        lut = np.clip(np.arange(256)*intensity, 0, 255).astype(np.ubyte)
+        return lut[ndarray]
+
+    return np.clip(ndarray*intensity, 0, 255)
+
 
 class Registrator(object):
     def __init__(self, gl_ins: gl.GLVolumeItem) -> None:
@@ -18,6 +31,9 @@ class Registrator(object):
 
         super().__init__()
         self.gl_instance = gl_ins
+        self.gl_instances = [gl_ins]
+        self.gl_offsets = [(0, 0, 0)]
+        self.volume_shape = None
         self.scaling_factor = 1. #// If this value is too large, the coordinates will be misaligned, so it is not used here.
 
         self.x = 0
@@ -29,6 +45,33 @@ class Registrator(object):
         self.y_flip = 1
         self.z_flip = 1
 
+        self.callbacks = []
+
+    def add_gl_instance(self, gl_ins: gl.GLGraphicsItem.GLGraphicsItem):
+        """Register another item drawn in the PET voxel coordinates, e.g. a GLScatterPlotItem."""
+        self.gl_instances.append(gl_ins)
+        self.gl_offsets.append((0, 0, 0))
+
+    def set_gl_offset(self, gl_ins: gl.GLGraphicsItem.GLGraphicsItem, offset):
+        """Set the position of the item's origin in the PET voxel coordinates, e.g. of a cropped GLVolumeItem."""
+        self.gl_offsets[self.gl_instances.index(gl_ins)] = tuple(offset)
+
+    def reset(self):
+        """Place the registered items at the volume center without flips, shifts and rotation."""
+
+        for gl_instance, offset in zip(self.gl_instances, self.gl_offsets):
+            gl_instance.resetTransform()
+            gl_instance.scale(-1,-1,-1)
+            gl_instance.translate(self.volume_shape[0]//2-offset[0], self.volume_shape[1]//2-offset[1], self.volume_shape[2]//2-offset[2])
+
+    def set_volume_shape(self, shape):
+        """Set the shape of the displayed PET volume, used when the GLVolumeItem holds no data."""
+        self.volume_shape = shape
+
+    def add_callback(self, callback):
+        """Register a function called with this Registrator after each registration."""
+        self.callbacks.append(callback)
+
     def set_flip_states(self, x_flip: bool, y_flip: bool, z_flip: bool):
         """Flip the GLVolumeItem
 
@@ -56,26 +99,36 @@ class Registrator(object):
         Note:
             If the arguments is omitted, the previous parameter will be used.
         """
-        self.x = x or self.x
-        self.y = y or self.y
-        self.z = z or self.z
-        self.angle = angle or self.angle
-
-        self.gl_instance.resetTransform()
-        self.gl_instance.scale(-1*self.z_flip,-1*self.y_flip,-1*self.x_flip)
-
-        pet_volume = self.gl_instance.data
-        assert pet_volume is not None
-
-        self.gl_instance.translate(
-            self.z_flip*pet_volume.shape[0]//2+self.z, 
-            self.y_flip*pet_volume.shape[1]//2+self.y, 
-            self.x_flip*pet_volume.shape[2]//2+self.x
-        )
-        self.gl_instance.rotate(self.angle, 1, 0, 0)
+        self.x = x if x is not None else self.x
+        self.y = y if y is not None else self.y
+        self.z = z if z is not None else self.z
+        self.angle = angle if angle is not None else self.angle
+
+        if self.volume_shape is not None:
+            shape = self.volume_shape
+        else:
+            pet_volume = self.gl_instance.data
+            assert pet_volume is not None
+            shape = pet_volume.shape
+
+        for gl_instance, offset in zip(self.gl_instances, self.gl_offsets):
+            gl_instance.resetTransform()
+            gl_instance.scale(-1*self.z_flip,-1*self.y_flip,-1*self.x_flip)
+            gl_instance.translate(
+                self.z_flip*(shape[0]//2-offset[0])+self.z, 
+                self.y_flip*(shape[1]//2-offset[1])+self.y, 
+                self.x_flip*(shape[2]//2-offset[2])+self.x
+            )
+            gl_instance.rotate(self.angle, 1, 0, 0)
+
+        for callback in self.callbacks:
+            callback(self)
         
 class Qt3DViewer(gl.GLViewWidget):
     label = '3D viewer'
+    pyqtSignal_volumes_changed = pyqtSignal()
+    pyqtSignal_intensity_changed = pyqtSignal()
+
     def __init__(self, parent: QtMain):
         super().__init__(parent=parent)
         self.opts['distance'] = 850
@@ -83,12 +136,37 @@ class Qt3DViewer(gl.GLViewWidget):
         self.opts['azimuth'] = 0
         self.opts['center'] = QVector3D(0,0,0)
 
+        #// subsampled copies of the arrays owned by Data and their RGBA buffers; released by set_*(None)
+        #// the RGBA buffers only cover the boxes of the content, so that empty space is not uploaded as textures
         self.ct_volume = None
+        self.ct_volume_display = None
         self.ct_trace = None
+        self.ct_box = None
+        self.pet_volume = None
+        self.pet_volume_display = None
+        self.pet_box = None
         self.ct_volume_intensity = 1.
         self.ct_trace_intensity = 1.
         self.pet_volume_intensity = 1.
 
+        #// pyramids of the X-ray CT volume and the trace; when set, the texture is read from them at the level that fits the display budget
+        self.ct_pyramid = None
+        self.trace_pyramid = None
+        self.ct_texture = None
+        self.ct_texture_volume = None
+        self.ct_texture_trace = None
+        self.detail_timer = QTimer(self)
+        self.detail_timer.setSingleShot(True)
+        self.detail_timer.setInterval(300)
+        self.detail_timer.timeout.connect(self.update_ct_detail)
+
+        #// sparse PET display: voxels above the threshold sorted by intensity, extracted down to pet_points_floor
+        self.pet_display_points = False
+        self.pet_threshold = 64
+        self.pet_points_floor = None
+        self.pet_points = None
+        self.pet_point_values = None
+
         self.gl_ct_volume = gl.GLVolumeItem(data=None, sliceDensity=1, smooth=True, glOptions='translucent')
         self.gl_ct_volume.scale(-1,-1,-1)
         self.addItem(self.gl_ct_volume)
@@ -96,81 +174,259 @@ class Qt3DViewer(gl.GLViewWidget):
         self.gl_pet_volume = gl.GLVolumeItem(data=None, sliceDensity=1, smooth=True, glOptions='additive')
         self.addItem(self.gl_pet_volume)
 
+        self.gl_pet_points = gl.GLScatterPlotItem(pos=np.zeros((0, 3), dtype=np.float32), size=1., pxMode=False, glOptions='additive')
+        self.addItem(self.gl_pet_points)
+
         self.registrator = Registrator(self.gl_pet_volume)
+        self.registrator.add_gl_instance(self.gl_pet_points)
         self.show()
 
-    def set_ct_volume(self, ct_volume: np.ndarray):
+    def set_ct_volume(self, ct_volume: np.ndarray, display: Union[np.ndarray, None]=None):
+        """Sets the X-ray CT volume; display is its display array (see display_array()) when it is already at hand, e.g. from the sample cache."""
+
         if ct_volume is None:
+            self.ct_volume = None
+            self.ct_volume_display = None
+            self.ct_box = None
             self.gl_ct_volume.setData(None)
+            self.pyqtSignal_volumes_changed.emit()
             return
 
+        self.ct_volume = display if display is not None else self.display_array(ct_volume)
+        self.set_ct_box(bounding_box(self.ct_volume))
+        self.update_ct_volume()
+        self.pyqtSignal_volumes_changed.emit()
+
+    @staticmethod
+    def display_array(ndarray: np.ndarray):
+        """Every skip_size-th voxel of ndarray, copied so that it does not keep ndarray alive; a memory-mapped (out-of-core) volume is copied slab by slab."""
+
+        if is_memory_mapped(ndarray):
+            return downsampled_copy(ndarray, config.skip_size)
+        return np.ascontiguousarray(ndarray[::config.skip_size, ::config.skip_size, ::config.skip_size])
+
+    def set_ct_box(self, box):
+        """Allocate the RGBA buffer of the X-ray CT volume for box (widened by the margin) and place it in the volume coordinates."""
+
+        self.ct_box = expand_box(box, self.ct_volume.shape, margin=config.crop_margin)
+        self.ct_texture = None
+        self.ct_volume_display = np.zeros(tuple([b.stop-b.start for b in self.ct_box]) + (4,), dtype=np.ubyte)
+
         self.gl_ct_volume.resetTransform()
         self.gl_ct_volume.scale(-1,-1,-1)
+        self.gl_ct_volume.translate(*[s//2-b.start for s, b in zip(self.ct_volume.shape, self.ct_box)])
+
+    def set_ct_pyramid(self, ct_pyramid: Union[VolumePyramid, None], trace_pyramid: Union[VolumePyramid, None]):
+        """Read the X-ray CT texture from the pyramids of the X-ray CT volume and the trace (mask) from now on; None reverts to the display arrays."""
 
-        self.ct_volume = ct_volume[::config.skip_size, ::config.skip_size, ::config.skip_size]
-        self.ct_volume_display = np.zeros(self.ct_volume.shape + (4,), dtype=np.ubyte)
-        self.gl_ct_volume.translate(self.ct_volume.shape[0]//2, self.ct_volume.shape[1]//2, self.ct_volume.shape[2]//2)
+        self.ct_pyramid = ct_pyramid
+        self.trace_pyramid = trace_pyramid
+        self.ct_texture = None
+        self.ct_texture_volume = None
+        self.ct_texture_trace = None
+        if self.ct_volume is None:
+            return
+
+        if ct_pyramid is None:
+            self.set_ct_box(union_box([bounding_box(self.ct_volume), bounding_box(self.ct_trace) if self.ct_trace is not None else None]))
         self.update_ct_volume()
 
+    def ct_texture_region(self):
+        """The pyramid level and the box (in full resolution voxels) of the X-ray CT texture.
+
+        The content box is shown at the finest level within the display budget, but not finer
+        than the display arrays. When zoomed in so that the view covers only a part of the
+        content box, that part is shown instead if a finer level of it fits in the budget.
+        """
+
+        budget = int(config.display_budget_mb*1024*1024)
+        content = expand_box(self.ct_box, self.ct_pyramid.shape, scale=config.skip_size)
+        level = self.ct_pyramid.level_for_budget(budget, content, bytes_per_voxel=4, minimum_factor=config.skip_size)
+
+        #// the view center and half of the view extent in display voxels; GL coordinates are s//2 minus the display voxel
+        half = self.opts['distance']*np.tan(np.deg2rad(self.opts['fov'])/2.)
+        center = [s//2-c for s, c in zip(self.ct_volume.shape, (self.opts['center'].x(), self.opts['center'].y(), self.opts['center'].z()))]
+        region = tuple([
+            slice(max(b.start, int(np.floor((c-half)*config.skip_size))), min(b.stop, int(np.ceil((c+half)*config.skip_size)))) 
+            for b, c in zip(content, center)
+        ])
+        if all([r.stop > r.start for r in region]) and region != content:
+            region_level = self.ct_pyramid.level_for_budget(budget, region, bytes_per_voxel=4)
+            if region_level < level:
+                return region_level, region
+
+        return level, content
+
+    def update_ct_detail(self):
+        if self.ct_pyramid is not None and self.ct_volume is not None and self.ct_texture_region() != self.ct_texture:
+            self.update_ct_volume()
+
+    def wheelEvent(self, ev):
+        super().wheelEvent(ev)
+        if self.ct_pyramid is not None:
+            self.detail_timer.start()
+
+    def mouseReleaseEvent(self, ev):
+        super().mouseReleaseEvent(ev)
+        if self.ct_pyramid is not None:
+            self.detail_timer.start()
+
     def set_pet_volume(self, pet_volume: Union[Volume, None]):
+        """Sets the PET volume, already rescaled to the display resolution (every skip_size-th voxel of the rescaled volume)."""
+
+        self.pet_points_floor = None
+        self.pet_points = None
+        self.pet_point_values = None
+
         if pet_volume is None:
+            self.pet_volume = None
+            self.pet_volume_display = None
+            self.pet_box = None
+            self.registrator.set_volume_shape(None)
             self.gl_pet_volume.setData(None)
+            self.gl_pet_points.setData(pos=np.zeros((0, 3), dtype=np.float32))
+            self.pyqtSignal_volumes_changed.emit()
             return
 
-        self.gl_pet_volume.resetTransform()
-        self.gl_pet_volume.scale(-1,-1,-1)
-
         ndary = pet_volume.ndary
         if ndary is not None:
-            self.pet_volume = ndary[::config.skip_size, ::config.skip_size, ::config.skip_size]
-            self.pet_volume_display = np.zeros(self.pet_volume.shape + (4,), dtype=np.ubyte)
-            self.gl_pet_volume.translate(self.pet_volume.shape[0]//2, self.pet_volume.shape[1]//2, self.pet_volume.shape[2]//2)
+            self.pet_volume = ndary
+            self.pet_volume_display = None
+            self.pet_box = expand_box(bounding_box(ndary, threshold=ndary.max()*config.crop_noise_ratio), ndary.shape, margin=config.crop_margin)
+            self.registrator.set_volume_shape(self.pet_volume.shape)
+            self.registrator.set_gl_offset(self.gl_pet_volume, [b.start for b in self.pet_box])
+            self.registrator.reset()
 
         self.update_pet_volume()
+        self.pyqtSignal_volumes_changed.emit()
 
-    def set_ct_trace(self, ct_trace: np.ndarray):
+    def set_ct_trace(self, ct_trace: np.ndarray, display: Union[np.ndarray, None]=None):
         if ct_trace is None:
-            ct_trace = None
+            self.ct_trace = None
+            self.pyqtSignal_volumes_changed.emit()
             return
 
-        self.ct_trace = ct_trace[::2, ::2, ::2]
+        self.ct_trace = display if display is not None else self.display_array(ct_trace)
+        if self.ct_volume is not None:
+            self.set_ct_box(union_box([bounding_box(self.ct_volume), bounding_box(self.ct_trace)]))
         self.update_ct_volume()
+        self.pyqtSignal_volumes_changed.emit()
 
     def ct_volume_intensity_changed(self, intensity: float):
         self.ct_volume_intensity = intensity
         self.update_ct_volume()
+        self.pyqtSignal_intensity_changed.emit()
 
     def pet_volume_intensity_changed(self, intensity: float):
         self.pet_volume_intensity = intensity
         self.update_pet_volume()
+        self.pyqtSignal_intensity_changed.emit()
 
     def ct_trace_intensity_changed(self, intensity: float):
         self.ct_trace_intensity = intensity
         self.update_ct_volume()
+        self.pyqtSignal_intensity_changed.emit()
+
+    def pet_display_mode_changed(self, points: bool):
+        self.pet_display_points = points
+        self.update_pet_volume()
+        self.pyqtSignal_intensity_changed.emit()
+
+    def pet_threshold_changed(self, threshold: int):
+        self.pet_threshold = threshold
+        self.update_pet_volume()
+        self.pyqtSignal_intensity_changed.emit()
 
     def update_pet_volume(self):
+        if self.pet_display_points:
+            #// release the dense texture; only the sparse arrays are kept
+            self.pet_volume_display = None
+            self.gl_pet_volume.setData(None)
+            self.update_pet_points()
+            self.paintGL()
+            return
+
+        self.gl_pet_points.setData(pos=np.zeros((0, 3), dtype=np.float32))
+        if self.pet_volume is not None and self.pet_volume_display is None:
+            self.pet_volume_display = np.zeros(tuple([b.stop-b.start for b in self.pet_box]) + (4,), dtype=np.ubyte)
+
         try:
-            self.pet_volume_display[...,0] = np.clip(self.pet_volume*self.pet_volume_intensity, 0, 255)
+            self.pet_volume_display[...,0] = scale_intensity(self.pet_volume[self.pet_box], self.pet_volume_intensity)
             self.pet_volume_display[...,1] = self.pet_volume_display[...,0]
             #self.pet_volume_display[...,2] = self.pet_volume_display[...,0]
-            self.pet_volume_display[...,3] = np.clip(((self.pet_volume_display[...,0]).astype(float) / 255.*2) **2 * 255, 0, 255)
+            self.pet_volume_display[...,3] = ALPHA_LUT[self.pet_volume_display[...,0]]
 
             self.gl_pet_volume.setData(self.pet_volume_display)
         except:
             pass
         self.paintGL()
 
+    def update_pet_points(self):
+        if self.pet_volume is None:
+            return
+
+        #// voxels are extracted again only if the threshold goes below the extracted range
+        if self.pet_points_floor is None or self.pet_threshold < self.pet_points_floor:
+            points = np.argwhere(self.pet_volume >= self.pet_threshold)
+            values = self.pet_volume[tuple(points.T)]
+            order = np.argsort(values)[::-1]
+            self.pet_points = (points[order]+0.5).astype(np.float32)
+            self.pet_point_values = values[order]
+            self.pet_points_floor = self.pet_threshold
+
+        count = len(self.pet_point_values)-np.searchsorted(self.pet_point_values[::-1], self.pet_threshold, side='left')
+        values = scale_intensity(self.pet_point_values[:count], self.pet_volume_intensity).astype(np.ubyte)
+
+        color = np.zeros((count, 4), dtype=np.float32)
+        color[:, 0] = values/255.
+        color[:, 1] = color[:, 0]
+        color[:, 3] = ALPHA_LUT[values]/255.
+        self.gl_pet_points.setData(pos=self.pet_points[:count], color=color)
+
+    def update_ct_texture(self):
+        """Read the X-ray CT texture and the trace mask from the pyramids if the region changed, and place the texture."""
+
+        level, box = self.ct_texture_region()
+        if (level, box) == self.ct_texture:
+            return
+
+        level_box = self.ct_pyramid.level_box(box, level)
+        self.ct_texture = (level, box)
+        self.ct_texture_volume = self.ct_pyramid.level(level)[level_box]
+        self.ct_texture_trace = self.trace_pyramid.level(level)[level_box] if self.trace_pyramid is not None and self.ct_trace is not None else None
+        self.ct_volume_display = np.zeros(self.ct_texture_volume.shape+(4,), dtype=np.ubyte)
+
+        #// a texel of level is level/skip_size display voxels, and is centered on the voxels it reduces
+        scale = level/config.skip_size
+        self.gl_ct_volume.resetTransform()
+        self.gl_ct_volume.scale(-scale,-scale,-scale)
+        self.gl_ct_volume.translate(*[s//2-(b.start*level+(level-1)/2.)/config.skip_size for s, b in zip(self.ct_volume.shape, level_box)])
+
     def update_ct_volume(self):
-        self.ct_volume_display[...,0] = np.clip(self.ct_volume*self.ct_volume_intensity, 0, 255)
+        if self.ct_volume is None:
+            return
+
+        if self.ct_pyramid is not None:
+            self.update_ct_texture()
+            ct_volume = self.ct_texture_volume
+            ct_trace = self.ct_texture_trace
+        else:
+            if self.ct_volume_display is None:
+                return
+            ct_volume = self.ct_volume[self.ct_box]
+            ct_trace = self.ct_trace[self.ct_box] if self.ct_trace is not None else None
+
+        self.ct_volume_display[...,0] = scale_intensity(ct_volume, self.ct_volume_intensity)
         self.ct_volume_display[...,1] = self.ct_volume_display[...,0]
         self.ct_volume_display[...,2] = self.ct_volume_display[...,0]
-        self.ct_volume_display[...,3] = np.clip(((self.ct_volume_display[...,1]).astype(float) / 255.*2) **2 * 255, 0, 255)
-
-        if self.ct_trace is not None:
-            self.ct_volume_display[...,0][self.ct_trace!=0] = np.clip(self.ct_volume[self.ct_trace!=0]*self.ct_trace_intensity, 0, 255)
-            self.ct_volume_display[...,1][self.ct_trace!=0] = self.ct_volume_display[...,0][self.ct_trace!=0]
-            self.ct_volume_display[...,2][self.ct_trace!=0] = self.ct_volume_display[...,0][self.ct_trace!=0]
-            self.ct_volume_display[...,3] = np.clip(((self.ct_volume_display[...,1]).astype(float) / 255.*2) **2 * 255, 0, 255)
+        self.ct_volume_display[...,3] = ALPHA_LUT[self.ct_volume_display[...,1]]
+
+        if ct_trace is not None:
+            trace_mask = ct_trace!=0
+            self.ct_volume_display[...,0][trace_mask] = scale_intensity(ct_volume[trace_mask], self.ct_trace_intensity)
+            self.ct_volume_display[...,1][trace_mask] = self.ct_volume_display[...,0][trace_mask]
+            self.ct_volume_display[...,2][trace_mask] = self.ct_volume_display[...,0][trace_mask]
+            self.ct_volume_display[...,3] = ALPHA_LUT[self.ct_volume_display[...,1]]
 
         self.gl_ct_volume.setData(self.ct_volume_display)
         self.paintGL()
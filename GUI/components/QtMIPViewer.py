@@ -0,0 +1,72 @@
+import numpy as np
+import pyqtgraph as pg
+from DATA import (PointProjector, RegistrationParameters,
+                  maximum_intensity_projections)
+from GUI.components import QtMain
+
+from .Qt3DViewer import Qt3DViewer, Registrator, scale_intensity
+
+
+class QtMIPViewer(pg.GraphicsLayoutWidget):
+    label = 'MIP viewer'
+    def __init__(self, parent: QtMain, threeD_viewer: Qt3DViewer):
+        """Orthogonal maximum intensity projections of the volumes shown in the 3D viewer.
+
+        The projections of the X-ray CT volume and the trace are computed once per volume.
+        On each registration, only the PET projections are updated, from the PET voxels
+        above the noise level, so that no OpenGL volume rendering is needed.
+        """
+
+        super().__init__(parent=parent)
+        self.threeD_viewer = threeD_viewer
+
+        self.ct_mips = None
+        self.trace_mips = None
+        self.pet_projector = None
+        self.pet_mips = None
+
+        self.image_items = []
+        for i, title in enumerate(['Top (Y-X)', 'Side (Z-X)', 'Side (Z-Y)']):
+            view_box = self.addViewBox(row=0, col=i, lockAspect=True, invertY=True)
+            image_item = pg.ImageItem(axisOrder='row-major')
+            view_box.addItem(image_item)
+            self.image_items.append(image_item)
+
+    def set_volumes(self):
+        viewer = self.threeD_viewer
+        self.ct_mips = maximum_intensity_projections(viewer.ct_volume) if viewer.ct_volume is not None else None
+        self.trace_mips = maximum_intensity_projections(viewer.ct_trace) if viewer.ct_trace is not None else None
+        self.pet_projector = PointProjector(viewer.pet_volume) if viewer.pet_volume is not None else None
+        self.pet_mips = None
+
+        self.update_pet(viewer.registrator)
+
+    def update_pet(self, registrator: Registrator):
+        if self.pet_projector is None or self.ct_mips is None:
+            self.pet_mips = None
+        else:
+            target_shape = self.threeD_viewer.ct_volume.shape
+            self.pet_mips = self.pet_projector.project(RegistrationParameters.from_registrator(registrator), target_shape, out=self.pet_mips)
+
+        self.update_images()
+
+    def update_images(self):
+        if self.ct_mips is None:
+            for image_item in self.image_items:
+                image_item.clear()
+            return
+
+        viewer = self.threeD_viewer
+        for i, image_item in enumerate(self.image_items):
+            gray = scale_intensity(self.ct_mips[i], viewer.ct_volume_intensity).astype(np.ubyte)
+            if self.trace_mips is not None:
+                trace_mask = self.trace_mips[i] != 0
+                gray[trace_mask] = scale_intensity(self.ct_mips[i][trace_mask], viewer.ct_trace_intensity)
+
+            rgb = np.repeat(gray[..., None], 3, axis=2)
+            if self.pet_mips is not None:
+                pet = scale_intensity(self.pet_mips[i], viewer.pet_volume_intensity).astype(np.ubyte)
+                np.maximum(rgb[..., 0], pet, out=rgb[..., 0])
+                np.maximum(rgb[..., 1], pet, out=rgb[..., 1])
+
+            image_item.setImage(rgb, levels=(0, 255))
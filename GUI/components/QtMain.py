@@ -1,19 +1,29 @@
 import json
 import logging
 import os
-from copy import deepcopy
-from typing import List
+import threading
+from typing import Callable, List, Tuple, Union
 
 import config
 import numpy as np
-from DATA import File, RSA_Vector, Trace
+from DATA import (AlignmentScore, ChunkedVolume, File, RegistrationParameters,
+                  RegistrationTransform, RSA_Vector, SampleCache, Session,
+                  Trace, allocate_volume, build_pyramids,
+                  estimate_sample_nbytes, expand_box, export_registered,
+                  find_samples, fit_points, held_nbytes, load_checkpoint,
+                  load_checkpoint_array, pet_hotspots, pyramid_jobs,
+                  read_uint8_frames, read_uint8_volume, read_volume_file,
+                  release_frames, release_pages, rescale_volume, rinfo_hash,
+                  root_points, root_uptake, save_checkpoint, save_registration,
+                  save_root_uptake, search_flip_rotation, slab_size)
 from DATA.RSA.components.volume import Volume
-from PyQt5.QtCore import Qt, QThread
-from PyQt5.QtWidgets import QApplication, QMainWindow, QMessageBox, QSplitter
-from scipy.ndimage import rotate
-from skimage import exposure, io, transform
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QMessageBox, QSplitter,
+                             QStackedWidget)
+from skimage import io
 
 from .Qt3DViewer import Qt3DViewer, Registrator
+from .QtMIPViewer import QtMIPViewer
 from .QtOptions import QtOptions
 from .QtStatusBar import QtStatusBarW
 
@@ -27,17 +37,137 @@ class GUI_Components(object):
 
 
 class Data(object):
+    """The owner of the loaded sample.
+
+    Full-resolution arrays are owned by Data only. The viewer and the exporter
+    receive read-only views of them and never copy them, so releasing a volume
+    here releases its memory once the views are dropped.
+
+    The viewer shows the PET volume rescaled straight to its display resolution.
+    The full resolution rescaled PET volume is never kept; the threads that need
+    it (search and export) compute it from the original PET volume and drop it.
+
+    When another sample is opened, Data is kept in the sample cache as a whole,
+    with the registration and the display arrays of the viewer.
+    """
+
     def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
         self.file = File()
         self.ct_volume = Volume()
         self.pet_volume = Volume()
-        self.pet_volume_rescaled = Volume()
+        self.pet_volume_preview = Volume()
+        self.pet_frames = None
+        self.pet_frame_names = []
+        self.pet_frame_index = 0
         self.rinfo = RSA_Vector()
+        self.rinfo_loaded = False
         self.ct_trace = Trace()
+        #// chunked multi-resolution copies on the disk; opened or built after loading
+        self.ct_pyramid = None
+        self.trace_pyramid = None
+        self.pet_pyramid = None
+        #// set while the sample is in the cache
+        self.signature = None
+        self.registration = None
+        self.display_arrays = (None, None)
 
     def clear_volumes(self):
         self.ct_volume.clear()
         self.pet_volume.clear()
+        self.pet_volume_preview.clear()
+        self.ct_trace.clear()
+        self.set_pet_frames(None, [])
+        self.ct_pyramid = None
+        self.trace_pyramid = None
+        self.pet_pyramid = None
+        self.registration = None
+        self.display_arrays = (None, None)
+
+    def nbytes(self):
+        """Bytes held by the sample, as counted by the sample cache."""
+
+        trace = self.ct_trace.trace3D.volume if not self.ct_trace.is_empty() else None
+        arrays = [self.ct_volume.ndary, self.pet_volume.ndary, self.pet_volume_preview.ndary, self.pet_frames, trace]
+        return held_nbytes(arrays+list(self.display_arrays))
+
+    def pyramid_jobs(self):
+        """(name, directory, volume, signature, reduction) of the volumes to be kept as pyramids."""
+
+        trace = self.ct_trace.trace3D if self.ct_trace.is_drawn() else None
+        pet = self.pet_volume.ndary if not self.pet_volume.is_empty() and self.pet_frames is None else None
+        return pyramid_jobs(self.file, self.ct_volume.full_ndarray(), trace=trace, pet=pet)
+
+    def load_rinfo_from_dict(self, rinfo_dict: dict, file: str='', progress: Union[Callable, None]=None):
+        """Loads the rinfo and draws its roots into the CT trace, which has to be initialized from the X-ray CT volume.
+
+        The drawn trace is saved in [volume_name]_trace/ and read from there while the rinfo
+        content, the X-ray CT shape and the pen size are unchanged.
+        """
+
+        ret = self.rinfo.load_from_dict(rinfo_dict, file=file)
+        if ret == False:
+            return False
+
+        directory = self.file.trace_directory if self.file.is_valid() else ''
+        if not self.ct_trace.draw_rinfo(self.rinfo, rinfo_hash(rinfo_dict), directory=directory, progress=progress):
+            return False
+
+        self.rinfo_loaded = True
+        return True
+
+    def load_pet(self, progress: Union[Callable, None]=None):
+        """Reads the PET volume, or all frames of a dynamic PET volume, from the PET directory."""
+
+        frame_directories = self.file.pet_frame_directories()
+        pet_files = [File(volume_directory=d) for d in frame_directories] if len(frame_directories) != 0 else [File(volume_directory=self.file.pet_directory())]
+        for pet_file in pet_files:
+            if not pet_file.is_valid():
+                self.logger.error(f'[Loading error] {pet_file.directory}')
+                self.logger.error(f'At least 64 slice images required.')
+                return False
+
+        if len(frame_directories) != 0:
+            #// a dynamic PET volume: all frames are kept memory-mapped and one of them is shown
+            frames = read_uint8_frames(
+                [pet_file.volume_source() for pet_file in pet_files],
+                clip_percentile=config.pet_clip_percentile,
+                progress=progress
+            )
+            self.set_pet_frames(frames, [os.path.basename(d) for d in frame_directories])
+            self.logger.info(f'[Dynamic PET] {len(frame_directories)} frames')
+        else:
+            pet_volume = read_uint8_volume(
+                pet_files[0].volume_source(),
+                clip_percentile=config.pet_clip_percentile,
+                progress=progress
+            )
+            self.pet_volume.init_from_volume(pet_volume)
+        self.pet_volume.resolution = self.ct_volume.resolution
+
+        return True
+
+    def apply_checkpoint(self, state: dict):
+        """Takes the resolutions and the PET frame of a checkpoint (see QtMain.save_checkpoint()), once the PET volume is loaded."""
+
+        self.ct_volume.resolution = state['ct_resolution']
+        self.pet_volume.resolution = state['pet_resolution']
+        if self.pet_frames is not None and 0 <= state.get('pet_frame_index', 0) < len(self.pet_frames):
+            self.select_pet_frame(state['pet_frame_index'])
+        self.registration = RegistrationParameters.from_dict(state['parameters'])
+
+    def set_pet_frames(self, frames: Union[np.memmap, None], names: List[str]):
+        """Set the frames of a dynamic PET volume; the first one becomes pet_volume."""
+
+        release_frames(self.pet_frames)
+        self.pet_frames = frames
+        self.pet_frame_names = names
+        if frames is not None:
+            self.select_pet_frame(0)
+
+    def select_pet_frame(self, index: int):
+        self.pet_frame_index = index
+        self.pet_volume.init_from_volume(self.pet_frames[index])
 
     def rescale_pet_volume(self):
         ct_resolution = self.ct_volume.resolution
@@ -45,17 +175,14 @@ class Data(object):
 
         self.pet_volume.scaling_factor = pet_resolution / ct_resolution
 
-        pet_shape = self.pet_volume.shape()
-        assert pet_shape is not None
-        resized_shape = [int(s*self.pet_volume.scaling_factor) for s in pet_shape]
-        rescaled_ndarray = exposure.rescale_intensity(
-            transform.resize(self.pet_volume.ndary, resized_shape),
-            out_range=np.uint8
-        )
+        #// only the voxels shown in the viewer are interpolated
+        self.pet_volume_preview.clear()
+        self.pet_volume_preview.init_from_volume(self.pet_volume.get_rescaled_ndarray(step=config.skip_size))
 
-        self.pet_volume_rescaled.init_from_volume(rescaled_ndarray)
+        return self.pet_volume_preview
 
-        return self.pet_volume_rescaled
+    def rescaled_pet_shape(self):
+        return self.pet_volume.rescaled_shape()
 
 class QtMain(QMainWindow):
     def __init__(self):
@@ -65,15 +192,43 @@ class QtMain(QMainWindow):
         self.GUI_components = GUI_Components(self)
 
         self.threeD_viewer = Qt3DViewer(parent=self)
+        self.mip_viewer = QtMIPViewer(parent=self, threeD_viewer=self.threeD_viewer)
+
+        self.viewer_stack = QStackedWidget()
+        self.viewer_stack.addWidget(self.threeD_viewer)
+        self.viewer_stack.addWidget(self.mip_viewer)
 
         self.main_splitter = QSplitter(Qt.Horizontal)
-        self.main_splitter.addWidget(self.threeD_viewer)
+        self.main_splitter.addWidget(self.viewer_stack)
         self.main_splitter.addWidget(self.GUI_components.options)
         self.setCentralWidget(self.main_splitter)
 
         self.resize(800,800)
         self.setAcceptDrops(True)
         self.data = Data()
+        self.floader = None
+        self.pyramid_builder = None
+        self.sample_loaded = False
+        self.sample_cache = SampleCache(int(config.sample_cache_mb*1024*1024), release=self.release_sample)
+        #// samples dropped while an export still reads their PET frames
+        self.pending_releases = []
+        self.volume_exporters = []
+        self.session = None
+        self.prefetcher = None
+        #// the state of the current sample is saved shortly after each change, and restored on reopening
+        self.checkpoint = None
+        self.checkpoint_arrays = {}
+        self.checkpoint_timer = QTimer(self)
+        self.checkpoint_timer.setSingleShot(True)
+        self.checkpoint_timer.setInterval(1000)
+        self.checkpoint_timer.timeout.connect(self.save_checkpoint)
+
+        self.alignment_scorer = AlignmentScorer()
+        self.alignment_scorer.pyqtSignal_scored.connect(self.on_alignment_scored)
+        self.alignment_scorer.start()
+        self.threeD_viewer.pyqtSignal_volumes_changed.connect(self.on_viewer_volumes_changed)
+        self.threeD_viewer.registrator.add_callback(self.on_registrated)
+        self.threeD_viewer.pyqtSignal_intensity_changed.connect(self.on_viewer_intensity_changed)
         
         self.__control_locked = False
         self.setStatusBar(self.GUI_components.statusbar.widget)
@@ -93,8 +248,31 @@ class QtMain(QMainWindow):
             self.logger.error('Only 1 directory at once is acceptable.')
             return
 
+        #// a folder of samples opens a session
+        if not File(volume_directory=flist[0]).is_valid() and len(find_samples(flist[0])) != 0:
+            self.open_session(directory=flist[0])
+            return
+
         self.load_from(directory=flist[0])
 
+    def open_session(self, directory: str):
+        """Opens a folder of samples and loads the first one. While a sample is aligned, the next one is prefetched into the sample cache."""
+
+        session = Session(directory)
+        if len(session) == 0:
+            self.logger.error(f'[Session error] No sample found in {directory}')
+            return False
+
+        self.stop_prefetcher()
+        self.session = session
+        self.GUI_components.options.session_group.set_samples([os.path.basename(s) for s in session.samples])
+        return self.open_session_sample(0)
+
+    def open_session_sample(self, index: int):
+        if self.session is None or not 0 <= index < len(self.session):
+            return False
+        return self.load_from(self.session.samples[index])
+
     def load_from(self, directory: str):
         VolumeFile = File(volume_directory=directory)
         if not VolumeFile.is_valid():
@@ -102,35 +280,256 @@ class QtMain(QMainWindow):
             self.logger.error(f'At least 64 slice images required.')
             return False
 
-        self.data.clear_volumes()
-        self.data.file = VolumeFile
-        flist = self.data.file.image_files()
-        self.set_control(locked=True)
+        if self.session is not None:
+            self.session.index = self.session.index_of(directory)
+            self.GUI_components.options.session_group.set_current(self.session.index)
+
+        if self.checkpoint_timer.isActive():
+            self.save_checkpoint()
+        self.checkpoint = None
+        self.checkpoint_arrays = {}
+
+        #// the sample being prefetched is waited for, as it is partly loaded already; any other prefetch is dropped
+        if self.prefetcher is not None and os.path.abspath(self.prefetcher.directory) == os.path.abspath(directory):
+            self.prefetcher.wait()
+            self.cache_prefetched_sample()
+        else:
+            self.stop_prefetcher()
 
+        self.stop_pyramid_builder()
+        #// a sample that is not fully loaded yet is not worth keeping
+        if self.sample_loaded and self.data.ct_volume.is_fully_loaded():
+            self.cache_sample()
+        else:
+            self.release_sample(self.data)
+        self.stop_volume_loader()
+
+        #// drop the viewer buffers so that an evicted sample is released
+        self.sample_loaded = False
+        self.threeD_viewer.set_ct_pyramid(None, None)
         self.threeD_viewer.set_ct_volume(None)
         self.threeD_viewer.set_ct_trace(None)
         self.threeD_viewer.set_pet_volume(None)
 
-        self.data.rinfo = RSA_Vector()
-        self.data.ct_trace = Trace()
+        signature = VolumeFile.sample_signature()
+        cached = self.sample_cache.pop(os.path.abspath(directory), signature)
+        if cached is not None:
+            self.restore_sample(cached)
+            return True
 
-        self.floader = VolumeLoader(flist, progressbar_signal=self.GUI_components.statusbar.pyqtSignal_update_progressbar)
-        self.floader.finished.connect(self.on_volume_loaded)
+        self.data = Data()
+        self.data.file = VolumeFile
+        self.data.signature = signature
+        noise_files = self.data.file.noise_files()
+        if len(noise_files) != 0:
+            self.logger.warning(f'{len(noise_files)} non-slice files ignored in {directory}')
+        self.set_control(locked=True)
+
+        self.checkpoint = load_checkpoint(VolumeFile.checkpoint_directory, signature)
+        if self.checkpoint is not None:
+            self.resume_from_checkpoint()
+
+        self.floader = VolumeLoader(self.data.file, progressbar_signal=self.GUI_components.statusbar.pyqtSignal_update_progressbar)
+        self.floader.pyqtSignal_preview_loaded.connect(self.on_volume_loaded)
+        self.floader.finished.connect(self.on_volume_fully_loaded)
         self.floader.start()
 
+    def stop_volume_loader(self):
+        if self.floader is None:
+            return
+
+        self.floader.requestInterruption()
+        self.floader.wait()
+        self.floader = None
+
+    def cache_sample(self):
+        """Keeps the current sample in the sample cache, with the registration and the display arrays of the viewer."""
+
+        self.data.registration = RegistrationParameters.from_registrator(self.threeD_viewer.registrator)
+        self.data.display_arrays = (self.threeD_viewer.ct_volume, self.threeD_viewer.ct_trace)
+        self.sample_cache.put(os.path.abspath(self.data.file.directory), self.data.signature, self.data, self.data.nbytes())
+
+    def release_sample(self, data: Data):
+        """Releases a sample that is neither shown nor cached; its PET frames are kept until the exports reading them finish."""
+
+        if data.pet_frames is not None and any([e.frames is data.pet_frames for e in self.volume_exporters]):
+            self.pending_releases.append(data)
+            return
+        data.clear_volumes()
+
+    def start_prefetcher(self):
+        #// once the current sample is loaded, so that the prefetch does not delay it
+        if self.session is None or not self.sample_loaded or self.floader is not None or self.prefetcher is not None:
+            return
+
+        directory = self.session.next_sample()
+        if directory == '' or os.path.abspath(directory) in self.sample_cache:
+            return
+
+        nbytes = estimate_sample_nbytes(directory)
+        if nbytes > self.sample_cache.budget:
+            self.logger.info(f'[Prefetch skipped] {directory} ({nbytes/1024/1024:.0f} MB) does not fit in the sample cache')
+            return
+
+        self.prefetcher = SamplePrefetcher(directory)
+        self.prefetcher.finished.connect(self.on_sample_prefetched)
+        self.prefetcher.start()
+
+    def stop_prefetcher(self):
+        if self.prefetcher is None:
+            return
+
+        self.prefetcher.requestInterruption()
+        self.prefetcher.wait()
+        if self.prefetcher.data is not None:
+            self.release_sample(self.prefetcher.data)
+        self.prefetcher = None
+
+    def on_sample_prefetched(self):
+        if self.prefetcher is None or self.sender() is not self.prefetcher:
+            return
+        self.cache_prefetched_sample()
+
+    def cache_prefetched_sample(self):
+        prefetcher, self.prefetcher = self.prefetcher, None
+        data = prefetcher.data
+        if data is None:
+            return
+
+        self.logger.info(f'[Prefetched] {data.file.directory}')
+        self.sample_cache.put(os.path.abspath(data.file.directory), data.signature, data, data.nbytes())
+
+    def request_checkpoint(self):
+        if self.sample_loaded:
+            self.checkpoint_timer.start()
+
+    def save_checkpoint(self):
+        """Saves the state of the current sample to [volume_name]_checkpoint/: the resolutions, the
+        registration, the intensities, what was imported, and the display arrays of the viewer.
+
+        Only the display arrays that changed since the last save are written.
+        """
+
+        self.checkpoint_timer.stop()
+        if not self.sample_loaded:
+            return
+
+        viewer = self.threeD_viewer
+        intensity = self.GUI_components.options.intensity_group
+        state = {
+            'signature': self.data.signature,
+            'rinfo': self.data.rinfo_loaded,
+            'pet': not self.data.pet_volume.is_empty(),
+            'ct_resolution': self.data.ct_volume.resolution,
+            'pet_resolution': self.data.pet_volume.resolution,
+            'pet_frame_index': self.data.pet_frame_index,
+            'parameters': RegistrationParameters.from_registrator(viewer.registrator).dictionary(),
+            'intensity': {
+                'ct': intensity.ct_slider.value(),
+                'trace': intensity.trace_slider.value(),
+                'pet': intensity.pet_slider.value(),
+                'pet_points': intensity.checkbox_pet_points.isChecked(),
+                'pet_threshold': intensity.pet_threshold_slider.value(),
+            },
+        }
+        arrays = {'ct_display': viewer.ct_volume, 'trace_display': viewer.ct_trace, 'pet_preview': viewer.pet_volume}
+        arrays = {name: ndarray for name, ndarray in arrays.items() if name not in self.checkpoint_arrays or self.checkpoint_arrays[name] is not ndarray}
+
+        try:
+            save_checkpoint(self.data.file.checkpoint_directory, state, arrays)
+        except OSError as e:
+            self.logger.warning(f'[Checkpoint not saved] {self.data.file.checkpoint_directory}: {e}')
+            return
+        self.checkpoint_arrays.update(arrays)
+
+    def resume_from_checkpoint(self):
+        """Shows the display arrays and the settings of the checkpoint at once, while the volumes are loaded."""
+
+        directory = self.data.file.checkpoint_directory
+        ct_display = load_checkpoint_array(directory, self.checkpoint, 'ct_display')
+        if ct_display is None:
+            return
+
+        self.logger.info(f'[Resumed from the checkpoint] {directory}')
+        self.threeD_viewer.set_ct_volume(ct_display, display=ct_display)
+        trace_display = load_checkpoint_array(directory, self.checkpoint, 'trace_display')
+        if trace_display is not None:
+            self.threeD_viewer.set_ct_trace(trace_display, display=trace_display)
+        pet_preview = load_checkpoint_array(directory, self.checkpoint, 'pet_preview')
+        if pet_preview is not None:
+            preview = Volume()
+            preview.init_from_volume(pet_preview)
+            self.threeD_viewer.set_pet_volume(preview)
+        self.apply_checkpoint_settings(self.checkpoint)
+
+    def apply_checkpoint_settings(self, state: dict):
+        options = self.GUI_components.options
+        parameters = RegistrationParameters.from_dict(state['parameters'])
+        options.flip_group.set_flip_states(x_flip=parameters.x_flip==-1, y_flip=parameters.y_flip==-1, z_flip=parameters.z_flip==-1)
+        options.registration_group.set_values(parameters.x, parameters.y, parameters.z, parameters.angle)
+
+        intensity = state.get('intensity', {})
+        for slider, key in [(options.intensity_group.ct_slider, 'ct'), (options.intensity_group.trace_slider, 'trace'), (options.intensity_group.pet_slider, 'pet'), (options.intensity_group.pet_threshold_slider, 'pet_threshold')]:
+            if key in intensity and slider.value() != intensity[key]:
+                slider.setValue(intensity[key])
+                slider.value_changed()
+        if 'pet_points' in intensity:
+            options.intensity_group.checkbox_pet_points.setChecked(intensity['pet_points'])
+
+    def ask_import(self, name: str, text: str):
+        #// a sample resumed from a checkpoint imports what it imported before
+        if self.checkpoint is not None:
+            return self.checkpoint.get(name, False)
+        return QMessageBox.information(None, "Information", text, QMessageBox.Yes, QMessageBox.No) == QMessageBox.Yes
+
+    def restore_sample(self, data: Data):
+        """Shows a sample taken out of the sample cache as it was left, without reading its files again."""
+
+        self.data = data
+        self.logger.info(f'[Restored from the cache] {data.file.directory}')
+
+        ct_display, trace_display = data.display_arrays
+        data.display_arrays = (None, None)
+        self.threeD_viewer.set_ct_volume(data.ct_volume.ndary, display=ct_display)
+        if data.ct_trace.is_drawn():
+            self.threeD_viewer.set_ct_trace(data.ct_trace.trace3D.volume[..., 1], display=trace_display)
+        if not data.pet_volume_preview.is_empty():
+            self.threeD_viewer.set_pet_volume(data.pet_volume_preview)
+
+        options = self.GUI_components.options
+        options.frame_group.set_frame_count(len(data.pet_frame_names), index=data.pet_frame_index)
+        if data.registration is not None:
+            parameters = data.registration
+            data.registration = None
+            options.flip_group.set_flip_states(x_flip=parameters.x_flip==-1, y_flip=parameters.y_flip==-1, z_flip=parameters.z_flip==-1)
+            options.registration_group.set_values(parameters.x, parameters.y, parameters.z, parameters.angle)
+        options.update_valid_option()
+
+        self.setWindowTitle()
+        self.show_default_msg_in_statusbar()
+        self.sample_loaded = True
+        if data.ct_pyramid is not None:
+            self.threeD_viewer.set_ct_pyramid(data.ct_pyramid, data.trace_pyramid)
+        else:
+            self.start_pyramid_builder()
+        self.start_prefetcher()
+
     def on_volume_loaded(self):
+        #// only the slices shown in the viewer are decoded here; the rest are filled in by the loader in the background
         volume = self.floader.data()
-        del self.floader
 
-        self.logger.info(f'[Loading succeeded] {self.data.file.directory}')
+        self.logger.info(f'[Preview loaded] {self.data.file.directory}')
 
-        self.data.ct_volume.init_from_volume(volume=volume)
+        self.data.ct_volume.init_from_volume(volume=volume, loader=self.floader)
         self.data.ct_trace.init_from_volume(volume=volume)
-        self.threeD_viewer.set_ct_volume(volume)
+        #// the display array of the checkpoint is the same as the one of the volume, and is not copied again
+        display = self.threeD_viewer.ct_volume if self.checkpoint is not None else None
+        if display is not None and display.shape != tuple([-(-s//config.skip_size) for s in volume.shape]):
+            display = None
+        self.threeD_viewer.set_ct_volume(volume, display=display)
 
         if self.data.file.is_rinfo_file_available():
-            ret = QMessageBox.information(None, "Information", "The rinfo file is available. Do you want to import this?", QMessageBox.Yes, QMessageBox.No)
-            if ret == QMessageBox.Yes:
+            if self.ask_import('rinfo', "The rinfo file is available. Do you want to import this?"):
                 loaded = self.load_rinfo(fname=self.data.file.rinfo_file)
                 if loaded:
                     trace_object = self.data.ct_trace.trace3D
@@ -142,22 +541,14 @@ class QtMain(QMainWindow):
                     self.data.ct_volume.resolution = self.data.rinfo.annotations.resolution()
 
         if os.path.isdir(self.data.file.pet_directory()):
-            ret = QMessageBox.information(None, "Information", "The PET directory is found. Do you want to import this?", QMessageBox.Yes, QMessageBox.No)
-            if ret == QMessageBox.Yes:
-                pet_file = File(volume_directory=self.data.file.pet_directory())
-                if not pet_file.is_valid():
-                    self.logger.error(f'[Loading error] {self.data.file.pet_directory()}')
-                    self.logger.error(f'At least 64 slice images required.')
+            if self.ask_import('pet', "The PET directory is found. Do you want to import this?"):
+                if not self.data.load_pet(progress=self.GUI_components.statusbar.pyqtSignal_update_progressbar.emit):
                     return False
+                if self.checkpoint is not None:
+                    self.data.apply_checkpoint(self.checkpoint)
+                self.GUI_components.options.frame_group.set_frame_count(len(self.data.pet_frame_names), index=self.data.pet_frame_index)
 
-                pet_volume = [io.imread(f) for f in pet_file.image_files()]
-                pet_volume = np.asarray(pet_volume)
-                pet_volume = exposure.rescale_intensity(pet_volume, out_range=np.uint8)
-                self.data.pet_volume.init_from_volume(pet_volume)
-                self.data.pet_volume.resolution = self.data.ct_volume.resolution
-
-                #self.data.rescale_pet_volume()
-                self.threeD_viewer.set_pet_volume(self.data.pet_volume)
+                self.threeD_viewer.set_pet_volume(self.data.rescale_pet_volume())
 
         self.GUI_components.options.update_valid_option()
 
@@ -165,6 +556,56 @@ class QtMain(QMainWindow):
         self.set_control(locked=False)
         self.setWindowTitle()
         self.show_default_msg_in_statusbar()
+        self.sample_loaded = True
+        if self.checkpoint is not None:
+            self.apply_checkpoint_settings(self.checkpoint)
+            self.checkpoint = None
+        self.request_checkpoint()
+        self.start_pyramid_builder()
+        self.start_prefetcher()
+
+    def on_volume_fully_loaded(self):
+        if self.floader is None or self.sender() is not self.floader or self.floader.isInterruptionRequested():
+            return
+
+        self.floader = None
+        self.logger.info(f'[Loading succeeded] {self.data.file.directory}')
+        if not self.is_control_locked():
+            self.show_default_msg_in_statusbar()
+        self.start_pyramid_builder()
+        self.start_prefetcher()
+
+    def start_pyramid_builder(self):
+        #// once the full resolution volume, the trace and the PET volume are all loaded
+        if not config.build_pyramid or not self.sample_loaded or self.floader is not None or self.pyramid_builder is not None:
+            return
+
+        self.pyramid_builder = PyramidBuilder(self.data.pyramid_jobs(), self.GUI_components.statusbar.pyqtSignal_update_progressbar)
+        self.pyramid_builder.finished.connect(self.on_pyramids_built)
+        self.pyramid_builder.start()
+
+    def stop_pyramid_builder(self):
+        if self.pyramid_builder is None:
+            return
+
+        self.pyramid_builder.requestInterruption()
+        self.pyramid_builder.wait()
+        self.pyramid_builder = None
+
+    def on_pyramids_built(self):
+        if self.pyramid_builder is None or self.sender() is not self.pyramid_builder or self.pyramid_builder.isInterruptionRequested():
+            return
+
+        pyramids = self.pyramid_builder.pyramids
+        self.pyramid_builder = None
+        self.data.ct_pyramid = pyramids.get('ct')
+        self.data.trace_pyramid = pyramids.get('trace')
+        self.data.pet_pyramid = pyramids.get('pet')
+        self.logger.info(f'[Pyramids ready] {", ".join(sorted(pyramids.keys()))}')
+
+        self.threeD_viewer.set_ct_pyramid(self.data.ct_pyramid, self.data.trace_pyramid)
+        if not self.is_control_locked():
+            self.show_default_msg_in_statusbar()
 
     def setWindowTitle(self):
         text = f'{config.application_name} (version {config.version_string()})'
@@ -195,21 +636,7 @@ class QtMain(QMainWindow):
         self.GUI_components.statusbar.set_main_message(msg)
 
     def load_rinfo_from_dict(self, rinfo_dict: dict, file: str = ""):
-        rinfo = self.data.rinfo
-        ret = rinfo.load_from_dict(rinfo_dict, file=file)
-        if ret == False:
-            return False
-
-        base_node = rinfo.base_node(1)
-        if base_node is None:
-            return False
-
-        total = base_node.child_count()
-        for i, root_node in enumerate(base_node.child_nodes()):
-            self.GUI_components.statusbar.pyqtSignal_update_progressbar.emit(i, total, 'Making trace volume')
-            self.data.ct_trace.draw_trace(root_node=root_node)
-
-        return True
+        return self.data.load_rinfo_from_dict(rinfo_dict, file=file, progress=self.GUI_components.statusbar.pyqtSignal_update_progressbar.emit)
 
     def load_rinfo(self, fname: str):
         with open(fname, 'r') as f:
@@ -219,107 +646,477 @@ class QtMain(QMainWindow):
 
     def export_volume(self):
         ct_volume = self.data.ct_volume
-        pet_volume = self.data.pet_volume_rescaled
+        pet_volume = self.data.pet_volume
         registrator = self.threeD_viewer.registrator
 
-        ct_ndarray = ct_volume.ndary
         ndarray = pet_volume.ndary
-        if ndarray is None or ct_ndarray is None:
+        if ndarray is None or ct_volume.is_empty():
             return
+        ct_ndarray = ct_volume.full_ndarray()
+
+        self.save_registration_parameters()
 
-        self.set_control(True)
         dest = self.data.file.registrated_pet_directory()
-        self.volume_exporter = VolumeExporter(ndarray, registrator, dest, ct_ndarray.shape, self.GUI_components.statusbar.pyqtSignal_update_progressbar)
-        self.volume_exporter.finished.connect(self.on_volume_exported)
-        self.volume_exporter.start()
+        #// the box of the viewer covers every skip_size-th voxel; the margin covers the voxels in between
+        box = None
+        if self.GUI_components.options.export_group.checkbox_crop.isChecked():
+            box = expand_box(self.threeD_viewer.ct_box, ct_ndarray.shape, margin=config.skip_size, scale=config.skip_size)
+
+        voxel_size = self.GUI_components.options.export_group.voxel_size(self.data.ct_volume.resolution, self.data.pet_volume.resolution)
+        #// the export runs in the background, also while the next samples are opened
+        volume_exporter = VolumeExporter(
+            ndarray, self.data.rescaled_pet_shape(), registrator, dest, ct_ndarray.shape, self.GUI_components.statusbar.pyqtSignal_update_progressbar,
+            box=box, voxel_scale=voxel_size/self.data.ct_volume.resolution, ct_resolution=self.data.ct_volume.resolution,
+            frames=self.data.pet_frames, frame_names=self.data.pet_frame_names,
+            source=self.data.pet_pyramid.level(1) if self.data.pet_pyramid is not None else None
+        )
+        volume_exporter.finished.connect(self.on_volume_exported)
+        self.volume_exporters.append(volume_exporter)
+        volume_exporter.start()
+        self.logger.info(f'[Export started] {dest}')
 
         return
 
-    def on_volume_exported(self):
-        print("Finished")
+    def select_pet_frame(self, index: int):
+        if self.data.pet_frames is None or not 0 <= index < len(self.data.pet_frames):
+            return
+
+        self.set_control(True)
+        self.data.select_pet_frame(index)
+        #// the viewer holds a view of the previous preview; drop it so both are not resident at once
+        self.threeD_viewer.set_pet_volume(None)
+        self.threeD_viewer.set_pet_volume(self.data.rescale_pet_volume())
         self.set_control(False)
-        self.setWindowTitle()
+
+    def save_registration_parameters(self):
+        if self.data.pet_volume.is_empty() or self.data.ct_volume.is_empty():
+            return
+
+        parameters = RegistrationParameters.from_registrator(self.threeD_viewer.registrator)
+        save_registration(self.data.file.registration_file, self.data.ct_volume.resolution, self.data.pet_volume.resolution, parameters)
+        self.logger.info(f'[Registration saved] {self.data.file.registration_file} ({parameters})')
+
+    def search_registration(self):
+        if self.data.pet_volume.is_empty() or self.data.ct_volume.is_empty():
+            return
+
+        self.set_control(True)
+        #// the trace matches the PET signal of roots better than the CT intensity does
+        trace_object = self.data.ct_trace.trace3D
+        if self.data.ct_trace.is_drawn():
+            reference = trace_object.volume[..., 0]
+        else:
+            reference = self.data.ct_volume.full_ndarray()
+
+        self.registration_searcher = RegistrationSearcher(reference, self.data.pet_volume.ndary, self.data.rescaled_pet_shape(), self.GUI_components.statusbar.pyqtSignal_update_progressbar)
+        self.registration_searcher.finished.connect(self.on_registration_searched)
+        self.registration_searcher.start()
+
+    def on_registration_searched(self):
+        candidates = self.registration_searcher.candidates
+        del self.registration_searcher
+
+        for score, parameters in candidates:
+            self.logger.info(f'[Candidate] {score:.3f} {parameters}')
+
+        self.set_control(False)
+        self.GUI_components.options.search_group.set_candidates(candidates)
         self.show_default_msg_in_statusbar()
 
+    def fit_registration_to_trace(self):
+        if self.data.pet_volume.is_empty() or self.data.ct_volume.is_empty():
+            return
+
+        target_points = root_points(self.data.rinfo)
+        if len(target_points) == 0:
+            self.logger.error('No root trace is available.')
+            return
+
+        self.set_control(True)
+        pet_shape = self.data.pet_volume.shape()
+        rescaled_shape = self.data.rescaled_pet_shape()
+        source_points = pet_hotspots(self.data.pet_volume.ndary, zoom=[r/s for r, s in zip(rescaled_shape, pet_shape)])
+
+        registrator = self.threeD_viewer.registrator
+        distance, parameters = fit_points(
+            source_points, target_points, rescaled_shape, self.data.ct_volume.shape(),
+            initial=RegistrationParameters.from_registrator(registrator),
+            search_flips=self.GUI_components.options.search_group.checkbox_search_flips.isChecked()
+        )
+        self.logger.info(f'[Point fitting] {len(source_points)} PET hotspots, {len(target_points)} trace points, mean distance {distance:.2f} voxels: {parameters}')
+
+        options = self.GUI_components.options
+        options.flip_group.set_flip_states(x_flip=parameters.x_flip==-1, y_flip=parameters.y_flip==-1, z_flip=parameters.z_flip==-1)
+        options.registration_group.set_values(parameters.x, parameters.y, parameters.z, parameters.angle)
+        self.set_control(False)
+
+    def set_mip_view(self, enabled: bool):
+        self.viewer_stack.setCurrentWidget(self.mip_viewer if enabled else self.threeD_viewer)
+        if enabled:
+            self.mip_viewer.set_volumes()
+
+    def is_mip_view(self):
+        return self.viewer_stack.currentWidget() is self.mip_viewer
+
+    def on_viewer_intensity_changed(self):
+        if self.is_mip_view():
+            self.mip_viewer.update_images()
+        self.request_checkpoint()
+
+    def on_viewer_volumes_changed(self):
+        #// the score is computed on the subsampled arrays of the viewer, in display voxels
+        viewer = self.threeD_viewer
+        if self.is_mip_view():
+            self.mip_viewer.set_volumes()
+        self.request_checkpoint()
+
+        if viewer.pet_volume is None or viewer.ct_volume is None:
+            self.alignment_scorer.set_alignment_score(None)
+            return
+
+        if viewer.ct_trace is not None and viewer.ct_trace.any():
+            alignment_score = AlignmentScore(viewer.pet_volume, viewer.ct_trace, is_mask=True)
+        else:
+            alignment_score = AlignmentScore(viewer.pet_volume, viewer.ct_volume, is_mask=False)
+        self.alignment_scorer.set_alignment_score(alignment_score)
+        self.on_registrated(viewer.registrator)
+
+    def on_registrated(self, registrator: Registrator):
+        if self.is_mip_view():
+            self.mip_viewer.update_pet(registrator)
+        self.alignment_scorer.request(RegistrationParameters.from_registrator(registrator))
+        self.request_checkpoint()
+
+    def on_alignment_scored(self, score: float, label: str, parameters: str):
+        self.logger.info(f'[{label}] {score:.4f} {parameters}')
+        self.GUI_components.options.registration_group.set_score(label, score)
+
+    def export_root_uptake(self):
+        if self.data.pet_volume.is_empty() or self.data.ct_volume.is_empty():
+            return
+
+        trace_object = self.data.ct_trace.trace3D
+        within_pen = self.GUI_components.options.export_group.checkbox_within_pen.isChecked()
+        radius = trace_object.pen_size if within_pen and trace_object is not None else 0
+
+        transform = RegistrationTransform(
+            RegistrationParameters.from_registrator(self.threeD_viewer.registrator),
+            self.data.rescaled_pet_shape(),
+            self.data.ct_volume.shape()
+        )
+        uptake = root_uptake(self.data.rinfo, self.data.pet_volume.ndary, transform, radius=radius, resolution=self.data.ct_volume.resolution)
+        if len(uptake) == 0:
+            self.logger.error('No root trace is available.')
+            return
+
+        save_root_uptake(uptake, self.data.file.root_uptake_file)
+        self.logger.info(f'[Root uptake saved] {self.data.file.root_uptake_file} ({len(uptake)} roots)')
+
+    def on_volume_exported(self):
+        volume_exporter = self.sender()
+        if volume_exporter in self.volume_exporters:
+            self.volume_exporters.remove(volume_exporter)
+        self.logger.info(f'[Export finished] {volume_exporter.dest}')
+
+        pending_releases, self.pending_releases = self.pending_releases, []
+        for data in pending_releases:
+            self.release_sample(data)
+        if not self.is_control_locked():
+            self.show_default_msg_in_statusbar()
+
     def closeEvent(self, event):
+        self.save_checkpoint()
+        self.stop_volume_loader()
+        self.stop_pyramid_builder()
+        self.stop_prefetcher()
+        self.alignment_scorer.stop()
+        for volume_exporter in self.volume_exporters:
+            self.logger.info(f'Waiting for the export to {volume_exporter.dest}')
+            volume_exporter.wait()
+        self.volume_exporters = []
+        self.data.set_pet_frames(None, [])
+        self.sample_cache.clear()
+        for data in self.pending_releases:
+            data.clear_volumes()
         self.GUI_components.statusbar.thread.exit()
         super().closeEvent(event)
 
 class VolumeLoader(QThread):
-    def __init__(self, files, progressbar_signal):
+    """Loads a volume in two phases.
+
+    The slices shown in the viewer (every skip_size-th slice) are decoded first and
+    pyqtSignal_preview_loaded is emitted. The remaining slices are then decoded into
+    the same array, and the thread finishes when the volume is complete. A single-file
+    volume is memory-mapped, so it is available at once.
+    """
+
+    pyqtSignal_preview_loaded = pyqtSignal()
+
+    def __init__(self, volume_file: File, progressbar_signal):
         super().__init__()
-        self.files = files
+        self.volume_file = volume_file
+        self.files = volume_file.img_files
         self.progressbar_signal = progressbar_signal
+        self.__data = None
+        self.__written = 0
 
     def run(self):
-        def fun(f, i, total):
-            self.progressbar_signal.emit(i, total, 'File loading')
-            return io.imread(f)
+        if self.volume_file.is_single_file():
+            self.progressbar_signal.emit(0, 1, 'File loading')
+            self.__data = read_volume_file(self.volume_file.volume_file())
+            self.pyqtSignal_preview_loaded.emit()
+            self.quit()
+            return
+
+        total = len(self.files)
+        preview_indices = list(range(0, total, config.skip_size))
+        remaining_indices = [i for i in range(total) if i % config.skip_size != 0]
+
+        for count, i in enumerate(preview_indices):
+            if self.isInterruptionRequested():
+                return
+            self.progressbar_signal.emit(count, len(preview_indices), 'Preview loading')
+            self.__set_slice(i, io.imread(self.files[i]))
 
-        self.__data = [fun(f, i, len(self.files)) for i, f in enumerate(self.files)]
+        self.pyqtSignal_preview_loaded.emit()
+
+        for count, i in enumerate(remaining_indices):
+            if self.isInterruptionRequested():
+                return
+            self.progressbar_signal.emit(count, len(remaining_indices), 'File loading')
+            self.__set_slice(i, io.imread(self.files[i]))
+
+        release_pages(self.__data)
         self.quit()
 
+    def __set_slice(self, i: int, img: np.ndarray):
+        if self.__data is None:
+            #// a scratch file in the out-of-core mode
+            self.__data = allocate_volume((len(self.files),)+img.shape, img.dtype)
+            self.__slab_size = slab_size(self.__data.shape, self.__data.dtype)
+        self.__data[i] = img
+        self.__written += 1
+        if self.__written % self.__slab_size == 0:
+            release_pages(self.__data)
+
     def data(self):
-        return np.array(self.__data)
+        return self.__data
+
+class AlignmentScorer(QThread):
+    """Computes the alignment score in the background.
+
+    Only the latest request is kept, and a result is dropped if a newer request arrived
+    while it was computed, so the score follows the spin boxes without queuing up.
+    """
+
+    pyqtSignal_scored = pyqtSignal(float, str, str)
+
+    def __init__(self):
+        super().__init__()
+        self.__condition = threading.Condition()
+        self.__alignment_score = None
+        self.__request = None
+        self.__stopped = False
+
+    def set_alignment_score(self, alignment_score: AlignmentScore):
+        with self.__condition:
+            self.__alignment_score = alignment_score
+
+    def request(self, parameters: RegistrationParameters):
+        with self.__condition:
+            self.__request = parameters
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.__condition:
+                while self.__request is None and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                parameters, self.__request = self.__request, None
+                alignment_score = self.__alignment_score
+
+            if alignment_score is None:
+                continue
+
+            score = alignment_score.score(parameters)
+            label = 'Trace overlap' if alignment_score.is_mask else 'CT correlation'
+
+            with self.__condition:
+                if self.__request is None:
+                    self.pyqtSignal_scored.emit(score, label, str(parameters))
+
+class RegistrationSearcher(QThread):
+    def __init__(self, reference: np.ndarray, ndarray: np.ndarray, rescaled_shape: Tuple[int], progressbar_signal):
+        super().__init__()
+        self.reference = reference
+        self.ndarray = ndarray
+        self.rescaled_shape = rescaled_shape
+        self.progressbar_signal = progressbar_signal
+        self.candidates = []
+
+    def run(self):
+        self.progressbar_signal.emit(0, 2, 'Rescaling the PET volume')
+        #// a scratch file in the out-of-core mode, filled slab by slab
+        rescaled = rescale_volume(
+            self.ndarray, self.rescaled_shape,
+            out=allocate_volume(self.rescaled_shape, np.uint8), slab_size=slab_size(self.rescaled_shape, np.uint8)
+        )
+
+        self.progressbar_signal.emit(1, 2, 'Searching flip and rotation')
+        self.candidates = search_flip_rotation(self.reference, rescaled)
+        self.quit()
 
 class VolumeExporter(QThread):
-    def __init__(self, ndarray: np.ndarray, registrator: Registrator, dest: str, output_shape: List[int], progressbar_signal):
+    def __init__(self, ndarray: np.ndarray, rescaled_shape: Tuple[int], registrator: Registrator, dest: str, output_shape: List[int], progressbar_signal, box: Union[Tuple[slice], None]=None, voxel_scale: float=1., ct_resolution: float=1., frames: Union[np.memmap, None]=None, frame_names: Union[List[str], None]=None, source: Union[ChunkedVolume, None]=None):
+        """Exports the registrated PET volume on a grid aligned with the X-ray CT volume.
+
+        For a dynamic PET volume, all frames are exported in parallel with the same registration.
+
+        Args:
+            ndarray (np.ndarray): The original PET volume (not rescaled).
+            rescaled_shape (Tuple[int]): Shape of the rescaled PET volume that the registration applies to.
+            registrator (Registrator): The registration, copied here.
+            dest (str): The output directory.
+            output_shape (List[int]): Shape of the X-ray CT volume.
+            progressbar_signal: The progress bar signal.
+            box (Union[Tuple[slice], None], optional): Only this box of the X-ray CT volume is exported. Defaults to None.
+            voxel_scale (float, optional): Output voxel size in X-ray CT voxels. Defaults to 1.
+            ct_resolution (float, optional): X-ray CT voxel resolution, written to export.json. Defaults to 1.
+            frames (Union[np.memmap, None], optional): All frames of a dynamic PET volume, of which ndarray is one. Defaults to None.
+            frame_names (Union[List[str], None], optional): The output directory name of each frame. Defaults to None (no frames).
+            source (Union[ChunkedVolume, None], optional): The chunked copy of ndarray, from which only the chunks of the exported region are read. Defaults to None.
+        """
+
         super().__init__()
-        self.ndarray = deepcopy(ndarray)
+        #// a read-only snapshot of the original PET volume; it is resampled directly in run(), so no rescaled copy is made
+        self.ndarray = ndarray.view()
+        self.ndarray.flags.writeable = False
+        self.rescaled_shape = rescaled_shape
         self.dest = dest
         self.output_shape = output_shape
-        self.x = registrator.x
-        self.y = registrator.y
-        self.z = registrator.z
-        self.x_flip = registrator.x_flip
-        self.y_flip = registrator.y_flip
-        self.z_flip = registrator.z_flip
-        self.angle = registrator.angle
+        self.box = box
+        self.voxel_scale = voxel_scale
+        self.ct_resolution = ct_resolution
+        self.parameters = RegistrationParameters.from_registrator(registrator)
         self.progressbar_signal = progressbar_signal
+        self.frames = frames
+        self.frame_names = list(frame_names) if frame_names is not None else []
+        self.source = source
 
     def run(self):
-        self.ndarray = self.ndarray[::self.z_flip,::self.y_flip,::self.x_flip]
-
-        shifted_ndarray = np.zeros_like(self.ndarray)
-        shifted_ndarray[
-            max(0, -self.z*config.skip_size):min(shifted_ndarray.shape[0], shifted_ndarray.shape[0]-self.z*config.skip_size), 
-            max(0, -self.y*config.skip_size):min(shifted_ndarray.shape[1], shifted_ndarray.shape[1]-self.y*config.skip_size), 
-            max(0, -self.x*config.skip_size):min(shifted_ndarray.shape[2], shifted_ndarray.shape[2]-self.x*config.skip_size)
-        ] = self.ndarray[
-            max(self.z*config.skip_size, 0):min(self.ndarray.shape[0], self.ndarray.shape[0]+self.z*config.skip_size), 
-            max(self.y*config.skip_size, 0):min(self.ndarray.shape[1], self.ndarray.shape[1]+self.y*config.skip_size), 
-            max(self.x*config.skip_size, 0):min(self.ndarray.shape[2], self.ndarray.shape[2]+self.x*config.skip_size)
-        ]
-
-        self.progressbar_signal.emit(0, 2, 'Rotating the volume')
-        rotate_ndarray = rotate(shifted_ndarray, self.angle, axes=(1,2), reshape=False, prefilter=False, order=1)
-
-        final_array = np.zeros(self.output_shape, dtype=np.uint8)
-        
-        difference = [x1-x2 for x1, x2 in zip(self.output_shape, self.ndarray.shape)]
-
-        slices_for_final = []
-        slices_for_original = []
-        for i in range(3):
-            slices_for_final.append(
-                slice(
-                    max(difference[i]//2, 0), 
-                    min(self.output_shape[i]-(difference[i]-difference[i]//2), self.output_shape[i])
-                )
-            )
-            slices_for_original.append(
-                slice(
-                    max(-difference[i]//2, 0), 
-                    min(self.ndarray.shape[i]+(difference[i]-difference[i]//2), self.ndarray.shape[i])
-                )
-            )
+        export_registered(
+            self.ndarray, self.rescaled_shape, self.parameters, self.dest, self.output_shape,
+            box=self.box, voxel_scale=self.voxel_scale, ct_resolution=self.ct_resolution,
+            frames=self.frames, frame_names=self.frame_names, source=self.source,
+            progress=self.progressbar_signal.emit
+        )
+
+        self.quit()
+
+class PyramidBuilder(QThread):
+    def __init__(self, jobs: List[Tuple[str, str, np.ndarray, str, str]], progressbar_signal):
+        """Opens the pyramids of the loaded volumes, and builds those that are missing or outdated.
+
+        Args:
+            jobs (List[Tuple[str, str, np.ndarray, str, str]]): The name, directory, volume, signature and reduction of each pyramid.
+            progressbar_signal: The progress bar signal.
+        """
+
+        super().__init__()
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.jobs = jobs
+        self.progressbar_signal = progressbar_signal
+        self.pyramids = {}
+
+    def run(self):
+        #// an exception escaping run() aborts the application; without pyramids, the viewer keeps the display arrays
+        try:
+            pyramids = build_pyramids(self.jobs, is_cancelled=self.isInterruptionRequested, progress=self.progressbar_signal.emit)
+        except OSError as e:
+            self.logger.warning(f'[Pyramids not built] {e}')
+            return
+        if pyramids is None:
+            return
+        self.pyramids = pyramids
+
+        self.quit()
 
-        final_array[tuple(slices_for_final)] = rotate_ndarray[tuple(slices_for_original)]
+class SamplePrefetcher(QThread):
+    def __init__(self, directory: str):
+        """Loads a sample in the background for the sample cache, as it is loaded on opening with the rinfo file and the PET volume imported.
 
-        self.progressbar_signal.emit(1, 2, 'Saving the volume')
-        os.makedirs(self.dest, exist_ok=True)
-        for i in range(len(final_array)):
-            dest_file = os.path.join(self.dest, f'img{i:04}.tif')
-            io.imsave(dest_file, final_array[i])
+        Nothing is shown and no progress is reported, so the sample being aligned is not disturbed.
+        data is set once the sample is completely loaded.
+
+        Args:
+            directory (str): The X-ray CT volume directory.
+        """
+
+        super().__init__()
+        self.directory = directory
+        self.data = None
 
+    def run(self):
+        data = Data()
+        data.file = File(volume_directory=self.directory)
+        data.signature = data.file.sample_signature()
+
+        volume = self.read_ct_volume(data.file)
+        if volume is None:
+            return
+        data.ct_volume.init_from_volume(volume)
+        data.ct_trace.init_from_volume(volume)
+        #// what was imported, the resolutions, the frame and the registration of the last time
+        checkpoint = load_checkpoint(data.file.checkpoint_directory, data.signature)
+
+        if data.file.is_rinfo_file_available() and (checkpoint is None or checkpoint['rinfo']):
+            with open(data.file.rinfo_file, 'r') as f:
+                rinfo_dict = json.load(f)
+            if data.load_rinfo_from_dict(rinfo_dict, file=data.file.rinfo_file):
+                data.ct_volume.resolution = data.rinfo.annotations.resolution()
+
+        if os.path.isdir(data.file.pet_directory()) and not self.isInterruptionRequested() and (checkpoint is None or checkpoint['pet']):
+            if data.load_pet():
+                if checkpoint is not None:
+                    data.apply_checkpoint(checkpoint)
+                data.rescale_pet_volume()
+
+        if self.isInterruptionRequested():
+            data.clear_volumes()
+            return
+
+        #// the display arrays of the viewer, so that showing the sample copies nothing
+        trace = data.ct_trace.trace3D.volume[..., 1] if data.ct_trace.is_drawn() else None
+        data.display_arrays = (Qt3DViewer.display_array(volume), Qt3DViewer.display_array(trace) if trace is not None else None)
+        self.data = data
         self.quit()
+
+    def read_ct_volume(self, volume_file: File) -> Union[np.ndarray, None]:
+        """The X-ray CT volume, as read by VolumeLoader; None if interrupted."""
+
+        if volume_file.is_single_file():
+            return read_volume_file(volume_file.volume_file())
+
+        volume = None
+        for i, f in enumerate(volume_file.img_files):
+            if self.isInterruptionRequested():
+                return None
+            img = io.imread(f)
+            if volume is None:
+                #// a scratch file in the out-of-core mode
+                volume = allocate_volume((len(volume_file.img_files),)+img.shape, img.dtype)
+                size = slab_size(volume.shape, volume.dtype)
+            volume[i] = img
+            if (i+1) % size == 0:
+                release_pages(volume)
+
+        release_pages(volume)
+        return volume
@@ -1,9 +1,11 @@
+from typing import List
+
 from GUI.components import QtMain
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QDoubleValidator
-from PyQt5.QtWidgets import (QCheckBox, QGroupBox, QHBoxLayout, QLabel,
-                             QLineEdit, QPushButton, QSizePolicy, QSlider,
-                             QSpinBox, QVBoxLayout, QWidget)
+from PyQt5.QtWidgets import (QCheckBox, QComboBox, QGroupBox, QHBoxLayout,
+                             QLabel, QLineEdit, QPushButton, QSizePolicy,
+                             QSlider, QSpinBox, QVBoxLayout, QWidget)
 
 
 class QtOptions(QWidget):
@@ -13,15 +15,23 @@ class QtOptions(QWidget):
 
         self.setLayout(QVBoxLayout(self))
 
+        self.session_group = SessionGroup(parent=parent)
+        self.layout().addWidget(self.session_group)
+        self.view_group = ViewGroup(parent=parent)
+        self.layout().addWidget(self.view_group)
         self.resolution_group = ResolutionGroup(parent=parent)
         self.layout().addWidget(self.resolution_group)
         self.intensity_group = IntensityGroup(parent=parent)
         self.layout().addWidget(self.intensity_group)
+        self.frame_group = FrameGroup(parent=parent)
+        self.layout().addWidget(self.frame_group)
 
         self.flip_group = FlipGroup(parent=parent)
         self.layout().addWidget(self.flip_group)
         self.registration_group = RegistrationGroup(parent=parent)
         self.layout().addWidget(self.registration_group)
+        self.search_group = SearchGroup(parent=parent)
+        self.layout().addWidget(self.search_group)
 
         self.export_group = ExportGroup(parent=parent)
         self.layout().addWidget(self.export_group)
@@ -31,6 +41,8 @@ class QtOptions(QWidget):
     def update_valid_option(self):
         self.main_window_instance.data.pet_volume
 
+        self.search_group.set_candidates([])
+
         #// update resolution spinboxes
         for spinbox, resolution in zip(
                     [self.resolution_group.xray_ct_resolution_edit, self.resolution_group.pet_resolution_edit],
@@ -43,11 +55,60 @@ class QtOptions(QWidget):
                     self.resolution_group,
                     self.export_group,
                     self.registration_group,
+                    self.search_group,
                     self.flip_group,
                     self.intensity_group
                 ]:
             widget.setEnabled(self.main_window_instance.data.pet_volume.is_empty()==False)
         
+class SessionGroup(QGroupBox):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__('Session')
+        self.main_window_instance = parent
+        self.setLayout(QHBoxLayout(self))
+
+        self.push_button_previous = QPushButton(parent=parent, text='<')
+        self.combo_box_sample = QComboBox()
+        self.combo_box_sample.setToolTip('The samples of the opened folder. The next sample is loaded in the background while the current one is aligned.')
+        self.push_button_next = QPushButton(parent=parent, text='>')
+        self.layout().addWidget(self.push_button_previous)
+        self.layout().addWidget(self.combo_box_sample)
+        self.layout().addWidget(self.push_button_next)
+        self.setVisible(False)
+
+        self.combo_box_sample.activated.connect(self.main_window_instance.open_session_sample)
+        self.push_button_previous.clicked.connect(lambda: self.main_window_instance.open_session_sample(self.combo_box_sample.currentIndex()-1))
+        self.push_button_next.clicked.connect(lambda: self.main_window_instance.open_session_sample(self.combo_box_sample.currentIndex()+1))
+
+    def set_samples(self, names: List[str]):
+        self.combo_box_sample.blockSignals(True)
+        self.combo_box_sample.clear()
+        self.combo_box_sample.addItems(names)
+        self.combo_box_sample.blockSignals(False)
+        self.setVisible(len(names) != 0)
+
+    def set_current(self, index: int):
+        self.combo_box_sample.blockSignals(True)
+        self.combo_box_sample.setCurrentIndex(index)
+        self.combo_box_sample.blockSignals(False)
+        self.push_button_previous.setEnabled(index > 0)
+        self.push_button_next.setEnabled(0 <= index < self.combo_box_sample.count()-1)
+
+class ViewGroup(QGroupBox):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__('View')
+        self.main_window_instance = parent
+        self.setLayout(QVBoxLayout(self))
+
+        self.checkbox_mip_view = QCheckBox(text='Orthogonal MIPs (2D)')
+        self.checkbox_mip_view.setToolTip('Show maximum intensity projections instead of the 3D volume rendering')
+        self.layout().addWidget(self.checkbox_mip_view)
+
+        self.checkbox_mip_view.stateChanged.connect(self.state_changed)
+
+    def state_changed(self, _):
+        self.main_window_instance.set_mip_view(self.checkbox_mip_view.isChecked())
+
 class ResolutionGroup(QGroupBox):
     def __init__(self, parent: QtMain) -> None:
         super().__init__('Resolution')
@@ -79,8 +140,10 @@ class ResolutionGroup(QGroupBox):
         self.main_window_instance.data.pet_volume.resolution = float(self.pet_resolution_edit.text())
 
         self.main_window_instance.set_control(True)
-        rescaled_pet_volume = self.main_window_instance.data.rescale_pet_volume()
-        self.main_window_instance.threeD_viewer.set_pet_volume(rescaled_pet_volume)
+        #// the viewer holds a view of the previous preview; drop it so both are not resident at once
+        self.main_window_instance.threeD_viewer.set_pet_volume(None)
+        pet_volume_preview = self.main_window_instance.data.rescale_pet_volume()
+        self.main_window_instance.threeD_viewer.set_pet_volume(pet_volume_preview)
         self.main_window_instance.set_control(False)
 
 class ResolutionLineEdit(QLineEdit):
@@ -89,6 +152,30 @@ class ResolutionLineEdit(QLineEdit):
         self.setValidator(QDoubleValidator())
         self.setSizePolicy(QSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed))
 
+class FrameGroup(QGroupBox):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__('PET frame')
+        self.main_window_instance = parent
+        self.setLayout(QHBoxLayout(self))
+
+        self.frame_spinbox = QSpinBox()
+        self.frame_spinbox.setToolTip('The frame of a dynamic PET volume shown in the viewer. All frames share the registration.')
+        self.layout().addWidget(QLabel('Frame'))
+        self.layout().addWidget(self.frame_spinbox)
+        self.set_frame_count(0)
+
+        self.frame_spinbox.valueChanged.connect(self.value_changed)
+
+    def value_changed(self, value: int):
+        self.main_window_instance.select_pet_frame(value)
+
+    def set_frame_count(self, count: int, index: int=0):
+        self.frame_spinbox.blockSignals(True)
+        self.frame_spinbox.setRange(0, max(0, count-1))
+        self.frame_spinbox.setValue(index)
+        self.frame_spinbox.blockSignals(False)
+        self.setEnabled(count > 1)
+
 class FlipGroup(QGroupBox):
     def __init__(self, parent: QtMain) -> None:
         super().__init__('Flip')
@@ -116,6 +203,13 @@ class FlipGroup(QGroupBox):
             z_flip=self.checkbox_z_flip.isChecked()
         )
 
+    def set_flip_states(self, x_flip: bool, y_flip: bool, z_flip: bool):
+        for checkbox, state in zip([self.checkbox_x_flip, self.checkbox_y_flip, self.checkbox_z_flip], [x_flip, y_flip, z_flip]):
+            checkbox.blockSignals(True)
+            checkbox.setChecked(state)
+            checkbox.blockSignals(False)
+        self.state_changed(None)
+
 class RegistrationGroup(QGroupBox):
     def __init__(self, parent: QtMain) -> None:
         super().__init__('Registration')
@@ -145,6 +239,11 @@ class RegistrationGroup(QGroupBox):
         self.label_layout.addWidget(QLabel('Rotate: '))
         self.edit_layout.addWidget(self.spin_box_rotate)
 
+        self.score_label = QLabel('Score: ')
+        self.score_value = QLabel('-')
+        self.label_layout.addWidget(self.score_label)
+        self.edit_layout.addWidget(self.score_value)
+
         self.layout().addLayout(self.label_layout)
         self.layout().addLayout(self.edit_layout)
 
@@ -159,6 +258,61 @@ class RegistrationGroup(QGroupBox):
                 self.spin_box_rotate.value()
             )
 
+    def set_score(self, label: str, score: float):
+        self.score_label.setText(f'{label}: ')
+        self.score_value.setText(f'{score:.4f}')
+
+    def set_values(self, x: int, y: int, z: int, angle: int):
+        for spin_box, value in zip([self.spin_box_left_right, self.spin_box_back_forth, self.spin_box_up_down, self.spin_box_rotate], [x, y, z, angle]):
+            spin_box.blockSignals(True)
+            spin_box.setValue(value)
+            spin_box.blockSignals(False)
+        self.spinbox_changed()
+
+class SearchGroup(QGroupBox):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__('Search')
+        self.main_window_instance = parent
+        self.setLayout(QVBoxLayout(self))
+
+        self.push_button_search = QPushButton(parent=parent, text='Search flip && rotation')
+        self.push_button_search.setToolTip('Evaluate all flip states and rotation angles at coarse resolution')
+        self.layout().addWidget(self.push_button_search)
+
+        self.combo_box_candidates = QComboBox()
+        self.layout().addWidget(self.combo_box_candidates)
+
+        self.fit_layout = QHBoxLayout()
+        self.push_button_fit = QPushButton(parent=parent, text='Fit to trace')
+        self.push_button_fit.setToolTip('Align PET hotspots to the root trace points')
+        self.checkbox_search_flips = QCheckBox(text='all flips')
+        self.fit_layout.addWidget(self.push_button_fit)
+        self.fit_layout.addWidget(self.checkbox_search_flips)
+        self.layout().addLayout(self.fit_layout)
+
+        self.push_button_search.clicked.connect(self.main_window_instance.search_registration)
+        self.push_button_fit.clicked.connect(self.main_window_instance.fit_registration_to_trace)
+        self.combo_box_candidates.activated.connect(self.candidate_selected)
+        self.candidates = []
+
+    def set_candidates(self, candidates):
+        self.candidates = candidates
+        self.combo_box_candidates.clear()
+        for i, (score, parameters) in enumerate(candidates):
+            self.combo_box_candidates.addItem(f'#{i+1} ({score:.3f}) {parameters}')
+
+        if len(candidates) != 0:
+            self.candidate_selected(0)
+
+    def candidate_selected(self, index: int):
+        if index < 0 or index >= len(self.candidates):
+            return
+
+        _, parameters = self.candidates[index]
+        options = self.main_window_instance.GUI_components.options
+        options.flip_group.set_flip_states(x_flip=parameters.x_flip==-1, y_flip=parameters.y_flip==-1, z_flip=parameters.z_flip==-1)
+        options.registration_group.set_values(parameters.x, parameters.y, parameters.z, parameters.angle)
+
 class SpinBox_Shift(QSpinBox):
     def __init__(self) -> None:
         super().__init__()
@@ -192,6 +346,11 @@ class IntensityGroup(QGroupBox):
         self.layout().addWidget(QLabel('PET'))
         self.layout().addWidget(self.pet_slider)
 
+        self.checkbox_pet_points = PET_PointsCheckBox(parent=parent)
+        self.layout().addWidget(self.checkbox_pet_points)
+        self.pet_threshold_slider = PET_ThresholdSlider(parent=parent)
+        self.layout().addWidget(self.pet_threshold_slider)
+
 class IntensitySlider(QSlider):
     def __init__(self) -> None:
         super().__init__(Qt.Horizontal)
@@ -232,14 +391,87 @@ class PET_IntensitySlider(IntensitySlider):
         self.main_window_instance.threeD_viewer.pet_volume_intensity_changed(intensity=self.value()/10)
 
 
+class PET_PointsCheckBox(QCheckBox):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__(text='PET as points above threshold')
+        self.main_window_instance = parent
+        self.setToolTip('Draw only PET voxels above the threshold as points instead of the whole volume')
+
+        self.stateChanged.connect(self.state_changed)
+
+    def state_changed(self, _):
+        self.main_window_instance.threeD_viewer.pet_display_mode_changed(points=self.isChecked())
+
+class PET_ThresholdSlider(QSlider):
+    def __init__(self, parent: QtMain) -> None:
+        super().__init__(Qt.Horizontal)
+        self.main_window_instance = parent
+        self.setMinimum(1)
+        self.setMaximum(255)
+        self.setSingleStep(8)
+        self.setValue(64)
+        self.setToolTip('PET threshold of the point display')
+
+        self.sliderReleased.connect(self.value_changed)
+
+    def value_changed(self):
+        self.main_window_instance.threeD_viewer.pet_threshold_changed(threshold=self.value())
+
+
 class ExportGroup(QGroupBox):
     def __init__(self, parent: QtMain) -> None:
         super().__init__('Export')
         self.main_window_instance = parent
         self.setLayout(QVBoxLayout(self))
 
+        self.volume_layout = QHBoxLayout()
         self.push_button_registrated_pet_volume = QPushButton(parent=parent, text='Registrated PET volume')
-        self.layout().addWidget(self.push_button_registrated_pet_volume)
+        self.checkbox_crop = QCheckBox(text='crop to content')
+        self.checkbox_crop.setToolTip('Export only the box of the X-ray CT volume and trace content; the offset is saved in export.json')
+        self.volume_layout.addWidget(self.push_button_registrated_pet_volume)
+        self.volume_layout.addWidget(self.checkbox_crop)
+        self.layout().addLayout(self.volume_layout)
+
+        self.voxel_size_layout = QHBoxLayout()
+        self.voxel_size_layout.addWidget(QLabel('voxel size: '))
+        self.combo_box_voxel_size = QComboBox()
+        self.combo_box_voxel_size.addItems(['X-ray CT', 'PET', 'custom'])
+        self.combo_box_voxel_size.setToolTip('Voxel size of the exported volume. Coarser voxels reduce the export time and disk use by the cube of the ratio.')
+        self.voxel_size_edit = ResolutionLineEdit(toolTip='Custom voxel size, in the unit of the resolutions (double)')
+        self.voxel_size_edit.setEnabled(False)
+        self.voxel_size_layout.addWidget(self.combo_box_voxel_size)
+        self.voxel_size_layout.addWidget(self.voxel_size_edit)
+        self.layout().addLayout(self.voxel_size_layout)
+
+        self.combo_box_voxel_size.currentTextChanged.connect(lambda text: self.voxel_size_edit.setEnabled(text == 'custom'))
 
         self.push_button_registrated_pet_volume.clicked.connect(self.main_window_instance.export_volume)
 
+        self.push_button_registration = QPushButton(parent=parent, text='Registration parameters (JSON)')
+        self.push_button_registration.setToolTip('Saved as [volume_name]_registration.json, also on each volume export')
+        self.layout().addWidget(self.push_button_registration)
+
+        self.push_button_registration.clicked.connect(self.main_window_instance.save_registration_parameters)
+
+        self.uptake_layout = QHBoxLayout()
+        self.push_button_root_uptake = QPushButton(parent=parent, text='Root uptake (CSV)')
+        self.push_button_root_uptake.setToolTip('PET uptake along each root, saved as [volume_name]_root_uptake.csv')
+        self.checkbox_within_pen = QCheckBox(text='within pen')
+        self.uptake_layout.addWidget(self.push_button_root_uptake)
+        self.uptake_layout.addWidget(self.checkbox_within_pen)
+        self.layout().addLayout(self.uptake_layout)
+
+        self.push_button_root_uptake.clicked.connect(self.main_window_instance.export_root_uptake)
+
+    def voxel_size(self, ct_resolution: float, pet_resolution: float):
+        text = self.combo_box_voxel_size.currentText()
+        if text == 'PET':
+            return pet_resolution
+        if text == 'custom':
+            try:
+                voxel_size = float(self.voxel_size_edit.text())
+            except ValueError:
+                return ct_resolution
+            return voxel_size if voxel_size > 0 else ct_resolution
+        return ct_resolution
+
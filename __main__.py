@@ -6,12 +6,26 @@ import config
 
 warnings.filterwarnings('ignore') 
 
-import GUI
-
 parser = argparse.ArgumentParser(description=f'{config.application_name} version {config.version_string()}: {config.description}')
 parser.add_argument('-d', '--debug', action='store_true')
+parser.add_argument('--qc', nargs='+', metavar='DIR', help='Render QC snapshots of the samples with saved registration parameters in DIR (or DIR itself) without the GUI.')
+parser.add_argument('--qc-output', default='', metavar='DIR', help='Directory for the QC snapshots. Defaults to next to each sample.')
+parser.add_argument('--processes', type=int, default=None, help='Number of worker processes for the QC snapshots.')
+parser.add_argument('--serve', type=int, default=None, metavar='PORT', help='Service mode: run export, uptake, registration and QC jobs posted as JSON to http://HOST:PORT/jobs without the GUI.')
+parser.add_argument('--host', default='127.0.0.1', help='Address the service mode listens on. Defaults to 127.0.0.1 (this machine only).')
+parser.add_argument('--workers', type=int, default=2, help='Number of jobs the service mode runs at once.')
+parser.add_argument('--watch', default=None, metavar='DIR', help='Watch mode: prepare the trace masks (and pyramids, with build_pyramid) of the samples arriving in DIR once their files are complete and stable, and export those with a registration file.')
+parser.add_argument('--settle', type=float, default=30., metavar='SECONDS', help='Seconds the files of a sample have to stay unchanged in the watch mode.')
+parser.add_argument('--watch-interval', type=float, default=10., metavar='SECONDS', help='Seconds between the scans of the watch mode.')
+parser.add_argument('--session', default='', metavar='DIR', help='Open the folder of samples DIR as a session; the next sample is loaded in the background while one is aligned.')
+parser.add_argument('--memory-limit', type=float, default=None, metavar='MB', help='Out-of-core mode: hold full resolution volumes in scratch files and process them in z-slabs that fit in this ceiling.')
+parser.add_argument('--scratch', default=None, metavar='DIR', help='Directory of the scratch files of the out-of-core mode. Defaults to the system temporary directory.')
 
 args = parser.parse_args()
+if args.memory_limit is not None:
+    config.memory_limit_mb = args.memory_limit
+if args.scratch is not None:
+    config.scratch_directory = args.scratch
 logger_level = logging.DEBUG if args.debug else logging.INFO
 
 try:
@@ -26,6 +40,17 @@ if __name__ == '__main__':
     pil_logger = logging.getLogger('PIL')
     pil_logger.setLevel(logging.INFO)
 
-    GUI.start()
+    if args.qc is not None:
+        from DATA import batch_qc_snapshots
+        batch_qc_snapshots(args.qc, output_directory=args.qc_output, processes=args.processes)
+    elif args.serve is not None:
+        from DATA import serve_jobs
+        serve_jobs(args.serve, host=args.host, workers=args.workers)
+    elif args.watch is not None:
+        from DATA import watch_samples
+        watch_samples(args.watch, interval=args.watch_interval, settle_time=args.settle)
+    else:
+        import GUI
+        GUI.start(session=args.session)
 
 
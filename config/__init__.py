@@ -8,6 +8,29 @@ revision = 1
 
 skip_size = 2
 
+#// percentile clipped at each end of the PET intensity range when it is normalized to 8 bit
+pet_clip_percentile = 0.
+
+#// the display buffers of the 3D viewer are cropped to the content: non-zero X-ray CT and trace voxels, and PET voxels above this ratio of the maximum
+crop_noise_ratio = 0.05
+#// margin of the cropped display buffers in display voxels
+crop_margin = 2
+
+#// out-of-core mode: with a positive ceiling (MB), full resolution volumes and intermediates are held in memory-mapped scratch files and processed in z-slabs sized to fit in it; 0 keeps them in memory
+memory_limit_mb = 0
+#// directory of the scratch files; '' is the system temporary directory
+scratch_directory = ''
+
+#// a chunked copy of the volumes with downsampled levels ([volume_name]_pyramid/) is written once after loading, for the 3D viewer and the exporter;
+#// off by default, since it writes about 1.15 times the volumes next to the data
+build_pyramid = False
+pyramid_chunk_size = 64
+#// texture memory (MB) of the X-ray CT volume in the 3D viewer; the finest pyramid level within it is shown, and finer levels around the center when zoomed in
+display_budget_mb = 128
+
+#// recently closed samples (volumes, rinfo, trace and display buffers) kept in memory (MB) so that switching back to one is instant; 0 disables the cache
+sample_cache_mb = 2048
+
 def version_string():
     return f'{version}.{revision}'
 
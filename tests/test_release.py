@@ -0,0 +1,38 @@
+import gc
+import weakref
+
+import numpy as np
+from GUI.components.QtMain import Data, Qt3DViewer, VolumeExporter
+
+
+class Registration(object):
+    x, y, z, angle = 0, 0, 0, 0
+    x_flip, y_flip, z_flip = False, False, False
+
+class ProgressSignal(object):
+    def emit(self, *args):
+        pass
+
+def test_exporter_does_not_copy():
+    ndarray = np.arange(8*6*4, dtype=np.uint8).reshape(8, 6, 4)
+    exporter = VolumeExporter(ndarray, ndarray.shape, Registration(), '', list(ndarray.shape), ProgressSignal())
+
+    assert np.shares_memory(exporter.ndarray, ndarray)
+    assert not exporter.ndarray.flags.writeable
+
+def test_clear_volumes_drops_every_reference():
+    data = Data()
+    ct = np.ones((16, 12, 8), dtype=np.uint8)
+    pet = np.ones((8, 6, 4), dtype=np.float32)
+    data.ct_volume.init_from_volume(ct)
+    data.ct_trace.init_from_volume(ct)
+    data.pet_volume.init_from_volume(pet)
+    data.rescale_pet_volume()
+    data.display_arrays = (Qt3DViewer.display_array(ct), None)
+
+    references = [weakref.ref(ct), weakref.ref(pet), weakref.ref(data.ct_trace.trace3D.volume), weakref.ref(data.pet_volume_preview.ndary)]
+    del ct, pet
+    data.clear_volumes()
+    gc.collect()
+
+    assert all([reference() is None for reference in references])
@@ -0,0 +1,44 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from DATA.RSA.components.shared import attach_array
+from DATA.RSA.components.volume import Volume
+
+
+def attached_sum(handle: tuple):
+    ndarray = attach_array(handle)
+    return int(ndarray.sum()), ndarray.flags.owndata, ndarray.flags.writeable
+
+def test_worker_maps_volume():
+    ndarray = np.arange(16*12*8, dtype=np.uint16).reshape(16, 12, 8)
+    volume = Volume()
+    volume.init_from_volume(ndarray)
+    handle = volume.shared_handle()
+
+    assert not volume.ndary.flags.writeable
+    assert np.array_equal(volume.ndary, ndarray)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(attached_sum, [handle]*2))
+    assert results == [(int(ndarray.sum()), False, False)]*2
+
+    volume.clear()
+    if handle[0] == 'memory':
+        assert not os.path.exists(os.path.join('/dev/shm', handle[1]))
+    else:
+        assert not os.path.exists(handle[1])
+
+def test_memory_mapped_volume_is_not_copied(tmp_path):
+    path = str(tmp_path/'volume.npy')
+    np.save(path, np.arange(16*12*8, dtype=np.uint8).reshape(16, 12, 8))
+    ndarray = np.load(path, mmap_mode='r')
+    volume = Volume()
+    volume.init_from_volume(ndarray)
+    handle = volume.shared_handle()
+
+    assert handle[0] == 'file' and handle[1] == path
+    assert np.shares_memory(volume.ndary, ndarray)
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(attached_sum, handle).result()[0] == int(ndarray.sum())
+    volume.clear()
+    assert os.path.exists(path)